@@ -0,0 +1,313 @@
+#
+# Benchmarks for the tester's own hot paths, so that a slowdown in the grading path
+# shows up before a deadline night, not during one.
+#
+# Synthetic test-aN fixtures are built in a scratch directory and served by a local
+# HTTP server that stands in for TESTER_URL_ROOT, so nothing touches the network.
+# Each stage is timed --repeat times; the table shows the median and best times and
+# the median throughput.
+#
+#   py3 bench-tester.py                          # run every stage
+#   py3 bench-tester.py --save base.json         # ... and save the timings as a baseline
+#   py3 bench-tester.py --compare base.json      # ... and compare with a saved baseline
+#   py3 bench-tester.py --stage diff,html --lines 1000,100000 --mismatch 0.001,0.1
+#   py3 bench-tester.py --tester ~/old/a5-tester.py --save old.json
+#
+# Stages:
+#   sync      building test-aN from TESTER_URL_ROOT (ensure_test_dir_current)
+#   glob      finding a program's tests (get_tests)
+#   post      post_process() with sort, sort+uniq, fake_news_sort and friends_sort
+#   diff      make_diff() with both DIFF_TYPEs
+#   html      DiffFile.add_diff() and DiffReport.add_diff()
+#   run       run_tests() end to end: running, comparing and reporting
+#
+# --compare exits with status 1 if any stage is more than --threshold slower than
+# its baseline.
+#
+
+import argparse
+import contextlib
+import difflib
+import functools
+import http.server
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ASSIGNMENT = "a99"
+PROGRAM = "bench.py"
+STAGES = ["sync", "glob", "post", "diff", "html", "run"]
+
+# The program run by the "run" stage: it copies its input to its output.
+PROGRAM_TEXT = """import sys
+for line in sys.stdin:
+    print(line, end="")
+"""
+
+def load_tester(path):
+    """Import the tester at path as a module.  The tester must have an 'if __name__ == "__main__"' guard."""
+    spec = importlib.util.spec_from_file_location("tester", path)
+    tester = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(tester)
+    return tester
+
+def make_lines(n, seed=0):
+    """Return n lines that look like counted words, "w012345 17", which suit all the post-process operations"""
+    rng = random.Random(seed)
+    return ["w{:06d} {}\n".format(rng.randrange(10**6), rng.randrange(50)) for _ in range(n)]
+
+def mismatch(lines, rate, seed=1):
+    """Return a copy of lines with a fraction rate of them changed"""
+    rng = random.Random(seed)
+    result = list(lines)
+    for i in rng.sample(range(len(lines)), int(len(lines) * rate)):
+        result[i] = "changed " + result[i]
+    return result
+
+def write_lines(fname, lines):
+    with open(fname, "w") as f:
+        f.writelines(lines)
+
+def make_fixtures(server_root, cases, lines, rate):
+    """Write a fixture set of cases tests with lines-line inputs in server_root/assgNN/tester/"""
+    tester_dir = os.path.join(server_root, "assg{:02d}".format(int(ASSIGNMENT[1:])), "tester")
+    if os.path.isdir(tester_dir):
+        shutil.rmtree(tester_dir)
+    os.makedirs(tester_dir)
+    basename = PROGRAM.split(".")[0]
+    for test in range(1, cases + 1):
+        input_lines = make_lines(lines, seed=test)
+        write_lines(os.path.join(tester_dir, "{}-input-{:02d}.txt".format(basename, test)), input_lines)
+        write_lines(os.path.join(tester_dir, "{}-expected-{:02d}.txt".format(basename, test)), mismatch(input_lines, rate, seed=test))
+    write_lines(os.path.join(tester_dir, "testfiles.txt"), [])
+    write_lines(os.path.join(tester_dir, "version.txt"), ["{}-{}-{}\n".format(cases, lines, rate)])
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+def start_server(root):
+    """Start an HTTP server for root in a thread and return it; its URL is server.url"""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=root))
+    server.url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+class Bench:
+    """Runs and times the stages, collecting a result per (stage, case) in self.results"""
+    def __init__(self, tester, work_dir, server_root, args):
+        self.tester = tester
+        self.work_dir = work_dir
+        self.server_root = server_root
+        self.args = args
+        self.results = {}
+
+    def measure(self, stage, case, items, unit, setup, func):
+        """
+        Time func() args.repeat times, calling setup() untimed before each.  If there's
+        no setup, func() is called enough times per repetition to take at least
+        MIN_TIME seconds, like timeit does, so that quick stages aren't all noise.
+        """
+        MIN_TIME = 0.05
+        loops = 1
+        if setup is None:
+            setup = lambda: None
+            while loops < 10**6 and self.time_loops(func, loops) < MIN_TIME:
+                loops *= 2
+
+        times = []
+        for _ in range(self.args.repeat):
+            setup()
+            times.append(self.time_loops(func, loops) / loops)
+        median = statistics.median(times)
+        key = "{} {}".format(stage, case)
+        self.results[key] = {"stage": stage, "case": case, "items": items, "unit": unit,
+            "median": median, "best": min(times)}
+        self.show(key)
+
+    def time_loops(self, func, loops):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for _ in range(loops):
+                func()
+            return time.perf_counter() - start
+
+    def show(self, key):
+        result = self.results[key]
+        line = "{:<44} {:>8} {:>10.3f}ms {:>10.3f}ms {:>12.0f} {}/s".format(key, result["items"],
+            1000 * result["median"], 1000 * result["best"], result["items"] / result["median"], result["unit"])
+        baseline = self.args.baseline.get(key)
+        if baseline:
+            ratio = result["median"] / baseline["median"]
+            result["ratio"] = ratio
+            line += "  {:5.2f}x{}".format(ratio, "  SLOWER" if ratio > 1 + self.args.threshold else "")
+        print(line)
+        sys.stdout.flush()
+
+    def fixtures(self, cases, lines, rate):
+        make_fixtures(self.server_root, cases, lines, rate)
+        test_dir = "test-" + ASSIGNMENT
+        if os.path.isdir(test_dir):
+            shutil.rmtree(test_dir)
+        self.tester.ensure_test_dir_current(ASSIGNMENT)
+
+    def bench_sync(self):
+        for cases in self.args.cases:
+            make_fixtures(self.server_root, cases, 100, 0)
+            def setup():
+                shutil.rmtree("test-" + ASSIGNMENT, ignore_errors=True)
+            self.measure("sync", "cases={}".format(cases), 2 * cases + 2, "files", setup,
+                lambda: self.tester.ensure_test_dir_current(ASSIGNMENT))
+
+    def bench_glob(self):
+        for cases in self.args.cases:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.fixtures(cases, 1, 0)
+            self.measure("glob", "cases={}".format(cases), cases, "tests", None,
+                lambda: self.tester.get_tests(PROGRAM.split(".")[0], ASSIGNMENT))
+
+    def bench_post(self):
+        for op in ["sort", "sort,uniq", "fake_news_sort", "friends_sort"]:
+            for lines in self.args.lines:
+                data = make_lines(lines)
+                self.measure("post", "{} lines={}".format(op, lines), lines, "lines", None,
+                    lambda: self.tester.post_process(list(data), op.split(",")))
+
+    def bench_diff(self):
+        tester = self.tester
+        saved = tester.DIFF_TYPE
+        try:
+            for diff_type in ["unified", "context"]:
+                # Older testers' DIFF_TYPE is one of difflib's functions
+                tester.DIFF_TYPE = diff_type if hasattr(tester, "DIFF_TYPES") else getattr(difflib, diff_type + "_diff")
+                for lines in self.args.lines:
+                    for rate in self.args.mismatch:
+                        if rate == 0:
+                            continue
+                        expected = make_lines(lines)
+                        actual = mismatch(expected, rate)
+                        self.measure("diff", "{} lines={} mismatch={}".format(diff_type, lines, rate),
+                            lines, "lines", None,
+                            lambda: tester.make_diff(expected, actual, "expected", "actual"))
+        finally:
+            tester.DIFF_TYPE = saved
+
+    def bench_html(self):
+        for lines in self.args.lines:
+            for rate in self.args.mismatch:
+                expected = make_lines(lines)
+                actual = mismatch(expected, rate)
+                for fname, contents in [("input.txt", expected), ("expected.txt", expected), ("actual.txt", actual)]:
+                    write_lines(fname, contents)
+                # diff.html as a single file, and as an index with a page per test (older testers don't have that)
+                for name, diff_class in [("", self.tester.DiffFile), ("report ", getattr(self.tester, "DiffReport", None))]:
+                    if not diff_class:
+                        continue
+                    diff_files = []
+                    def setup():
+                        diff_files[:] = [diff_class(ASSIGNMENT, "bench-diff.html")]
+                    def add_diff():
+                        diff_file = diff_files[0]
+                        diff_file.add_diff(PROGRAM, "01", "expected.txt", expected, "actual.txt", actual, "input.txt", rate == 0)
+                        diff_file.finish()
+                    self.measure("html", "{}lines={} mismatch={}".format(name, lines, rate), lines, "lines", setup, add_diff)
+
+    def bench_run(self):
+        tester = self.tester
+        write_lines(PROGRAM, [PROGRAM_TEXT])
+        program = tester.Program(PROGRAM)
+        for cases in self.args.cases:
+            for lines in self.args.lines:
+                for rate in self.args.mismatch:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        self.fixtures(cases, lines, rate)
+                    runner = tester.WarmRunner() if self.args.warm else tester.SubprocessRunner()
+                    test_cases = []
+                    def setup():
+                        diff_file = tester.DiffFile(ASSIGNMENT, "bench-diff.html")
+                        submission = tester.Submission("bench", ASSIGNMENT, "", "test-" + ASSIGNMENT, diff_file, out=io.StringIO())
+                        test_cases[:] = tester.get_test_cases(program, ASSIGNMENT, submission)
+                    def run():
+                        tester.run_tests(test_cases, self.args.jobs, runner)
+                        test_cases[0].submission.diff_file.finish()
+                    try:
+                        self.measure("run", "cases={} lines={} mismatch={}".format(cases, lines, rate), cases, "tests",
+                            setup, run)
+                    finally:
+                        runner.close()
+
+def parse_list(type):
+    return lambda s: [type(item) for item in s.split(",")]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tester's hot paths on synthetic fixtures")
+    parser.add_argument("--tester", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "tester.py"),
+        help="the tester to benchmark (default: tester.py next to this script)")
+    parser.add_argument("--stage", type=parse_list(str), default=STAGES,
+        help="comma-separated stages to run (default: {})".format(",".join(STAGES)))
+    parser.add_argument("--cases", type=parse_list(int), default=[10, 50], help="numbers of tests (default: 10,50)")
+    parser.add_argument("--lines", type=parse_list(int), default=[100, 10000],
+        help="lines of output per test (default: 100,10000)")
+    parser.add_argument("--mismatch", type=parse_list(float), default=[0, 0.01, 0.2],
+        help="fractions of output lines that differ from the expected output (default: 0,0.01,0.2)")
+    parser.add_argument("--repeat", type=int, default=3, help="times to run each measurement (default: 3)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="jobs for the run stage (default: 1)")
+    parser.add_argument("--warm", action="store_true", help="use the warm runner for the run stage")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline in FILE")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with the baseline in FILE")
+    parser.add_argument("--threshold", type=float, default=0.25,
+        help="with --compare, report stages more than this fraction slower than the baseline (default: 0.25)")
+    args = parser.parse_args()
+
+    unknown = set(args.stage) - set(STAGES)
+    if unknown:
+        parser.error("no such stage: {}".format(", ".join(sorted(unknown))))
+
+    args.baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            args.baseline = json.load(f)["results"]
+
+    tester = load_tester(os.path.abspath(args.tester))
+    scratch = tempfile.mkdtemp(prefix="bench-tester-")
+    server_root = os.path.join(scratch, "server")
+    work_dir = os.path.join(scratch, "work")
+    os.makedirs(server_root)
+    os.makedirs(work_dir)
+    server = start_server(server_root)
+    tester.TESTER_URL_ROOT = server.url
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    bench = Bench(tester, work_dir, server_root, args)
+    print("Benchmarking tester {} ({}) with Python {}".format(tester.VERSION, args.tester, sys.version.split()[0]))
+    print("{:<44} {:>8} {:>12} {:>12} {:>12}".format("Stage", "Items", "Median", "Best", "Throughput"))
+    try:
+        for stage in STAGES:
+            if stage in args.stage:
+                getattr(bench, "bench_" + stage)()
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"tester_version": tester.VERSION, "python": sys.version, "results": bench.results}, f, indent=1)
+
+    slower = [key for key, result in bench.results.items() if result.get("ratio", 0) > 1 + args.threshold]
+    if slower:
+        print("\n{} of {} measurements are more than {:.0%} slower than the baseline".format(
+            len(slower), len(bench.results), args.threshold))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 #
 # Generate input files
+#   (a<N>-tester.py record takes the same descriptors and cases, and writes the expected
+#   files too; see tester.html)
 #   cb | egrep "File:|N:" | xfield 2 | py3 gen-input.py a8 fake-news fl
 #
 # Assignment 9:
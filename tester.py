@@ -11,13 +11,12 @@ TEST = ["phylo.py"]
 #
 STOP_ON_FIRST_DIFF = False
 
-import difflib
 #
-# DIFF_TYPE controls the format of "diffs".  Try swapping the following two assignments with a
-# run that produces differences.
+# DIFF_TYPE controls the format of "diffs": "unified" or "context".  Try swapping the following
+# two assignments with a run that produces differences.
 #
-DIFF_TYPE=difflib.context_diff
-DIFF_TYPE=difflib.unified_diff
+DIFF_TYPE="context"
+DIFF_TYPE="unified"
 
 
 ####### End of commonly adjusted settings for students #######
@@ -25,27 +24,124 @@ DIFF_TYPE=difflib.unified_diff
 VERSION = "1.25"
 TAG_INDICATOR = "#!"
 
+#
+# argparse, concurrent.futures, difflib, http.client, tarfile and urllib are slow to import,
+# so they're imported by the functions that use them: a run that's all cache hits doesn't
+# need most of them, and importing this file (see run_suite()) needs none of them.
+#
+import sys
+# What Python imported before running this file, which a program's own modules can't hide (see get_shadowed_modules())
+STARTUP_MODULES = frozenset(sys.modules)
 from pathlib import Path
-import argparse
+import bisect
+import contextlib
+import functools
+import hashlib
+import heapq
+import html
+import io
+import itertools
+import json
+import locale
 import math
+import operator
 import os
 import platform
+import queue
 import re
 import shutil        
+import signal
 import subprocess
-import sys
-import urllib.request
+import tempfile
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class TesterError(Exception):
+    """A problem that stops the tester.  Its message, which says "Oops!", is for the user."""
+
+#
+# Limits on a test's run.  timeout is wall-clock seconds, cpu_limit is seconds of CPU time,
+# and memory_limit and output_limit are sizes: a number of bytes or a string like "500K",
+# "50M", or "2G".  They can be set for all of a program's tests with Program(...), for one
+# test with a tag like "timeout=120" in the tag line of its expected file, and for a whole
+# run with command-line options, which override the others.  None means no limit.  cpu_limit
+# and memory_limit only work on systems that have the resource module (not Windows).
+#
+LIMIT_NAMES = ["timeout", "cpu_limit", "memory_limit", "output_limit"]
+DEFAULT_LIMITS = {"timeout": 60, "cpu_limit": None, "memory_limit": None, "output_limit": "50M"}
+
+def parse_size(size):
+    """Return the number of bytes in size, a number or a string like "50M"; None stays None"""
+    if size is None or isinstance(size, int):
+        return size
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*$', str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError("'{}' isn't a size; try something like 500K, 50M or 2G".format(size))
+    return int(float(match.group(1)) * 1024 ** " KMG".index(match.group(2).upper() or " "))
+
+def format_size(nbytes):
+    for unit in ["bytes", "KB", "MB"]:
+        if nbytes < 1024 * 10:
+            return "{} {}".format(nbytes, unit)
+        nbytes //= 1024
+    return "{} GB".format(nbytes)
+
+class Limits:
+    """
+    The limits for a run of a test: timeout and cpu_limit in seconds, memory_limit and
+    output_limit in bytes, each None if there's no limit
+    """
+    def __init__(self, *settings):
+        """Build Limits from dicts of settings, later ones taking precedence over earlier ones"""
+        merged = {}
+        for setting in settings:
+            merged.update((name, value) for name, value in setting.items() if value is not None)
+        self.timeout = float(merged["timeout"]) if merged.get("timeout") is not None else None
+        self.cpu_limit = float(merged["cpu_limit"]) if merged.get("cpu_limit") is not None else None
+        self.memory_limit = parse_size(merged.get("memory_limit"))
+        self.output_limit = parse_size(merged.get("output_limit"))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in LIMIT_NAMES}
+
+def get_limit_settings(tags):
+    """Return a dict of the limit settings (like timeout=30) among the tags"""
+    settings = {}
+    for tag in tags:
+        if "=" in tag:
+            name, value = tag.split("=", 1)
+            try:
+                if name not in LIMIT_NAMES:
+                    raise ValueError("no such limit as '{}'".format(name))
+                Limits({name: value})
+            except ValueError as e:
+                raise TesterError("\nOops! Tester configuration error in tag '{}': {}\nTell Dr. O'Bagy about this!".format(tag, e))
+            settings[name] = value
+    return settings
 
 class Program:
     """
-    Instances of this class represent a program that is to be tested
+    Instances of this class represent a program that is to be tested.  post_process is a
+    comma-separated list of operations in POST_PROCESS_OPS.  performance is a list of
+    PerformanceCases.  Keyword arguments set limits for all of the program's tests; see
+    LIMIT_NAMES.
     """
-    def __init__(self, name, post_process=None):
+    def __init__(self, name, post_process=None, performance=None, **limits):
         self._name = name
         if post_process:
             self._post_process = post_process.split(",")
         else:
             self._post_process = []
+        self._performance = performance or []
+
+        for limit in limits:
+            if limit not in LIMIT_NAMES:
+                raise TypeError("Program() got an unexpected keyword argument '{}'".format(limit))
+        self._limits = limits
 
     def get_name(self):
         return self._name
@@ -54,6 +150,44 @@ class Program:
         """Return list of output post-processing operations, in the user-specified order"""
         return self._post_process
 
+    def get_limits(self):
+        """Return a dict of the limits set for this program's tests"""
+        return self._limits
+
+    def get_performance(self):
+        """Return the program's PerformanceCases"""
+        return self._performance
+
+class PerformanceCase:
+    """
+    A check that a program isn't much slower than it should be.  The program is run on an
+    input of each of sizes, made by generator(size, data_dir), which returns the text of the
+    input and writes any files that it names in data_dir.  budget is the CPU time the program
+    may take on any of the inputs, in units of the time the calibration program takes on
+    the same machine (see calibrate()).  If max_exponent is given, the growth exponent
+    fitted to the program's times (see fit_exponent()), like 1 for linear time or 2 for
+    quadratic, may be no larger.  name defaults to the generator's name.
+    """
+    def __init__(self, generator, sizes, budget, max_exponent=None, name=None):
+        self.generator = generator
+        self.sizes = sorted(sizes)
+        self.budget = budget
+        self.max_exponent = max_exponent
+        self.name = name or generator.__name__
+
+#
+# For example, if ngrams.py should run in about linear time:
+#
+#   def ngrams_text(size, data_dir):
+#       words = ["w{}".format(i % 500) for i in range(size)]
+#       with open(os.path.join(data_dir, "text.txt"), "w") as f:
+#           f.write(" ".join(words))
+#       return os.path.join(data_dir, "text.txt") + "\n3\n"
+#
+#   Program("ngrams.py", post_process="sort",
+#       performance=[PerformanceCase(ngrams_text, [10000, 20000, 40000, 80000], budget=20, max_exponent=1.4)])
+#
+
 def get_configs():
     return {
         'a1': [Program("word-grid.py"), Program("word-search.py")],
@@ -72,89 +206,199 @@ def get_configs():
         }
 
 class DiffFile:
-    def __init__(self, assignment):
+    def __init__(self, assignment, fname="diff.html"):
         self._assignment = assignment
-        self._file = open("diff.html", "w")
+        self._dir = os.path.dirname(fname)
+        self._file = open(fname, "w")
         self._write_file_header()
 
-    def add_message(self, program_fname, test_num, msg):
-        self._file.write("<h1>Difference on <code>{0}</code> test {1}</h1><br>".format(program_fname, int(test_num)))
+    def _href(self, fname, base_dir=None):
+        """Return a link target for fname, which is relative to the current directory, from base_dir (default: the diff file's directory)"""
+        base_dir = self._dir if base_dir is None else base_dir
+        if not base_dir:
+            return fname
+        return Path(os.path.relpath(fname, base_dir)).as_posix()
+
+    def add_message(self, program_fname, test_num, msg, title="Difference", profile=None):
+        self._file.write("<h1>{2} on <code>{0}</code> test {1}</h1><br>".format(program_fname, int(test_num), title))
         self._file.write("{}<br><br>".format(msg))
+        if profile:
+            self._write_profile(self._file, profile)
 
 
-    def add_diff(self, program_fname, test_num, expected_fname, expected_lines, actual_fname, actual_lines, stdin_fname, passed):
-        LIMIT_INPUT_FILE_TEXT = 5000
+    def add_diff(self, program_fname, test_num, expected_fname, expected_lines, actual_fname, actual_lines, stdin_fname, passed,
+            profile=None):
         PASSED_VARIANTS = ["Difference", "Success", "inline-block", "none"]
         self._file.write("""
             <h1 onclick="output_view(this)">{0} on <code>{1}</code> test {2}</h1>
             {3}
             <br>
-            <div class="test-display" style="display: {4};">
-            <h2>Input: (<code><a href='{5}'>{5}</a></code>)</h2>
+            <div class="test-display" style="display: {4};">""".format(PASSED_VARIANTS[passed], program_fname, int(test_num), ('<div class="arrow" onclick="output_view(this)"></div>' * passed), PASSED_VARIANTS[passed + 2]))
+
+        self._write_details(self._file, self._dir, expected_fname, expected_lines, actual_fname, actual_lines, stdin_fname)
+        if profile:
+            self._write_profile(self._file, profile)
+
+        self._file.write("</div><br><br>")
+
+    def add_performance(self, record):
+        self._file.write("<h1>Performance case <code>{}</code> of <code>{}</code>: {}</h1>".format(
+            html.escape(record["case"]), record["program"], record["verdict"]))
+        self._write_performance(self._file, record)
+        self._file.write("<br><br>")
+
+    def _write_performance(self, f, record):
+        """Write a performance case's record (see run_performance_case()) to f: its message and a table of its times"""
+        if record["message"]:
+            f.write("{}<br>".format(html.escape(record["message"])))
+        f.write("""<table class="profile"><tr><th>Size</th><th>Seconds</th></tr>""")
+        for size, seconds in zip(record["sizes"], record["times"]):
+            f.write("<tr><td>{}</td><td>{:.3f}</td></tr>\n".format(size, seconds))
+        f.write("</table>")
+        if record["exponent"] is not None:
+            f.write("Growth exponent: {:.2f}".format(record["exponent"]))
+            if record["max_exponent"] is not None:
+                f.write(" (at most {})".format(record["max_exponent"]))
+            f.write("<br>")
+
+    def _write_profile(self, f, profile):
+        """Write a collapsible section with a test's profile (see write_profile()) to f"""
+        f.write("""
+            <details class="profile"><summary>Profile: {:.2f} seconds, {} peak memory traced</summary>
+            <h2>Functions, by time spent in them and what they called:</h2>
+            <table class="profile"><tr><th>Function</th><th>Calls</th><th>Own time</th><th>Time</th></tr>""".format(
+            profile["time"], format_size(profile["peak_memory"])))
+        for function in profile["functions"]:
+            f.write("<tr><td><code>{}</code></td><td>{}</td><td>{:.4f}</td><td>{:.4f}</td></tr>\n".format(
+                html.escape(function["function"]), function["calls"], function["own_time"], function["time"]))
+        f.write("""</table>
+            <h2>Lines that allocated the most memory still in use at the end:</h2>
+            <table class="profile"><tr><th>Line</th><th>Size</th><th>Blocks</th></tr>""")
+        for allocation in profile["allocations"]:
+            f.write("<tr><td><code>{}</code></td><td>{}</td><td>{}</td></tr>\n".format(
+                html.escape(allocation["line"]), format_size(allocation["size"]), allocation["blocks"]))
+        f.write("</table></details>")
+
+    def _write_details(self, f, base_dir, expected_fname, expected_lines, actual_fname, actual_lines, stdin_fname):
+        """Write a test's input, previews of the test files it refers to, and a comparison of its output to f, with links from base_dir"""
+        f.write("""
+            <h2>Input: (<code><a href='{1}'>{0}</a></code>)</h2>
             <table class="diff" rules="groups">
             <colgroup></colgroup>
-            <tbody>""".format(PASSED_VARIANTS[passed], program_fname, int(test_num), ('<div class="arrow" onclick="output_view(this)"></div>' * passed), PASSED_VARIANTS[passed + 2], stdin_fname))
+            <tbody>""".format(stdin_fname, self._href(stdin_fname, base_dir)))
 
+        refs = set(get_test_file_refs(stdin_fname, self._assignment))
         test_files = []
         test_file_headers = []
         for line in open(stdin_fname):
             line = line.rstrip()
-            if re.match("test-" + self._assignment + r"/.*$", line) and Path(line).is_file():
-                test_files.append(line.strip("\n"))
-                line = "<a href={0}>{0}</a>".format(line)
+            if line in refs:
+                test_files.append(line)
+                line = "<a href={1}>{0}</a>".format(line, self._href(line, base_dir))
                 test_file_headers.append(line)
-            self._file.write("<tr><td><pre style='margin:0;'>" + line + "</pre>\n")
+            f.write("<tr><td><pre style='margin:0;'>" + line + "</pre>\n")
 
-        self._file.write(""" 
+        f.write(""" 
             </tbody>
             </table>
             """)
 
-        for i in range(len(test_files)):
-            open_file = open(test_files[i])
-            file_text = open_file.read()
-            file_len = len(file_text)
-            if (file_len > LIMIT_INPUT_FILE_TEXT):
-                #
-                # truncate at the end of a whole line, if possible
-                #
-                last_newline = file_text.rfind("\n", 0, LIMIT_INPUT_FILE_TEXT)
-                if last_newline >= 0:
-                    file_text = file_text[:last_newline+1]
-                    discarded = file_len - last_newline - 1
-                else:
-                    file_text = file_text[:LIMIT_INPUT_FILE_TEXT]
-                    discarded = file_len - LIMIT_INPUT_FILE_TEXT
+        self._write_previews(f, base_dir, test_files, test_file_headers)
 
-                file_text += "[...{} additional characters not shown...]".format(discarded)
+        f.write("""
+            <h2>Output:</h2>""")
+
+        htmldiff = self._make_table(expected_lines, actual_lines, expected_fname, actual_fname)
 
-            self._file.write(""" 
+        f.write(self._add_file_links(htmldiff, expected_fname, actual_fname, base_dir))
+
+    def _write_previews(self, f, base_dir, test_files, test_file_headers):
+        for i in range(len(test_files)):
+            f.write(""" 
             <div style="display: inline-block; position: relative; margin-top: 20px; margin-left: 5%; width: {0}%;"><div style="background-color: white; border:3px solid black; position: relative; height: 30px; width:100%; top:2px; z-index:9; text-align: center; left: 50%; transform: translate(-50%, 0); overflow: hidden;"><span style="position: relative; top: 5px; font-family: Courier; font-weight: 600;">{1}</span></div>
             <textarea spellcheck="false" autocapitalize="off" autocorrect="off" autocomplete="off" style="overflow: auto; background-color: #e0e0e0; position: relative; white-space: pre; left: 50%; transform: translate(-50%, 0); width:97%; height: 200px; box-shadow: inset 0px 2px 5px 5px #888888; z-index:8; top:-20px; outline: none; font-family: Courier; border: none; resize: none; padding-left: 1%; box-sizing: border-box; -webkit-box-sizing: border-box;" readonly>{2}</textarea></div>
-            """.format(((95 - (5 * len(test_files))) / len(test_files)), test_file_headers[i], "\n\n\n" + file_text))
-            open_file.close()
+            """.format(((95 - (5 * len(test_files))) / len(test_files)), test_file_headers[i], "\n\n\n" + get_catalog(self._assignment).get_preview(test_files[i])))
 
-        self._file.write("""
-            <h2>Output:</h2>""")
+    def _make_table(self, expected_lines, actual_lines, expected_fname, actual_fname):
+        """
+        Return an HTML side-by-side comparison of the expected and actual lines.  Small outputs
+        get difflib's HtmlDiff table, which highlights changes within lines but takes time
+        proportional to the square of the number of lines.  Larger ones get a table in the
+        same style that shows just the changed lines and a little context, up to a limit.
+        """
+        LIMIT_HTMLDIFF_LINES = 600
+        LIMIT_TABLE_ROWS = 1000
+        CONTEXT_LINES = 5
 
-        htmldiff = difflib.HtmlDiff().make_table(expected_lines, actual_lines, fromdesc=expected_fname, todesc=actual_fname)
+        if len(expected_lines) + len(actual_lines) <= LIMIT_HTMLDIFF_LINES:
+            import difflib
+            return difflib.HtmlDiff().make_table(expected_lines, actual_lines, fromdesc=expected_fname, todesc=actual_fname)
 
-        self._file.write(self._add_file_links(htmldiff, expected_fname, actual_fname))
+        def cell(line):
+            return html.escape(line.rstrip("\n").expandtabs(8), quote=False).replace(" ", "&nbsp;")
 
-        self._file.write("</div><br><br>")
+        def row(from_num, from_text, from_class, to_num, to_text, to_class):
+            columns = []
+            for num, text, css_class in [(from_num, from_text, from_class), (to_num, to_text, to_class)]:
+                if text is None:
+                    num = text = ""
+                elif css_class:
+                    text = '<span class="{}">{}</span>'.format(css_class, cell(text))
+                else:
+                    text = cell(text)
+                columns.append('<td class="diff_next"></td><td class="diff_header">{}</td><td nowrap="nowrap">{}</td>'.format(num, text))
+            return "<tr>{}</tr>".format("".join(columns))
+
+        if expected_lines == actual_lines:
+            groups = [[("equal", 0, len(expected_lines), 0, len(actual_lines))]]
+        else:
+            groups = PatienceMatcher(expected_lines, actual_lines).get_grouped_opcodes(CONTEXT_LINES)
+
+        table = ['<table class="diff" cellspacing="0" cellpadding="0" rules="groups">',
+            '<colgroup></colgroup> <colgroup></colgroup> <colgroup></colgroup>',
+            '<colgroup></colgroup> <colgroup></colgroup> <colgroup></colgroup>',
+            '<thead><tr><th class="diff_next"><br /></th><th colspan="2" class="diff_header">{}</th>'
+            '<th class="diff_next"><br /></th><th colspan="2" class="diff_header">{}</th></tr></thead>'.format(expected_fname, actual_fname)]
+        num_rows = 0
+        for group in groups:
+            if num_rows == LIMIT_TABLE_ROWS:
+                break
+            table.append("<tbody>")
+            for tag, i1, i2, j1, j2 in group:
+                for k in range(max(i2 - i1, j2 - j1)):
+                    if num_rows == LIMIT_TABLE_ROWS:
+                        break
+                    num_rows += 1
+                    i, j = i1 + k, j1 + k
+                    from_text = expected_lines[i] if i < i2 else None
+                    to_text = actual_lines[j] if j < j2 else None
+                    if tag == "equal":
+                        table.append(row(i + 1, from_text, None, j + 1, to_text, None))
+                    elif tag == "replace" and from_text is not None and to_text is not None:
+                        table.append(row(i + 1, from_text, "diff_chg", j + 1, to_text, "diff_chg"))
+                    else:
+                        table.append(row(i + 1, from_text, "diff_sub", j + 1, to_text, "diff_add"))
+            table.append("</tbody>")
+
+        if num_rows == LIMIT_TABLE_ROWS:
+            table.append('<tbody><tr><td colspan="6">[...the rest is not shown; see the files themselves...]</td></tr></tbody>')
+        table.append("</table>")
+
+        return "\n".join(table)
         
     def close(self):
         self._write_html_footer()
         self._file.close()
             
-    def _add_file_links(self, htmldiff, fname1, fname2):
-        for fname in [fname1, fname2]:
-            htmldiff = htmldiff.replace(fname, "<a href='{0}'>{0}</a>".format(fname))
+    def _add_file_links(self, htmldiff, fname1, fname2, base_dir=None):
+        # The actual file of a test that passed isn't kept, usually (see run_test())
+        for fname in [fname for fname in [fname1, fname2] if os.path.exists(fname)]:
+            htmldiff = htmldiff.replace(fname, "<a href='{1}'>{0}</a>".format(fname, self._href(fname, base_dir)))
     
         return htmldiff
     
-    def _write_file_header(self):
-        self._file.write("""
+    def _write_file_header(self, f=None):
+        (f or self._file).write("""
         <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
                   "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
         <html>
@@ -178,6 +422,20 @@ class DiffFile:
                 .disclaimer { font-size: 1.2em; border: solid 1px; padding: .5em; font-family: sans-serif }
                 .arrow {height: 0px; width: 0px; border-top: 10px solid black; border-left: 6px solid transparent; border-right: 6px solid transparent; transform: rotate(270deg); display:inline-block;}
                 .arrow:hover {cursor: pointer;}
+                table.tests {font-family: sans-serif; border-collapse: collapse}
+                table.tests td, table.tests th {border-bottom: 1px solid #c0c0c0; padding: .2em .6em; text-align: left}
+                tr.success td:first-child {background-color:#aaffaa}
+                tr.difference td:first-child, tr.timeout td:first-child, tr.limit td:first-child, tr.error td:first-child {background-color:#ffaaaa}
+                tr.slow td:first-child {background-color:#ffddaa}
+                tr.difference:hover, tr[onclick]:hover {cursor: pointer;}
+                details.profile {margin: 1em 0 0 1em; font-family: sans-serif}
+                details.profile summary {font-weight: bold; cursor: pointer}
+                table.profile {border-collapse: collapse; margin-left: 3em}
+                table.profile td, table.profile th {border-bottom: 1px solid #c0c0c0; padding: .1em .6em; text-align: right}
+                table.profile td:first-child, table.profile th:first-child {text-align: left}
+                .show {color: #808080}
+                iframe.details {width: 100%; height: 40em; border: none}
+                iframe.preview {width: 90%; height: 200px; margin-left: 3em; border: 1px solid black; background-color: #e0e0e0}
             </style>
             <script>
             var output_view = function(elem) {
@@ -196,6 +454,17 @@ class DiffFile:
                     arrow_elem.style.transform = "rotate(270deg)"
                 }
             }
+            var show_test = function(row, src) {
+                var next = row.nextElementSibling;
+                if (next && next.className == "details") {
+                    next.parentNode.removeChild(next);
+                    return;
+                }
+                var details = document.createElement("tr");
+                details.className = "details";
+                details.innerHTML = '<td colspan="4"><iframe class="details" src="' + src + '"></iframe></td>';
+                row.parentNode.insertBefore(details, next);
+            }
             </script>
         <body>
             """)
@@ -207,340 +476,3058 @@ class DiffFile:
         self._file.write("<p class=notice>NOTE: Tester execution interrupted; not all tests were completed.")
 
     def finish(self):
+        if self._file.closed:
+            return
         self._write_file_footer()
         disc = get_disclaimer()
         self._file.write("<br><br><div class=disclaimer><b>{}</b> {} <u>{}</u></div>".format(*disc))
 
         self._file.close()
     
+def make_diff_file(assignment, fname="diff.html", single=False):
+    """Return a DiffFile, if single is True, or a DiffReport"""
+    return DiffFile(assignment, fname) if single else DiffReport(assignment, fname)
+
+def get_preview_text(fname):
+    """Return the text of the test file fname for a preview: up to LIMIT_INPUT_FILE_TEXT characters of it"""
+    LIMIT_INPUT_FILE_TEXT = 5000
+    with open(fname) as open_file:
+        file_text = open_file.read()
+    file_len = len(file_text)
+    if (file_len > LIMIT_INPUT_FILE_TEXT):
+        #
+        # truncate at the end of a whole line, if possible
+        #
+        last_newline = file_text.rfind("\n", 0, LIMIT_INPUT_FILE_TEXT)
+        if last_newline >= 0:
+            file_text = file_text[:last_newline+1]
+            discarded = file_len - last_newline - 1
+        else:
+            file_text = file_text[:LIMIT_INPUT_FILE_TEXT]
+            discarded = file_len - LIMIT_INPUT_FILE_TEXT
+
+        file_text += "[...{} additional characters not shown...]".format(discarded)
+
+    return file_text
+
+class DiffReport(DiffFile):
+    """
+    A diff.html that's an index of the tests, with a row per test.  The details of each
+    failed test go in a page of their own, in a directory named like diff-tests next to
+    the index, and are loaded into the index when the test's row is clicked.  Previews of
+    the test files that inputs refer to are written once, in diff-tests/files, and shared
+    by the tests that refer to them.  While tests are running the index is rewritten at
+    most every INDEX_INTERVAL seconds and reloads itself, so a long run can be watched.
+    """
+    INDEX_INTERVAL = 1
+
+    def __init__(self, assignment, fname="diff.html"):
+        self._assignment = assignment
+        self._fname = fname
+        self._dir = os.path.dirname(fname)
+        self._parts_dir = os.path.splitext(fname)[0] + "-tests"
+        shutil.rmtree(self._parts_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self._parts_dir, "files"))
+        self._rows = []
+        self._previews = {}
+        self._counts = {}
+        self._notice = ""
+        self._finished = False
+        self._written = 0
+        self._write_index()
+
+    def _add_row(self, status, program_fname, test_num, detail, onclick=None):
+        self._counts[status] = self._counts.get(status, 0) + 1
+        self._rows.append("""<tr class="{0}"{4}><td>{1}</td><td><code>{2}</code></td><td>{3}</td><td>{5}</td></tr>""".format(
+            status.split()[0].lower(), status, program_fname, test_num,
+            ' onclick="show_test(this, \'{}\')"'.format(onclick) if onclick else "", detail))
+        self._write_index()
+
+    def add_message(self, program_fname, test_num, msg, title="Difference", profile=None):
+        if not profile:
+            self._add_row(title, program_fname, int(test_num), msg)
+            return
+
+        part_fname = self._write_part(program_fname, test_num, lambda f: self._write_profile(f, profile))
+        self._add_row(title, program_fname, int(test_num), msg + " <span class=show>(click to show)</span>", self._href(part_fname))
+
+    def add_diff(self, program_fname, test_num, expected_fname, expected_lines, actual_fname, actual_lines, stdin_fname, passed,
+            profile=None):
+        links = self._get_links(expected_fname, actual_fname if os.path.exists(actual_fname) else None)
+        if passed and not profile:
+            self._add_row("Success", program_fname, int(test_num), links)
+            return
+
+        def write(f):
+            if not passed:
+                self._write_details(f, self._parts_dir, expected_fname, expected_lines, actual_fname, actual_lines, stdin_fname)
+            if profile:
+                self._write_profile(f, profile)
+        part_fname = self._write_part(program_fname, test_num, write)
+        self._add_row("Success" if passed else "Difference", program_fname, int(test_num),
+            links + " <span class=show>(click to show)</span>", self._href(part_fname))
+
+    def add_performance(self, record):
+        status = {"PASS": "Success", "SLOW": "Slow", "FAILED": "Error"}[record["verdict"]]
+        part_fname = self._write_part(record["program"], "performance-" + record["case"], lambda f: self._write_performance(f, record))
+        detail = "{} seconds over sizes {}".format("/".join("{:.2f}".format(seconds) for seconds in record["times"]),
+            "/".join(str(size) for size in record["sizes"]))
+        self._add_row(status, record["program"], html.escape(record["case"]), detail + " <span class=show>(click to show)</span>",
+            self._href(part_fname))
+
+    def _write_part(self, program_fname, test_num, write):
+        """Write the details page of a test, with write(f) writing its body, and return its name"""
+        part_fname = os.path.join(self._parts_dir, "{}-{}.html".format(program_fname, test_num))
+        with open(part_fname, "w") as f:
+            self._write_file_header(f)
+            write(f)
+            f.write("</body></html>")
+        return part_fname
+
+    def add_record(self, record, part_fname=None):
+        """Add a row for a test's result record (see make_result_record()), with the details page part_fname, if any"""
+        status = {"PASSED": "Success", "FAILED": "Difference", "TIMEOUT": "Timeout", "LIMIT": "Limit exceeded"}[record["verdict"]]
+        detail = self._get_links(record["expected"], record["actual"])
+        if record["message"]:
+            detail += " " + record["message"]
+        if part_fname:
+            detail += " <span class=show>(click to show)</span>"
+        self._add_row(status, record["program"], int(record["test"]), detail, self._href(part_fname) if part_fname else None)
+
+    def _get_links(self, expected_fname, actual_fname):
+        """Return links to a test's expected and actual files; actual_fname is None if it wasn't kept"""
+        links = "<a href='{}'>expected</a>".format(self._href(expected_fname))
+        if actual_fname:
+            links += " <a href='{}'>actual</a>".format(self._href(actual_fname))
+        return links
+
+    def _write_previews(self, f, base_dir, test_files, test_file_headers):
+        for fname, header in zip(test_files, test_file_headers):
+            f.write("""
+            <h2>{0}</h2>
+            <iframe class="preview" loading="lazy" src="{1}"></iframe>
+            """.format(header, self._href(self._get_preview(fname), base_dir)))
+
+    def _get_preview(self, fname):
+        """Return the name of the page with a preview of the test file fname, writing it if it hasn't been yet"""
+        if fname not in self._previews:
+            preview_fname = os.path.join(self._parts_dir, "files", re.sub(r"[^-\w.]", "_", fname) + ".html")
+            with open(preview_fname, "w") as f:
+                f.write("<!DOCTYPE html><html><head><meta charset='utf-8'></head><body><pre>{}</pre></body></html>".format(
+                    html.escape(get_catalog(self._assignment).get_preview(fname))))
+            self._previews[fname] = preview_fname
+        return self._previews[fname]
+
+    def _write_index(self, force=False):
+        if not force and time.monotonic() - self._written < self.INDEX_INTERVAL:
+            return
+        self._written = time.monotonic()
+
+        temp_fname = self._fname + ".tmp"
+        with open(temp_fname, "w") as f:
+            self._write_file_header(f)
+            if not self._finished:
+                f.write('<meta http-equiv="refresh" content="{}">'.format(max(2, 2 * self.INDEX_INTERVAL)))
+                f.write("<p>Testing in progress...</p>")
+            f.write("<p>{}</p>".format(", ".join("{}: {}".format(status, count) for status, count in sorted(self._counts.items()))))
+            f.write("""<table class="tests"><tr><th>Result</th><th>Program</th><th>Test</th><th></th></tr>\n""")
+            f.write("\n".join(self._rows))
+            f.write("</table>")
+            f.write(self._notice)
+            if self._finished:
+                disc = get_disclaimer()
+                f.write("<br><br><div class=disclaimer><b>{}</b> {} <u>{}</u></div>".format(*disc))
+            f.write("</body></html>")
+        os.replace(temp_fname, self._fname)
+
+    def note_interrupted(self):
+        self._notice = "<p class=notice>NOTE: Tester execution interrupted; not all tests were completed."
+        self._write_index(force=True)
+
+    def finish(self):
+        self._finished = True
+        self._write_index(force=True)
+
 TESTER_URL_ROOT="http://www2.cs.arizona.edu/classes/cs120/spring18/ASSIGNMENTS/"
 
 def print_dot():
     print(".", end="")
     sys.stdout.flush()
 
-def ensure_test_dir_current(assignment):
+#
+# Whether the test directory is current is checked by getting version.txt from the server,
+# at most once every FRESHNESS_TTL seconds.  What was learned is kept in the test directory's
+# freshness.json, along with version.txt's ETag and Last-Modified headers, so that the next
+# check can be a conditional GET.  With --offline there's no check at all, and with
+# --background-check the check runs while the tests run on the current test directory
+# (see BackgroundCheck).  If the server can't be reached but there's a test directory, it's
+# used as is.
+#
+
+FRESHNESS_TTL = 5 * 60
+FRESHNESS_FNAME = "freshness.json"
+
+def get_assignment_url(assignment):
+    return TESTER_URL_ROOT + "assg{:02d}".format(int(assignment[1:])) + "/tester/"
+
+def ensure_test_dir_current(assignment, offline=False, ttl=FRESHNESS_TTL, background=False):
     """Build the test directory, if needed.
         Cases:
             Doesn't exist: make directory and populate it
-            Exists: do nothing
+            Exists and checked in the last ttl seconds, or offline: do nothing
+            Exists: check its version with the server and rebuild it if needed
             Exists but is a file: tell the user
+        If background is True and the test directory exists, its version is checked in the
+        background and a BackgroundCheck is returned.  Otherwise None is returned.
     """
 
+    import urllib.error
+
     test_dir = Path("test-" + assignment)
-    assignment_url = TESTER_URL_ROOT + "assg{:02d}".format(int(assignment[1:])) + "/tester/"
+    assignment_url = get_assignment_url(assignment)
     #print(assignment_url)
     
     if test_dir.exists() and not test_dir.is_dir():
-        print("""Oops!  The tester needs to create a directory named '{0}' but you've got a file (or something else) named '{0}'.  Remove it or rename it and run me again.""".format(test_dir))
-        sys.exit(1)
+        raise TesterError("""Oops!  The tester needs to create a directory named '{0}' but you've got a file (or something else) named '{0}'.  Remove it or rename it and run me again.""".format(test_dir))
 
-    if test_dir.is_dir() and test_dir_current(test_dir, assignment_url):
-        #print("up to date!")
-        return
-    else:
-        build_test_directory(test_dir, assignment_url)
+    if is_test_dir_fresh(test_dir, offline, ttl):
+        #print("recently checked!")
+        return None
+
+    have_test_dir = (test_dir / "version.txt").is_file()
+    state = read_freshness(test_dir)
+
+    if offline:
+        raise TesterError("Oops! There's no '{}' directory, and I can't get the test files with --offline.".format(test_dir))
+
+    if have_test_dir and background and not state.get("stale"):
+        return BackgroundCheck(test_dir, assignment_url, state)
+
+    try:
+        current = have_test_dir and not state.get("stale") and test_dir_current(test_dir, assignment_url, state)
+    except urllib.error.URLError as e:
+        if not have_test_dir:
+            raise
+        print("Oops! Couldn't check for new test files ({}), so I'm using the ones in '{}'.".format(e, test_dir))
+        return None
+
+    if not current:
+        state = build_test_directory(test_dir, assignment_url)
+    write_freshness(test_dir, state)
+    return None
+
+def is_test_dir_fresh(test_dir, offline=False, ttl=FRESHNESS_TTL):
+    """Return True if test_dir has its files and needn't be checked: offline is True, or it was checked in the last ttl seconds"""
+    state = read_freshness(test_dir)
+    return (test_dir / "version.txt").is_file() and \
+        (offline or not state.get("stale") and 0 <= time.time() - state.get("checked", 0) < ttl)
+
+def test_dir_current(test_dir, assignment_url, state):
+    """
+    Return True if test_dir's version is the server's.  state is test_dir's freshness state,
+    which is updated with what the server says.
+    """
+    import urllib.request
 
-def test_dir_current(test_dir, assignment_url):
     try:
         my_version = (test_dir / "version.txt").open().read().strip()
     except FileNotFoundError:
         return False
 
-    expected_version = get_remote_file_contents(assignment_url + "version.txt").decode().strip()
+    request = urllib.request.Request(assignment_url + "version.txt")
+    if state.get("version") == my_version:
+        if state.get("etag"):
+            request.add_header("If-None-Match", state["etag"])
+        if state.get("last_modified"):
+            request.add_header("If-Modified-Since", state["last_modified"])
+
+    try:
+        with urllib.request.urlopen(request) as f:
+            expected_version = f.read().decode().strip()
+            headers = f.headers
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        # Not modified since we last saw it, when it matched
+        state["checked"] = time.time()
+        return True
 
     #print("my_version",my_version,"expected_version",expected_version)
 
+    state.update(checked=time.time(), version=expected_version,
+        etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
     return my_version == expected_version
 
-def get_remote_file_contents(url):
-    contents = urllib.request.urlopen(url).read()
-    return contents
+def read_freshness(test_dir):
+    try:
+        with (test_dir / FRESHNESS_FNAME).open() as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_freshness(test_dir, state):
+    try:
+        with (test_dir / FRESHNESS_FNAME).open("w") as f:
+            json.dump(state, f)
+    except OSError:
+        pass
 
-def build_test_directory(test_dir, assignment_url):
-    print("Building '{}' directory".format(test_dir), end="")
-    sys.stdout.flush()
+class BackgroundCheck:
+    """
+    A check of a test directory's version, run in a thread while tests run on the test
+    directory as it is.  finish() reports a new version, and marks the test directory
+    as stale so that the next run rebuilds it without checking again.
+    """
+    def __init__(self, test_dir, assignment_url, state):
+        self._test_dir = test_dir
+        self._state = state
+        self._current = None
+        self._thread = threading.Thread(target=self._check, args=(assignment_url,), daemon=True)
+        self._thread.start()
 
-    if test_dir.is_dir():
-        shutil.rmtree(test_dir.as_posix())
-    
-    # If test directory exists, remove it.  Then build it.
+    def _check(self, assignment_url):
+        import urllib.error
+        try:
+            self._current = test_dir_current(self._test_dir, assignment_url, self._state)
+        except (urllib.error.URLError, OSError):
+            pass
+
+    def finish(self, out=None):
+        self._thread.join(timeout=10)
+        if self._current is None:
+            return
+        if not self._current:
+            self._state["stale"] = True
+            print("\n\nNOTE: There are new test files for this assignment.  Run me again to test with them.", file=out or sys.stdout, end="")
+        write_freshness(self._test_dir, self._state)
+
+#
+# A test directory is built from the files in an assignment's tester directory on the web
+# server, in one of three ways, whichever the server supports:
+#
+#     If there's a bundle-<version>.tar.gz (see make_bundle()), it's downloaded, and its files
+#     are checked against the manifest.json in it and extracted.
+#
+#     If there's a manifest.json (see make_manifest()), it lists each file's size and SHA-256
+#     hash, so files that the local test directory already has are copied from it rather
+#     than downloaded, and downloaded files are checked.
+#
+#     Otherwise the files are found by scraping the server's directory listing and reading
+#     testfiles.txt, and all of them are downloaded.
+#
+# Files are downloaded SYNC_CONNECTIONS at a time over keep-alive connections.  They're
+# written to a new directory, test-aN.new, which then replaces test-aN, so an interrupted
+# sync leaves test-aN as it was.
+#
+
+SYNC_CONNECTIONS = 4
+
+class FixtureFetcher:
+    """
+    Gets files from a base URL.  Each thread has its own connection to the server, which
+    is kept open between requests.  URLs that aren't http or https, and redirects, are
+    handled by urllib.
+    """
+    def __init__(self, base_url):
+        import urllib.parse
+        self._base_url = base_url
+        self._url = urllib.parse.urlsplit(base_url)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        import http.client
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self._url.scheme == "https":
+                connection = http.client.HTTPSConnection(self._url.netloc, timeout=60)
+            else:
+                connection = http.client.HTTPConnection(self._url.netloc, timeout=60)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def get(self, fname, missing_ok=False, headers=None):
+        """
+        Return the contents of the file fname under the base URL, or None if missing_ok and
+        it's not found.  If headers is a dict, the response's headers are added to it, with
+        their names in lowercase.
+        """
+        import http.client
+        import urllib.error
+        import urllib.parse
+        url = self._base_url + fname
+        if self._url.scheme not in ["http", "https"]:
+            return self._get_with_urllib(url, missing_ok, headers)
 
+        path = self._url.path + urllib.parse.quote(fname)
+        for attempt in range(2):
+            connection = self._get_connection()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                contents = response.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                # The server may have closed the kept-alive connection; try once more on a new one
+                connection.close()
+                if attempt == 1:
+                    raise urllib.error.URLError(e)
+
+        if response.status == 200:
+            if headers is not None:
+                headers.update((name.lower(), value) for name, value in response.headers.items())
+            return contents
+        if response.status in [301, 302, 303, 307, 308]:
+            return self._get_with_urllib(url, missing_ok, headers)
+        if response.status == 404 and missing_ok:
+            return None
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+    def _get_with_urllib(self, url, missing_ok, headers=None):
+        import urllib.request
+        try:
+            with urllib.request.urlopen(url) as f:
+                if headers is not None:
+                    headers.update((name.lower(), value) for name, value in f.headers.items())
+                return f.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404 and missing_ok:
+                return None
+            raise
+
+    def close(self):
+        for connection in self._connections:
+            connection.close()
+
+def build_test_directory(test_dir, assignment_url):
+    """
+    Build test_dir from the files at assignment_url, and return its freshness state: the
+    version it was built from, and what the server said about version.txt, so that the next
+    check can be a conditional GET (see test_dir_current())
+    """
+    fetcher = FixtureFetcher(assignment_url)
     try:
-        test_dir.mkdir()
-    except Exception as e:
-        print("Oops!  Tried to create directory '{}' but failed with this:".format(test_dir))
-        print(e)
-        sys.exit(1)
+        headers = {}
+        version = fetcher.get("version.txt", headers=headers).decode().strip()
+        state = {"checked": time.time(), "version": version, "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified")}
+        bundle = fetcher.get(get_bundle_name(version), missing_ok=True)
+        if bundle is not None:
+            with new_test_directory(test_dir) as new_dir:
+                extract_bundle(bundle, new_dir)
+            return state
+
+        manifest = fetcher.get("manifest.json", missing_ok=True)
+        if manifest is not None:
+            manifest = json.loads(manifest.decode())
+        else:
+            listing = fetcher.get("").decode()
+            testfiles = fetcher.get("testfiles.txt").decode()
+            manifest = {"files": {fname: {} for fname in get_fixture_names(listing, testfiles)}}
+        sync_test_directory(test_dir, fetcher, manifest)
+        return state
+    finally:
+        fetcher.close()
 
-    f = urllib.request.urlopen(assignment_url)
-    s = f.read()
-    #print(s)
-    for m in re.finditer(r'>([-\w]+)-input-([0-9]+)\.txt<',str(s)):
+def get_fixture_names(listing, testfiles):
+    """
+    Return the names of the files in a test directory, given the text of a directory
+    listing (or a list of file names, one per line) and of testfiles.txt
+    """
+    names = []
+    for m in re.finditer(r'(?:^|>)([-\w]+)-input-([0-9]+)\.txt(?:<|$)', listing, re.MULTILINE):
         program = m.group(1)
         testnum = m.group(2)
-        for fname in ["{}-{}-{}.txt".format(program, name, testnum) for name in ["input","expected"]]:
-            #print(fname)
-            copy_test_file(assignment_url, test_dir, fname)
-            print_dot()
-    f.close()
+        names += ["{}-{}-{}.txt".format(program, name, testnum) for name in ["input","expected"]]
 
-    f = urllib.request.urlopen(assignment_url + "testfiles.txt")
-    for fname in f.readlines():
-        fname = fname.decode().strip()
+    for fname in testfiles.splitlines():
+        fname = fname.strip()
         if len(fname) == 0 or fname[0] == "#":
             continue
-        copy_test_file(assignment_url, test_dir, fname)
-        print_dot()
+        names.append(fname)
 
-    copy_test_file(assignment_url, test_dir, "version.txt")
-    print("Done!")
-    
-def copy_test_file(url, test_dir, fname):
-    with urllib.request.urlopen(url + fname) as testurl:
-        testfilepath = test_dir / fname
-        testfile = testfilepath.open(mode="wb")
-        testfile.write(testurl.read())
-        testfile.close()
+    names.append("version.txt")
+    return list(dict.fromkeys(names))
 
-def get_tests(program, assignment):
-    result = []
-    test_dir = "test-" + assignment
-    for input_file in Path(test_dir).glob(program + "-input-*.txt"):
-        #print(str(input_file))
-        match = re.match(test_dir + r'[/\\].*-input-([0-9]+).txt', str(input_file))
-        result.append(match.group(1))
+@contextlib.contextmanager
+def new_test_directory(test_dir):
+    """
+    A context manager for replacing test_dir: the with block fills in the new directory
+    it's given, which replaces test_dir at the end of the block, unless there's an exception.
+    """
+    if test_dir.is_dir():
+        print("Updating '{}' directory".format(test_dir), end="")
+    else:
+        print("Building '{}' directory".format(test_dir), end="")
+    sys.stdout.flush()
+
+    new_dir = test_dir.with_name(test_dir.name + ".new")
+    if new_dir.exists():
+        shutil.rmtree(new_dir.as_posix())
+    try:
+        new_dir.mkdir()
+    except Exception as e:
+        raise TesterError("Oops!  Tried to create directory '{}' but failed with this:\n{}".format(new_dir, e))
 
-    return sorted(result)
+    try:
+        yield new_dir
 
+        old_dir = test_dir.with_name(test_dir.name + ".old")
+        if old_dir.exists():
+            shutil.rmtree(old_dir.as_posix())
+        if test_dir.is_dir():
+            test_dir.rename(old_dir)
+        new_dir.rename(test_dir)
+        shutil.rmtree(old_dir.as_posix(), ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(new_dir.as_posix(), ignore_errors=True)
+        raise
 
-def run_tests(program_spec, assignment, diff_file): 
-    program_fname = program_spec.get_name()
-    program_basename = program_fname.split(".")[0]
+    print("Done!")
 
-    #print("fname, basename", program_fname, program_basename)
+def check_fixture_name(fname):
+    if Path(fname).is_absolute() or ".." in Path(fname).parts:
+        raise TesterError("\nOops! Tester configuration error: bad file name '{}' in manifest".format(fname))
 
-    if not Path(program_fname).is_file():
-        print("Oops! I can't find the file '{}'.  Did you use the right name for your solution?".format(program_fname))
-        sys.exit(1)
+def write_fixture(new_dir, fname, contents, sha256):
+    """Write a test file downloaded for new_dir, checking it against its hash (if any) from a manifest"""
+    if sha256 and hashlib.sha256(contents).hexdigest() != sha256:
+        raise TesterError("\nOops! The download of test file '{}' was corrupted.  Try running me again.".format(fname))
+    (new_dir / fname).parent.mkdir(parents=True, exist_ok=True)
+    with (new_dir / fname).open("wb") as f:
+        f.write(contents)
 
-    test_dir = "test-" + assignment
-    for test_num in get_tests(program_basename, assignment):
-        print("\n{}: Running test {}...".format(program_basename, test_num), end="")
-        stdin_fname = "{}/{}-input-{}.txt".format(test_dir, program_basename, test_num)
-        actual_fname = "{}/{}-actual-{}.txt".format(test_dir, program_basename, test_num)
-        stdin = open(stdin_fname,"r")
-        actual_file = open(actual_fname,"w")
-        rc = subprocess.call([sys.executable, program_fname], stdin=stdin, stdout=actual_file, stderr=subprocess.STDOUT)
-        stdin.close()
-        actual_file.close()
-        
-        expected_fname = "{}/{}-expected-{}.txt".format(test_dir, program_basename, test_num)
-        expected_file = open(expected_fname, "r")
-        actual_file = open(actual_fname,"r")
+def sync_test_directory(test_dir, fetcher, manifest):
+    """Make test_dir hold the files in manifest, reusing the ones it already has"""
+    import concurrent.futures
 
-        tags = []
-        expected_lines = expected_file.readlines()
+    with new_test_directory(test_dir) as new_dir:
+        to_fetch = []
+        for fname, info in manifest["files"].items():
+            check_fixture_name(fname)
+            path = test_dir / fname
+            if info.get("sha256") and path.is_file() and path.stat().st_size == info["size"] and get_file_hash(path) == info["sha256"]:
+                (new_dir / fname).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(path.as_posix(), (new_dir / fname).as_posix())
+            else:
+                to_fetch.append(fname)
 
-        #Check expected output for tag line, create tags if it exists.
-        if len(expected_lines) > 0 and expected_lines[0].startswith(TAG_INDICATOR):
-            tags = expected_lines[0].lstrip(TAG_INDICATOR + " ").rstrip().split()
-            expected_lines = expected_lines[1:]
-        
-        actual_lines = actual_file.readlines()
-        #TODO: Add trailing newline check here
-        
-        expected_file.close()
-        actual_file.close()
+        def fetch(fname):
+            write_fixture(new_dir, fname, fetcher.get(fname), manifest["files"][fname].get("sha256"))
 
-        expected_lines = post_process(expected_lines, program_spec.get_post_process())
-        actual_lines = post_process(actual_lines, program_spec.get_post_process())
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_CONNECTIONS) as pool:
+            for _ in pool.map(fetch, to_fetch):
+                print_dot()
 
-        #Post process based on tags
-        expected_lines = post_process(expected_lines, tags)
-        actual_lines = post_process(actual_lines, tags)
-            
-        diff = DIFF_TYPE(expected_lines, actual_lines, fromfile=expected_fname, tofile=actual_fname)
-        diff_str = ""
-        for line in diff:
-            diff_str += line
-            
-        if len(diff_str) == 0:
-            print("PASSED")
-            diff_file.add_diff(program_fname, test_num,
-                expected_fname, expected_lines, actual_fname, actual_lines, stdin_fname, True)
-        else:
-            print("FAILED")
+        if "version" in manifest:
+            with (new_dir / "manifest.json").open("w") as f:
+                json.dump(manifest, f, indent=1)
 
-            #
-            # Special case quick fix for 120.f17 a12: If actual_lines is only missing a final newline,
-            # state that.
-            if "".join(expected_lines) == "".join(actual_lines) + "\n":
-                msg = "NOTE: Your output is identical to the expected output EXCEPT that your output is missing a newline at the very end."
-                print(msg)
-                diff_file.add_message(program_fname, test_num, msg)
-            else:
-                show_input(stdin_fname)
-                print(diff_str)
-
-                diff_file.add_diff(program_fname, test_num,
-                    expected_fname, expected_lines, actual_fname, actual_lines, stdin_fname, False)
-                    
-                
-            if STOP_ON_FIRST_DIFF:
-                break
+def get_bundle_name(version):
+    return "bundle-{}.tar.gz".format(re.sub(r"[^-\w.]", "_", version))
 
-def post_process(lines, operations):
-    for op in operations:
-        if op == "sort":
-            lines = sorted(lines)
-        elif op == "uniq":
-            lines = uniq(lines)
-        elif op == "upper":
-            lines = list(map(str.upper, lines))
-        elif op == "lower":
-            lines = list(map(str.lower, lines))
-        elif op == "fake_news_sort":
-            lines = fake_news_sort(lines)
-        elif op == "friends_sort":
-            lines = friends_sort(lines)
-        else:
-            print("\nOops! Tester configuration error: no such operation as '{}'".format(op))
-            print("Tell Dr. O'Bagy about this!")
-            sys.exit()
+def extract_bundle(bundle, new_dir):
+    """Extract the files listed in the manifest of bundle, the contents of a bundle file, into new_dir"""
+    import tarfile
 
-    return lines
+    try:
+        with tarfile.open(fileobj=io.BytesIO(bundle), mode="r:gz") as tar:
+            manifest = json.load(tar.extractfile("manifest.json"))
+            for fname, info in manifest["files"].items():
+                check_fixture_name(fname)
+                member = tar.getmember(fname)
+                if not member.isfile():
+                    raise tarfile.TarError("'{}' isn't a file".format(fname))
+                write_fixture(new_dir, fname, tar.extractfile(member).read(), info["sha256"])
+                print_dot()
+    except (tarfile.TarError, KeyError, ValueError, EOFError, OSError) as e:
+        raise TesterError("\nOops! The download of the test files was corrupted ({}).  Try running me again.".format(e))
 
+    with (new_dir / "manifest.json").open("w") as f:
+        json.dump(manifest, f, indent=1)
 
-def fake_news_sort(lines):
-    prefix = "File: N: "
-    if lines[0].startswith(prefix):
-        line = lines[0]
-        lines.pop(0)
-        lines.insert(0,line[:len(prefix)] + "\n")
-        lines.insert(1,line[len(prefix):])
+def get_file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            h.update(block)
+    return h.hexdigest()
 
-    result = []
-    last_count = None
-    batch = []
-    for line in lines:
-        try:
-            count = int(line.split()[-1])
-        except:
-            count = "x"
+def get_manifest(tester_dir, version=None):
+    """
+    Return a manifest for tester_dir, which lists the size and hash of each file that goes in
+    a test directory: the input and expected files, the files named in testfiles.txt, and
+    version.txt.  If version is given, the manifest is for version.txt holding that version
+    (see get_version_text()) rather than what it holds now.
+    """
+    tester_dir = Path(tester_dir)
+    listing = "\n".join(sorted(path.name for path in tester_dir.iterdir()))
+    testfiles = tester_dir / "testfiles.txt"
+    testfiles = testfiles.read_text() if testfiles.is_file() else ""
 
-        #print(line, count, last_count)
-        if last_count == None or count == last_count:
-            batch.append(line)
-        else:
-            #print(batch)
-            result += sorted(batch)
-            batch = [line]
+    files = {}
+    for fname in get_fixture_names(listing, testfiles):
+        path = tester_dir / fname
+        if fname == "version.txt" and version is not None:
+            text = get_version_text(version)
+            files[fname] = {"size": len(text), "sha256": hashlib.sha256(text).hexdigest()}
+            continue
+        if not path.is_file():
+            raise TesterError("Oops! '{}' is missing.".format(path))
+        files[fname] = {"size": path.stat().st_size, "sha256": get_file_hash(path)}
 
-        last_count = count
+    if version is None:
+        version = (tester_dir / "version.txt").read_text().strip()
+    return {"version": version, "files": files}
 
-    result += sorted(batch)
+def get_version_text(version):
+    return (version + "\n").encode()
 
-    #print(result)
-        
-    return result
+def make_manifest(tester_dir, version=None):
+    """
+    Write tester_dir/manifest.json.  Run "python tester.py manifest DIR" in an assignment's
+    tester directory on the web server after changing any of its files.  version is as for
+    get_manifest().
+    """
+    manifest = get_manifest(tester_dir, version)
+    fname = Path(tester_dir) / "manifest.json"
+    temp_fname = fname.with_name(fname.name + ".tmp")
+    with temp_fname.open("w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(temp_fname.as_posix(), fname.as_posix())
+    print("Wrote '{}' with {} files, version {}".format(fname, len(manifest["files"]), manifest["version"]))
+    return manifest
 
-def friends_sort(lines):
-    if len(lines) == 0:
-        return lines
-    else:
-        return [lines[0]] + sorted(lines[1:])
+def make_bundle(tester_dir, version=None):
+    """
+    Write tester_dir/manifest.json and tester_dir/bundle-<version>.tar.gz, which holds the
+    manifest and the files it lists.  Run "python tester.py bundle DIR" in an assignment's
+    tester directory on the web server after changing any of its files.  version is as for
+    get_manifest().
+    """
+    import tarfile
 
-def uniq(L):
-    result = []
-    prev = None
-    for e in L:
-        if e != prev:
-            result.append(e)
-            prev = e
+    manifest = make_manifest(tester_dir, version)
+    fname = Path(tester_dir) / get_bundle_name(manifest["version"])
+    temp_fname = fname.with_name(fname.name + ".tmp")
+    with tarfile.open(temp_fname.as_posix(), "w:gz") as tar:
+        tar.add((Path(tester_dir) / "manifest.json").as_posix(), arcname="manifest.json")
+        for name in manifest["files"]:
+            if name == "version.txt" and version is not None:
+                info = tarfile.TarInfo(name)
+                info.size = len(get_version_text(version))
+                info.mtime = int(time.time())
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(get_version_text(version)))
+            else:
+                tar.add((Path(tester_dir) / name).as_posix(), arcname=name)
+    os.replace(temp_fname.as_posix(), fname.as_posix())
+    print("Wrote '{}'".format(fname))
 
-    return result
-            
-def print_header():
-    print("CSC 120 Tester, version {}".format(VERSION))
-    print("Python version:")
-    print(sys.version)
-    print("os.name: {}, platform: {}, bits: {}".format(os.name, platform.platform(), int(math.log(sys.maxsize,2))+1))
-    print()
+#
+# Recording expected output: "python tester.py record ASSIGNMENT REFERENCE [DESCRIPTORS]",
+# run where test-ASSIGNMENT is, runs a reference solution on each of a program's tests, in
+# parallel, and writes its output as the expected output.  With DESCRIPTORS, the inputs are
+# made first, from cases read from stdin the way gen-input.py reads them: a line per
+# descriptor, "f" for the name of a file in the test directory and "l" for a line that's used
+# as is, with lines that start with "#" skipped.  Without DESCRIPTORS, the existing inputs are
+# used.  An expected file's tag line (like "#! sort") is kept.  Nothing in the test directory
+# changes unless the reference runs to the end on every test.  Then the inputs and expected
+# files are put in place, followed by testfiles.txt, manifest.json (and a bundle, with
+# --bundle), and, last, version.txt, each in one step, so that a tester that sees the new
+# version gets the new files.
+#
+
+def get_case_inputs(lines, descriptors, assignment):
+    """Return the text of the input of each case in lines, as described above"""
+    if set(descriptors) - set("fl"):
+        raise TesterError("Oops! The descriptors are 'f', for a file in the test directory, and 'l', for a line; not '{}'.".format(descriptors))
+    lines = [line if line.endswith("\n") else line + "\n" for line in lines if not line.startswith("#")]
+    if len(lines) % len(descriptors):
+        raise TesterError("Oops! The last case has {} lines, but descriptors '{}' call for {}.".format(
+            len(lines) % len(descriptors), descriptors, len(descriptors)))
+
+    inputs = []
+    for i in range(0, len(lines), len(descriptors)):
+        inputs.append("".join(("test-" + assignment + "/" if descriptor == "f" else "") + line
+            for descriptor, line in zip(descriptors, lines[i:i + len(descriptors)])))
+    return inputs
 
-def show_input(fname):
-    print("Input: (in {})".format(fname))
+def read_tag_line(expected_fname):
+    """Return the tag line of expected_fname, as bytes, or b"" if it doesn't have one or doesn't exist"""
     try:
-        f = open(fname)
-        for line in f:
-            print("   ", line.rstrip())
-        print()
-        f.close()
-    except Exception as e:
-        print(e)
+        with open(expected_fname, "rb") as f:
+            first_line = f.readline()
+    except OSError:
+        return b""
+    return first_line if first_line.startswith(TAG_INDICATOR.encode()) else b""
 
-def get_assignment(argv):
-    aN_pattern = r'(a\d+)-.*'
+def record_main(argv):
+    import argparse
+    import concurrent.futures
 
-    if len(argv) != 0:
-        program = Path(argv[0]).name
-    else:
-        program = ""
+    parser = argparse.ArgumentParser(prog="tester record",
+        description="Run REFERENCE, a reference solution, on each of its program's tests in test-ASSIGNMENT and write its output as the expected output")
+    parser.add_argument("assignment", help="assignment name, like a5")
+    parser.add_argument("reference", help="the reference solution, like solutions/phylo.py")
+    parser.add_argument("descriptors", nargs="?",
+        help="make new inputs from the cases on stdin, a line for each letter of DESCRIPTORS: f for a file in the test directory, l for a line "
+            "(default: use the existing inputs)")
+    parser.add_argument("--cases", metavar="FILE", help="read the cases from FILE rather than stdin")
+    parser.add_argument("--name", help="the program's name, if it's not the reference's file name")
+    parser.add_argument("-j", "--jobs", type=int, default=0, metavar="N",
+        help="run up to N tests at the same time (default: one per CPU)")
+    parser.add_argument("--warm", action="store_true",
+        help="run tests in children forked from pre-started Pythons instead of starting a new Python for each")
+    add_limit_options(parser)
+    parser.add_argument("--bundle", action="store_true", help="write a bundle of the test files as well as manifest.json")
+    parser.add_argument("--version",
+        help="the new version of the test files (default: the current version plus one, if it's a number, or the date and time)")
+    args = parser.parse_args(argv)
 
-    match = re.match(aN_pattern, program)
-    if len(argv) == 0 or not match:
-        print("Note: Determining assignment based on first program in TEST list...", end="")
-        assignment = get_assignment_based_on_tests()
-        print("looks like '{}'".format(assignment))
+    test_dir = Path("test-" + args.assignment)
+    if not test_dir.is_dir():
+        raise TesterError("Oops! There's no '{}' directory here.".format(test_dir))
+    if not Path(args.reference).is_file():
+        raise TesterError("Oops! I can't find the reference solution '{}'.".format(args.reference))
+    program_name = args.name or os.path.basename(args.reference)
+    basename = program_name.split(".")[0]
+    program_spec = next((program for program in get_configs().get(args.assignment, []) if program.get_name() == program_name),
+        Program(program_name))
+
+    old_tests = get_tests(basename, args.assignment)
+    if args.descriptors:
+        with open(args.cases) if args.cases else sys.stdin as f:
+            inputs = get_case_inputs(f.readlines(), args.descriptors, args.assignment)
+        test_nums = ["{:02d}".format(i + 1) for i in range(len(inputs))]
     else:
-        assignment = match.groups(0)[0]
+        test_nums = old_tests
+        inputs = [(test_dir / "{}-input-{}.txt".format(basename, test_num)).read_text() for test_num in test_nums]
+    if not test_nums:
+        raise TesterError("Oops! There are no tests of {} to record.".format(program_name))
 
-    return assignment
+    overrides = {name: getattr(args, name) for name in LIMIT_NAMES}
+    jobs = args.jobs or os.cpu_count() or 1
+    stage_dir = Path(tempfile.mkdtemp(prefix=".record-", dir=test_dir.as_posix()))
+    runner = make_runner(args)
+    try:
+        def record(test_num, input_text):
+            stdin_fname = stage_dir / "{}-input-{}.txt".format(basename, test_num)
+            output_fname = stage_dir / "{}-output-{}.txt".format(basename, test_num)
+            stdin_fname.write_text(input_text)
+            tag_line = read_tag_line(test_dir / "{}-expected-{}.txt".format(basename, test_num))
+            limits = Limits(DEFAULT_LIMITS, program_spec.get_limits(), get_limit_settings(tag_line.decode().lstrip(TAG_INDICATOR + " ").split()), overrides)
+            rc, stopped, _ = runner.run(args.reference, stdin_fname.as_posix(), output_fname.as_posix(), limits)
+            _, limit_msg = get_limit_exceeded(rc, stopped, limits, output_fname.as_posix())
+            (stage_dir / "{}-expected-{}.txt".format(basename, test_num)).write_bytes(tag_line + output_fname.read_bytes())
+            output_fname.unlink()
+            print_dot()
+            return rc, limit_msg
 
-def get_assignment_based_on_tests():
-    for aname, programs in get_configs().items():
-        for testprog in TEST:
-            for program in programs:
-                if testprog == program.get_name():
-                    return aname
+        print("Recording {} tests of {} with '{}'".format(len(test_nums), program_name, args.reference), end="")
+        sys.stdout.flush()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            outcomes = list(pool.map(record, test_nums, inputs))
+        print()
 
-    print("\nSorry! I can't figure out which assignment you're trying to test.")
-    print("Either the tester must have a name like aN-tester.py or the variable TEST")
-    print("in the tester source code (near the top) must specify a known program name.")
-    sys.exit(1)
+        problems = ["Test {}: {}".format(test_num, limit_msg.replace("Your program", "The reference"))
+            for test_num, (rc, limit_msg) in zip(test_nums, outcomes) if limit_msg]
+        if problems:
+            raise TesterError("\n".join(problems) + "\nOops! Nothing was changed, since the reference didn't finish every test.")
+        for test_num, (rc, limit_msg) in zip(test_nums, outcomes):
+            if rc != 0:
+                print("Note: the reference exited with status {} on test {}.".format(rc, test_num))
 
-def get_disclaimer():
-    return ["NOTE:",
-            "This tester gives you an automated way to confirm that your programs are producing the expected output for the examples shown in the assignment specifications, including error cases.",
-            "Passing the test cases does not guarantee any particular grade: additional and/or different test cases will be included when grading."
-            ]
+        for test_num in test_nums:
+            for kind in ["input", "expected"]:
+                fname = "{}-{}-{}.txt".format(basename, kind, test_num)
+                os.replace((stage_dir / fname).as_posix(), (test_dir / fname).as_posix())
+        for test_num in set(old_tests) - set(test_nums):
+            for kind in ["input", "expected"]:
+                (test_dir / "{}-{}-{}.txt".format(basename, kind, test_num)).unlink(missing_ok=True)
+    finally:
+        runner.close()
+        shutil.rmtree(stage_dir.as_posix(), ignore_errors=True)
 
-f=get_assignment_based_on_tests
-        
-def main():
-    print_header()
-    assignment = get_assignment(sys.argv)
+    add_test_files(test_dir, [line for input_text in inputs for line in input_text.splitlines()
+        if re.match(re.escape(test_dir.name) + r"/", line) and Path(line).is_file()])
 
-    diff_file = DiffFile(assignment)
-    
+    old_version = read_test_dir_version(test_dir) or ""
+    version = args.version or (str(int(old_version) + 1) if old_version.isdigit() else time.strftime("%Y%m%d-%H%M%S"))
+    if args.bundle:
+        make_bundle(test_dir, version)
+    else:
+        make_manifest(test_dir, version)
+    temp_fname = test_dir / "version.txt.tmp"
+    temp_fname.write_bytes(get_version_text(version))
+    os.replace(temp_fname.as_posix(), (test_dir / "version.txt").as_posix())
+    print("Recorded {} tests of {}; the test files are now version {}".format(len(test_nums), program_name, version))
+
+def add_test_files(test_dir, refs):
+    """Add the files refs name (like test-a8/in1.txt) to test_dir's testfiles.txt, if they're not there already"""
+    fname = test_dir / "testfiles.txt"
+    text = fname.read_text() if fname.is_file() else ""
+    listed = set(line.strip() for line in text.splitlines())
+    new = [name for name in dict.fromkeys(Path(ref).relative_to(test_dir).as_posix() for ref in refs) if name not in listed]
+    if not new:
+        return
+    if text and not text.endswith("\n"):
+        text += "\n"
+    temp_fname = fname.with_name(fname.name + ".tmp")
+    temp_fname.write_text(text + "".join(name + "\n" for name in new))
+    os.replace(temp_fname.as_posix(), fname.as_posix())
+    print("Added {} to '{}'".format(", ".join(new), fname))
+
+def get_test_file_refs(stdin_fname, assignment):
+    """Return the names of the test directory files that stdin_fname refers to, like test-a8/in1.txt"""
+    return get_catalog(assignment).get_refs(stdin_fname)
+
+def get_tests(program, assignment):
+    return get_catalog(assignment).get_tests(program)
+
+#
+# The fixture catalog keeps what the tester learns about the files in a test directory, so
+# that it isn't worked out again for every test of every run: the tests of each program, the
+# lines of each input that name test directory files, and the size, SHA-256 hash and preview
+# (see get_preview_text()) of each file.  It's kept in .catalog/catalog.json in the test
+# directory.  What it says about a file is used only while the file's size and modification
+# time are unchanged, and the lists of tests are redone when the directory's modification
+# time changes.  A new version of the test files starts a new catalog.
+#
+
+CATALOG_FORMAT = 1
+
+class FixtureCatalog:
+    def __init__(self, test_dir):
+        self._dir = test_dir
+        self._fname = os.path.join(test_dir, ".catalog", "catalog.json")
+        self._lock = threading.Lock()
+        self._changed = False
+        version = read_test_dir_version(test_dir)
+        try:
+            with open(self._fname) as f:
+                self._catalog = json.load(f)
+            if self._catalog["format"] != CATALOG_FORMAT or self._catalog["version"] != version:
+                raise ValueError("out of date")
+        except (OSError, ValueError, KeyError):
+            self._catalog = {"format": CATALOG_FORMAT, "version": version, "dir_mtime": None, "tests": {}, "files": {}}
+
+    def get_tests(self, program):
+        """Return the test numbers of program, a name like "phylo", in order"""
+        with self._lock:
+            try:
+                dir_mtime = os.stat(self._dir).st_mtime_ns
+            except OSError:
+                return []
+            if dir_mtime != self._catalog["dir_mtime"]:
+                tests = {}
+                for name in os.listdir(self._dir):
+                    match = re.match(r"(.*)-input-([0-9]+)\.txt$", name)
+                    if match:
+                        tests.setdefault(match.group(1), []).append(match.group(2))
+                self._catalog["tests"] = {name: sorted(nums) for name, nums in tests.items()}
+                self._catalog["dir_mtime"] = dir_mtime
+                self._changed = True
+            return list(self._catalog["tests"].get(program, []))
+
+    def get_refs(self, stdin_fname):
+        """Return the lines of stdin_fname that name files in the test directory"""
+        with self._lock:
+            entry = self._get_entry(stdin_fname)
+            if "refs" not in entry:
+                with open(stdin_fname) as f:
+                    lines = [line.rstrip() for line in f]
+                entry["refs"] = [line for line in lines if re.match(self._dir + r"/.*$", line)]
+                self._changed = True
+            return [ref for ref in entry["refs"] if os.path.isfile(ref)]
+
+    def get_size(self, fname):
+        with self._lock:
+            return self._get_entry(fname)["size"]
+
+    def get_hash(self, fname):
+        with self._lock:
+            return self._get_entry(fname)["sha256"]
+
+    def get_preview(self, fname):
+        with self._lock:
+            entry = self._get_entry(fname)
+            if "preview" not in entry:
+                entry["preview"] = get_preview_text(fname)
+                self._changed = True
+            return entry["preview"]
+
+    def _get_entry(self, fname):
+        """Return fname's entry, a new one if fname has changed since it was made (call with the lock held)"""
+        stat = os.stat(fname)
+        entry = self._catalog["files"].get(fname)
+        if not entry or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "sha256": get_file_hash(fname)}
+            self._catalog["files"][fname] = entry
+            self._changed = True
+        return entry
+
+    def save(self):
+        """Write the catalog, if it's changed.  It's only a cache, so it's not a problem if it can't be written."""
+        with self._lock:
+            if not self._changed:
+                return
+            self._catalog["version"] = read_test_dir_version(self._dir)
+            temp_fname = "{}.{}.{}.tmp".format(self._fname, os.getpid(), threading.get_ident())
+            try:
+                os.makedirs(os.path.dirname(self._fname), exist_ok=True)
+                with open(temp_fname, "w") as f:
+                    json.dump(self._catalog, f)
+                os.replace(temp_fname, self._fname)
+                self._changed = False
+            except OSError:
+                pass
+
+fixture_catalogs = {}
+fixture_catalogs_lock = threading.Lock()
+
+def get_catalog(assignment):
+    """Return the FixtureCatalog of test-ASSIGNMENT"""
+    with fixture_catalogs_lock:
+        if assignment not in fixture_catalogs:
+            fixture_catalogs[assignment] = FixtureCatalog("test-" + assignment)
+        return fixture_catalogs[assignment]
+
+def save_catalogs():
+    for catalog in list(fixture_catalogs.values()):
+        catalog.save()
+
+
+#
+# Runners start a program with a test's input file as stdin and its actual output file as
+# stdout and stderr, enforce the test's Limits, and return (exit status, stopped, usage).
+# stopped is "timeout" or "output" if the runner killed the program for running too long
+# or writing too much, and None otherwise.  usage is the program's resource usage (see
+# ChildProcess.get_usage()), or None where it's not available.  SubprocessRunner starts a
+# new Python for every test.  WarmRunner (--warm) has a pre-started "warm server" per
+# worker fork a child for every test, saving the interpreter's start-up time.  Given a
+# profile_fname, either runs the program under the profiler, which writes the program's
+# profile there when it's done (see write_profile()).
+#
+
+class ChildProcess:
+    """
+    A running child process, waited for with os.wait4() so that its resource usage is known.
+    popen is the child's subprocess.Popen, if it was started that way; where there's no
+    os.wait4() (Windows), popen does the waiting and there's no resource usage.
+    """
+    def __init__(self, pid, popen=None):
+        self.pid = pid
+        self._popen = popen
+        self.returncode = None
+        self.rusage = None
+
+    def poll(self, flags=None):
+        if self.returncode is None:
+            if not hasattr(os, "wait4"):
+                self.returncode = self._popen.poll() if flags is None else self._popen.wait()
+                return self.returncode
+            pid, status, rusage = os.wait4(self.pid, os.WNOHANG if flags is None else flags)
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+                self.rusage = rusage
+                if self._popen:
+                    self._popen.returncode = self.returncode
+        return self.returncode
+
+    def wait(self):
+        return self.poll(0)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, getattr(signal, "SIGKILL", signal.SIGTERM))
+        except OSError:
+            pass
+
+    def get_usage(self):
+        """Return a dict of user and system CPU seconds and peak memory use in bytes, or None if they're not known"""
+        if self.rusage is None:
+            return None
+        max_rss = self.rusage.ru_maxrss
+        if sys.platform != "darwin":
+            max_rss *= 1024
+        return {"user_time": self.rusage.ru_utime, "sys_time": self.rusage.ru_stime, "max_rss": max_rss}
+
+def get_rlimits(limits):
+    """Return the resource limits for limits' CPU, memory, and output limits, as (name of an RLIMIT_ constant, soft, hard)"""
+    rlimits = []
+    if limits.cpu_limit is not None:
+        seconds = int(math.ceil(limits.cpu_limit))
+        rlimits.append(("RLIMIT_CPU", seconds, seconds + 1))
+    if limits.memory_limit is not None:
+        rlimits.append(("RLIMIT_AS", limits.memory_limit, limits.memory_limit))
+    if limits.output_limit is not None:
+        rlimits.append(("RLIMIT_FSIZE", limits.output_limit, limits.output_limit))
+    return rlimits
+
+def set_child_limits(limits):
+    """In a child process that's about to run a program (see warm_child()), set the CPU, memory, and file size limits"""
+    if resource is None:
+        return
+    for name, soft, hard in get_rlimits(limits):
+        resource.setrlimit(getattr(resource, name), (soft, hard))
+
+#
+# SubprocessRunner sets a program's limits on its process with prlimit() as soon as it's
+# started, rather than with a preexec_fn, which isn't safe to use when the tester has threads
+# (as with -j).  That's best effort: the new process runs without limits from its exec until
+# the thread that started it calls prlimit(), which with -j can wait for the GIL for a
+# scheduler slice or more, and a program that starts allocating or writing right away can
+# get that far unlimited.  It can't get much further, as the output limit is also checked as
+# the program runs (see wait_with_limits()), and setting the limits in the new process itself
+# would mean starting a second Python for every test.  Where there's no prlimit() (it's Linux
+# only), LIMIT_LAUNCHER, run by a new Python, sets the limits
+# given as its first argument, like "RLIMIT_CPU:60:61,RLIMIT_FSIZE:1000:1000", and then execs
+# the rest of its arguments, the program's command.
+#
+LIMIT_LAUNCHER = """
+import os, resource, sys
+for rlimit in sys.argv[1].split(","):
+    name, soft, hard = rlimit.split(":")
+    resource.setrlimit(getattr(resource, name), (int(soft), int(hard)))
+os.execv(sys.argv[2], sys.argv[2:])
+"""
+
+def get_file_size(fname):
+    """Return the size of the file fname, or 0 if it doesn't exist (yet)"""
+    try:
+        return os.path.getsize(fname)
+    except OSError:
+        return 0
+
+def wait_with_limits(proc, actual_fname, limits, start, watcher=None):
+    """
+    Wait for proc, which has Popen's poll(), kill(), and wait(), to finish, killing it if it
+    passes limits' timeout or output limit, or if watcher, an OutputWatcher, sees output that
+    differs from the expected output.  start is the time.monotonic() it started at.
+    """
+    delay = 0.001
+    while True:
+        rc = proc.poll()
+        if rc is not None:
+            return rc, None
+
+        stopped = None
+        if limits.timeout is not None and time.monotonic() - start > limits.timeout:
+            stopped = "timeout"
+        elif limits.output_limit is not None and get_file_size(actual_fname) > limits.output_limit:
+            stopped = "output"
+        elif watcher and watcher.differs():
+            stopped = "mismatch"
+        if stopped:
+            proc.kill()
+            return proc.wait(), stopped
+
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+#
+# With --fail-fast, this many lines of output after the first difference are kept
+#
+FAIL_FAST_WINDOW = 20
+
+class OutputWatcher:
+    """
+    Compares a running program's output with the expected output a line at a time, as the
+    output is written to the actual file.  watch is a dict with the name of the expected
+    file ("expected") and the test's post-processing operations ("operations"), which must
+    all be "map" operations, so that each line can be compared as soon as it's written.
+    Output that the watcher can't judge, like lines ending in \r\n, turns it off.
+    """
+    def __init__(self, watch, actual_fname):
+        with open(watch["expected"]) as f:
+            lines = f.readlines()
+        if lines and lines[0].startswith(TAG_INDICATOR):
+            lines = lines[1:]
+        self._expected = post_process(lines, watch["operations"])
+        self._pipeline = make_pipeline(watch["operations"])
+        self._actual_fname = actual_fname
+        self._encoding = locale.getpreferredencoding(False)
+        self._pos = 0
+        self._line_num = 0
+        self._active = True
+
+    def differs(self):
+        """Return True if a line written so far differs from the expected output, or there are too many lines"""
+        if not self._active:
+            return False
+        try:
+            with open(self._actual_fname, "rb") as f:
+                f.seek(self._pos)
+                data = f.read()
+        except OSError:
+            return False
+
+        # Only whole lines are compared; the rest is read again next time
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return False
+        self._pos += end
+        try:
+            text = data[:end].decode(self._encoding)
+        except UnicodeDecodeError:
+            self._active = False
+            return False
+        if "\r" in text:
+            self._active = False
+            return False
+
+        for line in self._pipeline(line + "\n" for line in text[:-1].split("\n")):
+            if self._line_num >= len(self._expected) or line != self._expected[self._line_num]:
+                return True
+            self._line_num += 1
+        return False
+
+def get_watch(case):
+    """
+    Return what an OutputWatcher needs to compare case's output as it's written, or None if
+    its post-processing operations don't allow that (like sort, which needs all the output)
+    """
+    tags = [tag for tag in read_tags(case.expected_fname) if "=" not in tag]
+    operations = case.program_spec.get_post_process() + tags
+    if any(POST_PROCESS_OPS.get(op, ("stream", None))[0] != "map" for op in operations):
+        return None
+    return {"expected": case.expected_fname, "operations": operations}
+
+def get_run_command(program_path, profile_fname=None):
+    """Return the command that runs a program in a new Python, under the profiler if profile_fname is given"""
+    if profile_fname:
+        return [sys.executable, os.path.abspath(__file__), "profile-child", profile_fname, program_path]
+    return [sys.executable, program_path]
+
+class SubprocessRunner:
+    def run(self, program_path, stdin_fname, actual_fname, limits, watch=None, profile_fname=None):
+        rlimits = get_rlimits(limits) if resource else []
+        use_prlimit = hasattr(resource, "prlimit")
+
+        stdin = open(stdin_fname,"r")
+        actual_file = open(actual_fname,"w")
+        start = time.monotonic()
+        command = get_run_command(program_path, profile_fname)
+        if rlimits and not use_prlimit:
+            command = [sys.executable, "-I", "-S", "-c", LIMIT_LAUNCHER,
+                ",".join("{}:{}:{}".format(*rlimit) for rlimit in rlimits)] + command
+        proc = subprocess.Popen(command, stdin=stdin, stdout=actual_file, stderr=subprocess.STDOUT)
+        stdin.close()
+        actual_file.close()
+        child = ChildProcess(proc.pid, proc)
+        try:
+            if use_prlimit:
+                try:
+                    for name, soft, hard in rlimits:
+                        resource.prlimit(proc.pid, getattr(resource, name), (soft, hard))
+                except ProcessLookupError:
+                    pass     # It's finished already
+            watcher = OutputWatcher(watch, actual_fname) if watch else None
+            rc, stopped = wait_with_limits(child, actual_fname, limits, start, watcher)
+            return rc, stopped, child.get_usage()
+        except BaseException:
+            child.kill()
+            child.wait()
+            raise
+
+    def close(self):
+        pass
+
+#
+# Modules that warm servers import before forking children.  Student programs that import
+# them get them for free.
+#
+WARM_PRELOAD = ["atexit", "collections", "copy", "functools", "io", "itertools", "json",
+    "importlib.machinery", "math", "random", "re", "string", "threading", "traceback", "types"]
+
+class WarmRunner:
+    """
+    Runs programs by way of warm servers, one per worker thread that's using it.  A
+    server is a "python tester.py warm-server" process; see warm_server() for the protocol.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = []
+        self._servers = []
+
+    def run(self, program_path, stdin_fname, actual_fname, limits, watch=None, profile_fname=None):
+        with self._lock:
+            if self._idle:
+                server = self._idle.pop()
+            else:
+                server = _WarmServer()
+                self._servers.append(server)
+        try:
+            return server.run(program_path, stdin_fname, actual_fname, limits, watch, profile_fname)
+        finally:
+            with self._lock:
+                self._idle.append(server)
+
+    def start(self, count):
+        """Start count more servers now, rather than when they're first needed"""
+        servers = [_WarmServer() for _ in range(count)]
+        for server in servers:
+            server.start()
+        with self._lock:
+            self._idle += servers
+            self._servers += servers
+
+    def close(self):
+        for server in self._servers:
+            server.close()
+
+class _WarmServer:
+    def __init__(self):
+        self._proc = None
+
+    def start(self):
+        self._proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "warm-server"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _request(self, request):
+        self._proc.stdin.write((json.dumps(request) + "\n").encode())
+        self._proc.stdin.flush()
+
+    def _reply(self):
+        line = self._proc.stdout.readline()
+        if not line:
+            raise RuntimeError("Oops! A warm server died unexpectedly (exit status {}).".format(self._proc.wait()))
+        return json.loads(line)
+
+    def run(self, program_path, stdin_fname, actual_fname, limits, watch=None, profile_fname=None):
+        if self._proc is None or self._proc.poll() is not None:
+            self.start()
+        self._request({"program": program_path, "stdin": stdin_fname, "stdout": actual_fname, "cwd": os.getcwd(),
+            "limits": limits.to_dict(), "watch": watch, "profile": profile_fname})
+        pid = self._reply()["pid"]
+        try:
+            reply = self._reply()
+        except BaseException:
+            #
+            # Interrupted: kill the child; the server will still send its reply
+            #
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            raise
+        return reply["rc"], reply["stopped"], reply["usage"]
+
+    def close(self):
+        if self._proc and self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+
+def make_runner(args):
+    if args.warm:
+        if hasattr(os, "fork"):
+            return WarmRunner()
+        print("Note: --warm isn't supported on this system; starting a new Python for each test.")
+    return SubprocessRunner()
+
+def warm_server():
+    """
+    Serve run requests from a _WarmServer.  Each request is a line of JSON naming the program,
+    its input and output files, the directory to run it in, its limits, what to watch
+    its output for (see OutputWatcher), if anything, and the file to write its profile
+    to, if it's to be profiled.  For each request
+    the server forks a child to run the program (see warm_child()) and replies with two lines
+    of JSON: {"pid": <child's pid>} right away, and {"rc": <exit status>, "stopped": <reason>,
+    "usage": <usage>} when the child finishes, like a runner's run() returns.  The exit status
+    follows the subprocess convention: -N if the child was killed by signal N.
+    """
+    for name in WARM_PRELOAD:
+        __import__(name)
+
+    requests = sys.stdin.buffer
+    replies = sys.stdout
+    while True:
+        line = requests.readline()
+        if not line:
+            return
+        request = json.loads(line)
+
+        replies.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            warm_child(request)
+
+        start = time.monotonic()
+        print(json.dumps({"pid": pid}), file=replies, flush=True)
+        child = ChildProcess(pid)
+        actual_fname = os.path.join(request["cwd"], request["stdout"])
+        watcher = None
+        if request["watch"]:
+            watch = dict(request["watch"], expected=os.path.join(request["cwd"], request["watch"]["expected"]))
+            watcher = OutputWatcher(watch, actual_fname)
+        rc, stopped = wait_with_limits(child, actual_fname, Limits(request["limits"]), start, watcher)
+        print(json.dumps({"rc": rc, "stopped": stopped, "usage": child.get_usage()}), file=replies, flush=True)
+
+def warm_child(request):
+    """
+    Run a program in a forked warm server child the way "python program" would: stdin from
+    the input file, stdout and stderr to the output file, uncaught exceptions and sys.exit()
+    handled like the interpreter does.  Never returns.
+    """
+    import io
+    import traceback
+
+    try:
+        os.chdir(request["cwd"])
+        stdin_fd = os.open(request["stdin"], os.O_RDONLY)
+        out_fd = os.open(request["stdout"], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        os.dup2(stdin_fd, 0)
+        os.dup2(out_fd, 1)
+        os.dup2(out_fd, 2)
+        os.close(stdin_fd)
+        os.close(out_fd)
+
+        #
+        # Make new sys.std* to match what the interpreter makes at start-up for non-tty files
+        #
+        def make_stdio(fd, mode, like, line_buffering=False):
+            if like.write_through:
+                raw = io.open(fd, mode + "b", buffering=0, closefd=False)
+                return io.TextIOWrapper(raw, like.encoding, like.errors, "\n", line_buffering, write_through=True)
+            return io.TextIOWrapper(io.open(fd, mode + "b", closefd=False), like.encoding, like.errors, "\n", line_buffering)
+
+        sys.stdin = sys.__stdin__ = make_stdio(0, "r", sys.stdin)
+        sys.stdout = sys.__stdout__ = make_stdio(1, "w", sys.stdout)
+        sys.stderr = sys.__stderr__ = make_stdio(2, "w", sys.stderr, line_buffering=True)
+
+        program = os.path.abspath(request["program"])
+        sys.argv = [request["program"]]
+        sys.path[0] = os.path.dirname(program)
+        set_child_limits(Limits(request["limits"]))
+
+        #
+        # A module of the program's own that has the name of one the server has imported,
+        # like random.py, would be hidden by it, so such a program gets a new Python after all
+        #
+        if get_shadowed_modules(sys.path[0]):
+            command = get_run_command(request["program"], request.get("profile"))
+            os.execv(command[0], command)
+    except BaseException:
+        traceback.print_exc()
+        os._exit(127)
+
+    run_main(program, request.get("profile"))
+
+def get_shadowed_modules(program_dir):
+    """Return the names of the modules this process has imported that a module or package in program_dir would hide"""
+    import importlib.machinery
+
+    suffixes = tuple(importlib.machinery.all_suffixes())
+    loaded = {name.partition(".")[0] for name in sys.modules if name not in STARTUP_MODULES} - set(sys.builtin_module_names)
+    shadowed = []
+    for entry in os.listdir(program_dir):
+        name = entry.partition(".")[0]
+        if name in loaded and (entry == name or entry.endswith(suffixes)):
+            # A directory without __init__.py is a namespace package, which doesn't hide a module
+            spec = importlib.machinery.PathFinder.find_spec(name, [program_dir])
+            if spec and spec.has_location:
+                shadowed.append(name)
+    return shadowed
+
+def profile_child(profile_fname, program_path):
+    """Run a program the way "python program" would, under the profiler, for SubprocessRunner"""
+    program = os.path.abspath(program_path)
+    sys.argv = [program_path]
+    sys.path[0] = os.path.dirname(program)
+    # The program's own modules come first, as they would if it had been run directly
+    for name in get_shadowed_modules(sys.path[0]):
+        for loaded in [loaded for loaded in sys.modules if loaded == name or loaded.startswith(name + ".")]:
+            del sys.modules[loaded]
+    run_main(program, profile_fname)
+
+def run_main(program, profile_fname=None):
+    """
+    Run the program, whose path is absolute, as __main__ in this process, handle its exit
+    the way the interpreter does, and exit with its exit status.  If profile_fname is given,
+    the program is run under the profiler, and its profile is written there when it's done.
+    Never returns.
+    """
+    import atexit
+    import importlib.machinery
+    import types
+
+    profiler = start_profile() if profile_fname else None
+
+    #
+    # This is what runpy.run_path() does, except that run_path() would set sys.argv[0]
+    # to the absolute path of the program.
+    #
+    rc = 0
+    try:
+        main_module = types.ModuleType("__main__")
+        main_module.__file__ = program
+        main_module.__cached__ = None
+        main_module.__loader__ = importlib.machinery.SourceFileLoader("__main__", program)
+        sys.modules["__main__"] = main_module
+        with open(program, "rb") as f:
+            code = compile(f.read(), program, "exec", dont_inherit=True)
+        if profiler:
+            profiler.runcall(exec, code, main_module.__dict__)
+        else:
+            exec(code, main_module.__dict__)
+    except SystemExit as e:
+        sys.stdout.flush()
+        if e.code is None:
+            rc = 0
+        elif isinstance(e.code, int):
+            rc = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            rc = 1
+    except BaseException as e:
+        #
+        # Leave this function's frame out of the traceback
+        #
+        tb = e.__traceback__
+        while tb and tb.tb_frame.f_code.co_filename != program:
+            tb = tb.tb_next
+        sys.stdout.flush()
+        sys.excepthook(type(e), e.with_traceback(tb), tb)
+        rc = 1
+        if isinstance(e, KeyboardInterrupt):
+            rc = -signal.SIGINT
+
+    try:
+        if "threading" in sys.modules:
+            sys.modules["threading"]._shutdown()
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        pass
+
+    if profiler:
+        write_profile(profile_fname, profiler, program)
+
+    if rc < 0:
+        signal.signal(-rc, signal.SIG_DFL)
+        os.kill(os.getpid(), -rc)
+    os._exit(rc & 0xff)
+
+#
+# Profiling: with --profile, each program is run under cProfile, for where its time goes,
+# and tracemalloc, for where its memory goes, and a summary of each is kept with the test's
+# result, in results.json and diff.html.  Both slow the program down, several times over
+# for tracemalloc, so the times of profiled runs aren't comparable with the usual ones.
+# The profile is written by the child that runs the program, to a file next to the actual
+# output file, so the program's own output is just what it would be without profiling.
+#
+
+PROFILE_TOP = 15            # functions and lines kept in a profile
+
+#
+# Entries of the profiler's own that aren't the program's functions
+#
+PROFILE_HIDDEN = ["<built-in method builtins.exec>", "<method 'disable' of '_lsprof.Profiler' objects>"]
+
+def start_profile():
+    """Start tracing memory allocations and return a cProfile.Profile to run the program with"""
+    import cProfile
+    import pstats               # for write_profile(), so that importing it isn't traced
+    import tracemalloc
+
+    tracemalloc.start()
+    return cProfile.Profile()
+
+def write_profile(fname, profiler, program):
+    """
+    Write the profile of a program that was run with profiler (see start_profile()) to
+    fname as JSON: "time", the seconds it took; "functions", the PROFILE_TOP functions
+    it spent the most time in, including what they called, with the number of "calls",
+    "own_time" (not including what they called) and "time" (including it); "allocations",
+    the PROFILE_TOP lines that allocated the most memory that was still in use when the
+    program finished, with its "size" and number of "blocks"; and "peak_memory", the most
+    memory that was in use at any time.  Errors are ignored, since the program's output
+    file is the only place they could be reported, and it mustn't change.
+    """
+    import cProfile
+    import pstats
+    import tracemalloc
+
+    try:
+        snapshot = tracemalloc.take_snapshot()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        program_dir = os.path.dirname(program)
+        stats = pstats.Stats(profiler).stats
+        functions = [{"function": get_profile_site(program_dir, fname, line, name), "calls": calls,
+            "own_time": round_time(own_time), "time": round_time(total_time)}
+            for (fname, line, name), (_, calls, own_time, total_time, _) in stats.items()
+            if not (fname == "~" and name in PROFILE_HIDDEN)]
+        functions.sort(key=lambda function: function["time"], reverse=True)
+
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, module.__file__) for module in [tracemalloc, cProfile]] +
+            [tracemalloc.Filter(False, write_profile.__code__.co_filename)])
+        allocations = [{"line": get_profile_site(program_dir, stat.traceback[0].filename, stat.traceback[0].lineno),
+            "size": stat.size, "blocks": stat.count} for stat in snapshot.statistics("lineno")[:PROFILE_TOP]]
+
+        run = stats.get(("~", 0, PROFILE_HIDDEN[0]))
+        profile = {"time": round_time(run[3] if run else 0), "functions": functions[:PROFILE_TOP],
+            "allocations": allocations, "peak_memory": peak_memory}
+        with open(fname, "w") as f:
+            json.dump(profile, f)
+    except Exception:
+        pass
+
+def get_profile_site(program_dir, fname, line, name=None):
+    """
+    Return how a profile shows a function or line: like "phylo.py:12(main)" for a file in the
+    program's directory, "re/__init__.py:12(sub)" for one elsewhere, and as the profiler
+    names it for a built-in function
+    """
+    if fname == "~":
+        return name
+    if fname.startswith(program_dir + os.sep):
+        fname = os.path.relpath(fname, program_dir)
+    elif os.path.isabs(fname):
+        fname = "/".join(Path(fname).parts[-2:])
+    return "{}:{}({})".format(fname, line, name) if name else "{}:{}".format(fname, line)
+
+def read_profile(fname):
+    """Return the profile that write_profile() wrote to fname, or None if there isn't one"""
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+#
+# The result cache saves the outcome of running a test under a key that's a hash of
+# everything that could affect it, so that a test is only run again when something has
+# changed.  In batch mode, identical submissions share cache entries, and a test that's
+# running for one submission isn't started again for another until it finishes.  Tests that
+# time out or run out of CPU time aren't cached, as that depends on how busy the machine was.
+#
+
+class ResultCache:
+    """
+    A directory of cache entries, one file per key.  An entry is a line of JSON with the
+    test's exit status, time, and result, followed by the program's output.  Entries are
+    touched when used, and when the cache grows past its size limit the least recently
+    used ones are removed.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self._dir = Path(cache_dir)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._running = {}
+        self.hits = 0
+
+    def get_key(self, case):
+        """Return the key for a TestCase: a hash of its program, input, and expected output"""
+        h = hashlib.sha256()
+        def add(data):
+            h.update(b"%d:" % len(data))
+            h.update(data)
+
+        add("{} {}\n{}".format(VERSION, sys.executable, sys.version).encode())
+        add(",".join(case.program_spec.get_post_process()).encode())
+        for name, (kind, func) in sorted(POST_PROCESS_OPS.items()):
+            # So that changing a user-defined operation invalidates results that it was used for
+            code = getattr(func, "__code__", None)
+            add("{} {}".format(name, kind).encode() + (code.co_code if code else b""))
+        add(json.dumps(case.get_limits().to_dict(), sort_keys=True).encode())
+
+        #
+        # Hash all the .py files in the program's directory since it might import them
+        #
+        program_dir = Path(case.program_path).parent
+        for path in sorted(program_dir.glob("*.py")):
+            add(path.name.encode())
+            add(path.read_bytes())
+
+        catalog = get_catalog(case.assignment)
+        for fname in [case.stdin_fname, case.expected_fname] + catalog.get_refs(case.stdin_fname):
+            add(fname.encode())
+            add(catalog.get_hash(fname).encode())
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self._dir / key[:2] / key
+
+    def _read(self, key):
+        try:
+            with self._path(key).open("rb") as f:
+                entry = json.loads(f.readline())
+                entry["output"] = f.read()
+            os.utime(str(self._path(key)))
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def claim(self, key):
+        """
+        Return the entry for key, waiting for it if another thread is running the same test.
+        If there's no entry, return None: the caller must then run the test and call
+        release() with the new entry, or with None if it didn't finish.
+        """
+        while True:
+            with self._lock:
+                running = self._running.get(key)
+                if running is None:
+                    entry = self._read(key)
+                    if entry is None:
+                        self._running[key] = threading.Event()
+                    else:
+                        self.hits += 1
+                    return entry
+            running.wait()
+
+    def release(self, key, entry):
+        try:
+            if entry is not None:
+                path = self._path(key)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                meta = dict(entry)
+                output = meta.pop("output")
+                tmp_path = path.with_name("{}.{}.tmp".format(key, threading.get_ident()))
+                with tmp_path.open("wb") as f:
+                    f.write(json.dumps(meta).encode() + b"\n")
+                    f.write(output)
+                os.replace(str(tmp_path), str(path))
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._running.pop(key).set()
+
+    def close(self):
+        self.trim()
+
+    def trim(self):
+        """Remove least recently used entries until the cache is within its size limit"""
+        entries = []
+        for path in self._dir.glob("*/*"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+def make_cache(args):
+    if args.no_cache:
+        return None
+    return ResultCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+class DurationHistory:
+    """
+    How long tests took in earlier runs, kept as JSON in fname and keyed by assignment,
+    program and test number, so that the longest tests can be started first: with -j, a
+    long test started last holds up the end of the run.  A test's duration is a moving
+    average of its wall-clock times.  Tests with no history are estimated from the size
+    of their input and the test files it refers to, at the rate of the tests that have one.
+    """
+    def __init__(self, fname):
+        self._fname = fname
+        self._lock = threading.Lock()
+        self._input_sizes = {}
+        try:
+            with open(fname) as f:
+                self._durations = json.load(f)
+        except (OSError, ValueError):
+            self._durations = {}
+
+    def _get_key(self, case):
+        return "{}/{}/{}".format(case.assignment, case.program_fname, case.test_num)
+
+    def _get_input_size(self, case):
+        if case.stdin_fname not in self._input_sizes:
+            catalog = get_catalog(case.assignment)
+            try:
+                self._input_sizes[case.stdin_fname] = sum(map(catalog.get_size, [case.stdin_fname] + catalog.get_refs(case.stdin_fname)))
+            except OSError:
+                self._input_sizes[case.stdin_fname] = 0
+        return self._input_sizes[case.stdin_fname]
+
+    def get_order(self, cases):
+        """Return the indexes of cases, longest expected first"""
+        known = [(self._durations[self._get_key(case)], self._get_input_size(case))
+            for case in cases if self._get_key(case) in self._durations]
+        known_size = sum(size for _, size in known)
+        rate = sum(duration for duration, _ in known) / known_size if known_size else 1
+        def estimate(i):
+            key = self._get_key(cases[i])
+            if key in self._durations:
+                return self._durations[key]
+            return self._get_input_size(cases[i]) * rate
+        return sorted(range(len(cases)), key=lambda i: -estimate(i))
+
+    def record(self, case, seconds):
+        key = self._get_key(case)
+        with self._lock:
+            if key in self._durations:
+                seconds = (self._durations[key] + seconds) / 2
+            self._durations[key] = round(seconds, 4)
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self._fname) or ".", exist_ok=True)
+            temp_fname = "{}.{}.{}.tmp".format(self._fname, os.getpid(), threading.get_ident())
+            with open(temp_fname, "w") as f:
+                json.dump(self._durations, f)
+            os.replace(temp_fname, self._fname)
+        except OSError:
+            pass
+
+def make_durations(args):
+    return DurationHistory(os.path.join(args.cache_dir, "durations.json"))
+
+class Submission:
+    """
+    Instances of this class represent one set of solution programs being tested: where
+    the programs are, where their actual output goes, and where results are reported.
+    diff_type is the kind of diff it gets (see make_diff()), and on_record, if set, is
+    called with each test's record (see make_result_record()) as it's reported.  If results
+    is set to a dict, each TestResult is kept in it by get_case_key().  If profile is True, its
+    programs are run under the profiler (see write_profile()).  Unless keep_output is True,
+    only the failed tests' output is kept in actual files (see run_test()).  If performance
+    is True, its programs' performance cases are run, and their records are kept in
+    performance_records (see run_performance_case()).  A plain run of the tester has a
+    single Submission: the programs in the current directory, reporting to the console and
+    diff.html.  When the submission is done, results.json (and junit.xml, if junit is True)
+    are written in report_dir.
+    """
+    def __init__(self, name, assignment, program_dir, actual_dir, diff_file, out=None, report_dir="", junit=False):
+        self.name = name
+        self.assignment = assignment
+        self.program_dir = program_dir
+        self.actual_dir = actual_dir
+        self.diff_file = diff_file
+        self.out = out or sys.stdout
+        self.report_dir = report_dir
+        self.junit = junit
+        self.diff_type = None
+        self.on_record = None
+        self.results = None
+        self.profile = False
+        self.keep_output = False
+        self.performance = True
+        self.performance_records = []
+        self.num_passed = 0
+        self.num_failed = 0
+        self.records = []
+        self._done = False
+
+    def print(self, *args, **kwargs):
+        print(*args, file=self.out, **kwargs)
+
+    def report(self, result):
+        case = result.case
+        diff_file = self.diff_file
+        self.records.append(make_result_record(result))
+        if self.on_record:
+            self.on_record(self.records[-1])
+        if self.results is not None:
+            self.results[get_case_key(case)] = result
+        if result.passed():
+            self.num_passed += 1
+            self.print("PASSED")
+            diff_file.add_diff(case.program_fname, case.test_num,
+                case.expected_fname, result.expected_lines, case.actual_fname, result.actual_lines, case.stdin_fname, True, result.profile)
+            return
+
+        self.num_failed += 1
+        self.print(result.verdict())
+
+        if result.limit:
+            self.print(result.limit_msg)
+            show_input(case.stdin_fname, self.out)
+            title = "Timeout" if result.limit == "timeout" else "Limit exceeded"
+            diff_file.add_message(case.program_fname, case.test_num, result.limit_msg, title, result.profile)
+            return
+
+        #
+        # Special case quick fix for 120.f17 a12: If actual_lines is only missing a final newline,
+        # state that.
+        if "".join(result.expected_lines) == "".join(result.actual_lines) + "\n":
+            msg = "NOTE: Your output is identical to the expected output EXCEPT that your output is missing a newline at the very end."
+            self.print(msg)
+            diff_file.add_message(case.program_fname, case.test_num, msg, profile=result.profile)
+        else:
+            show_input(case.stdin_fname, self.out)
+            self.print(result.diff_str)
+
+            diff_file.add_diff(case.program_fname, case.test_num,
+                case.expected_fname, result.expected_lines, case.actual_fname, result.actual_lines, case.stdin_fname, False, result.profile)
+
+    def report_performance(self, record):
+        self.performance_records.append(record)
+        self.print(record["verdict"])
+        for size, seconds in zip(record["sizes"], record["times"]):
+            self.print("    size {:>10}: {:8.3f}s".format(size, seconds))
+        if record["exponent"] is not None:
+            self.print("    growth exponent: {:.2f}".format(record["exponent"]) +
+                ("" if record["max_exponent"] is None else " (at most {})".format(record["max_exponent"])))
+        if record["message"]:
+            self.print(record["message"])
+        self.diff_file.add_performance(record)
+
+    def done(self):
+        """Called after the last of this submission's tests has been reported, or when testing is interrupted"""
+        if self._done:
+            return
+        self._done = True
+        if self.records:
+            self.print("\n")
+            print_summary_table(self.records, self.out)
+        write_results_json(self, os.path.join(self.report_dir, "results.json"))
+        if self.junit:
+            write_junit_xml(self, os.path.join(self.report_dir, "junit.xml"))
+
+#
+# Machine-readable results.  Each test's result is summarized by a "record", a dict that's
+# written to results.json as is.
+#
+
+def make_result_record(result):
+    case = result.case
+    usage = result.usage or {}
+    return {"program": case.program_fname, "test": case.test_num, "verdict": result.verdict(),
+        "exit_status": result.rc, "wall_time": round_time(result.elapsed),
+        "user_time": round_time(usage.get("user_time")), "sys_time": round_time(usage.get("sys_time")),
+        "max_rss": usage.get("max_rss"),
+        "output_size": result.output_size, "limit": result.limit, "message": result.limit_msg, "cached": result.cached,
+        "input": case.stdin_fname, "expected": case.expected_fname, "actual": result.actual_fname, "profile": result.profile}
+
+def round_time(seconds):
+    return None if seconds is None else round(seconds, 4)
+
+def print_summary_table(records, out):
+    """Print a table with a line per program: tests passed and failed, total and slowest time, and peak memory use"""
+    programs = []
+    for record in records:
+        if record["program"] not in programs:
+            programs.append(record["program"])
+
+    row_format = "{:<20} {:>5} {:>6} {:>6} {:>9}  {:<16} {:>11}"
+    print(row_format.format("Program", "Tests", "Passed", "Failed", "Time", "Slowest test", "Peak memory"), file=out)
+    for program in programs:
+        program_records = [record for record in records if record["program"] == program]
+        passed = sum(1 for record in program_records if record["verdict"] == "PASSED")
+        slowest = max(program_records, key=lambda record: record["wall_time"])
+        peaks = [record["max_rss"] for record in program_records if record["max_rss"] is not None]
+        print(row_format.format(program, len(program_records), passed, len(program_records) - passed,
+            "{:.2f}s".format(sum(record["wall_time"] for record in program_records)),
+            "{} ({:.2f}s)".format(slowest["test"], slowest["wall_time"]),
+            "{:.1f} MB".format(max(peaks) / 2**20) if peaks else "?"), file=out)
+
+def write_results_json(submission, fname):
+    results = {"tester_version": VERSION, "python": sys.version, "assignment": submission.assignment,
+        "submission": submission.name, "passed": submission.num_passed, "failed": submission.num_failed,
+        "tests": submission.records, "performance": submission.performance_records}
+    with open(fname, "w") as f:
+        json.dump(results, f, indent=1)
+
+def write_junit_xml(submission, fname):
+    """Write the submission's results as JUnit XML, with a <testsuite> per program"""
+    import xml.etree.ElementTree as ElementTree
+
+    suites = ElementTree.Element("testsuites", name=submission.name or submission.assignment)
+    suite = None
+    for record in submission.records:
+        if suite is None or suite.get("name") != record["program"]:
+            suite = ElementTree.SubElement(suites, "testsuite", name=record["program"], tests="0", failures="0", time="0")
+        suite.set("tests", str(int(suite.get("tests")) + 1))
+        suite.set("time", "{:.4f}".format(float(suite.get("time")) + record["wall_time"]))
+
+        classname = "{}.{}".format(submission.assignment, record["program"].split(".")[0])
+        if submission.name:
+            classname = submission.name + "." + classname
+        testcase = ElementTree.SubElement(suite, "testcase", classname=classname,
+            name="test " + record["test"], time="{:.4f}".format(record["wall_time"]))
+        if record["verdict"] != "PASSED":
+            suite.set("failures", str(int(suite.get("failures")) + 1))
+            message = record["message"] or "Output differs from {}".format(record["expected"])
+            failure = ElementTree.SubElement(testcase, "failure", message=message, type=record["verdict"])
+            failure.text = "See {}".format(record["actual"])
+
+    ElementTree.ElementTree(suites).write(fname, encoding="utf-8", xml_declaration=True)
+
+class TestCase:
+    """
+    Instances of this class represent one test of one program: the program's
+    spec plus the names of the program, input, expected, and actual output files.
+    limit_overrides is a dict of limits that override the program's and test's own.
+    """
+    def __init__(self, program_spec, assignment, test_num, submission, limit_overrides=None):
+        test_dir = "test-" + assignment
+        basename = program_spec.get_name().split(".")[0]
+        self.program_spec = program_spec
+        self.assignment = assignment
+        self.program_fname = program_spec.get_name()
+        self.program_path = os.path.join(submission.program_dir, self.program_fname)
+        self.program_basename = basename
+        self.test_num = test_num
+        self.submission = submission
+        self.stdin_fname = "{}/{}-input-{}.txt".format(test_dir, basename, test_num)
+        self.expected_fname = "{}/{}-expected-{}.txt".format(test_dir, basename, test_num)
+        self.actual_fname = "{}/{}-actual-{}.txt".format(submission.actual_dir, basename, test_num)
+        self.profile_fname = "{}/{}-profile-{}.json".format(submission.actual_dir, basename, test_num)
+        self._limit_overrides = limit_overrides or {}
+        self._limits = None
+
+    def get_limits(self):
+        if self._limits is None:
+            tag_settings = get_limit_settings(read_tags(self.expected_fname))
+            self._limits = Limits(DEFAULT_LIMITS, self.program_spec.get_limits(), tag_settings, self._limit_overrides)
+        return self._limits
+
+def get_case_key(case):
+    return (case.program_fname, case.test_num)
+
+class TestResult:
+    """
+    The outcome of running a TestCase: the program's exit status, how long it took, its
+    resource usage (see ChildProcess.get_usage()) and output size, the post-processed
+    expected and actual lines, and the text of the diff between them (empty if the output
+    matched).  If the program ran into one of its limits, limit is "timeout", "output",
+    "cpu", or "memory" and limit_msg explains.  cached is True if the program wasn't
+    actually run because the outcome came from the ResultCache.  profile is the program's
+    profile (see write_profile()), if it was run under the profiler, or None.  actual_fname
+    is the case's actual file, or None if the output wasn't kept (see run_test()).
+    """
+    def __init__(self, case, run, output_size, expected_lines, actual_lines, diff_str, limit=None, limit_msg=None, cached=False):
+        self.case = case
+        self.actual_fname = case.actual_fname
+        self.rc = run["rc"]
+        self.elapsed = run["elapsed"]
+        self.stopped = run.get("stopped")
+        self.usage = run["usage"]
+        self.profile = run.get("profile")
+        self.output_size = output_size
+        self.cached = cached
+        self.expected_lines = expected_lines
+        self.actual_lines = actual_lines
+        self.diff_str = diff_str
+        self.limit = limit
+        self.limit_msg = limit_msg
+
+    def passed(self):
+        return len(self.diff_str) == 0 and not self.limit
+
+    def verdict(self):
+        if self.limit:
+            return "TIMEOUT" if self.limit == "timeout" else "LIMIT"
+        return "PASSED" if self.passed() else "FAILED"
+
+def get_test_cases(program_spec, assignment, submission, limit_overrides=None):
+    program_basename = program_spec.get_name().split(".")[0]
+    return [TestCase(program_spec, assignment, test_num, submission, limit_overrides)
+        for test_num in get_tests(program_basename, assignment)]
+
+def read_tags(expected_fname):
+    """Return the tags in the tag line of an expected output file, if it has one"""
+    with open(expected_fname) as f:
+        first_line = f.readline()
+    if first_line.startswith(TAG_INDICATOR):
+        return first_line.lstrip(TAG_INDICATOR + " ").rstrip().split()
+    return []
+
+def get_limit_exceeded(rc, stopped, limits, actual_fname):
+    """Return (limit, message) for the limit a run ran into (see TestResult), or (None, None) if it didn't"""
+    if stopped == "mismatch":
+        return None, None
+    if stopped == "timeout":
+        return "timeout", "Your program was stopped because it took more than {:g} seconds to run.".format(limits.timeout)
+    #
+    # With an output limit the program's writes fail at the limit: Python ignores SIGXFSZ
+    #
+    if stopped == "output" or (limits.output_limit is not None and rc != 0 and get_file_size(actual_fname) >= limits.output_limit):
+        return "output", "Your program was stopped because it wrote more than {} of output.".format(format_size(limits.output_limit))
+    if limits.cpu_limit is not None and rc in (-getattr(signal, "SIGXCPU", 0), -getattr(signal, "SIGKILL", 0)):
+        return "cpu", "Your program was stopped because it used more than {:g} seconds of CPU time.".format(limits.cpu_limit)
+    if limits.memory_limit is not None and rc != 0:
+        with open(actual_fname, "rb") as f:
+            f.seek(max(0, os.path.getsize(actual_fname) - 1000))
+            if b"MemoryError" in f.read():
+                return "memory", "Your program ran out of memory: it's limited to {}.".format(format_size(limits.memory_limit))
+    return None, None
+
+#
+# Unless --keep-output is given, a program's output goes to a spool file in OUTPUT_SPOOL_DIR,
+# which is in memory (tmpfs) where there's one, rather than to its actual output file, and
+# it's compared with the expected output from there.  The output of a test that fails is
+# then moved to the actual file, and the output of one that passes is dropped.  With the
+# actual files on a shared or network file system, that saves creating, writing and reading
+# a file there for every test that passes, and checking the output's size as the program
+# runs (see wait_with_limits()) doesn't touch it either.  Each spool file is limited by the
+# test's output limit.  A tmpfs can be small (containers often have a 64M /dev/shm), and a
+# full one would fail a test that's right, so a run only spools output there if it has room
+# for every test running at once to write as much as the largest output limit allows;
+# otherwise each test's output is spooled next to its actual file.
+#
+
+OUTPUT_SPOOL_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None        # None is tempfile's default
+
+def can_spool(cases, jobs):
+    """Return True if the output of cases, jobs of them running at a time, can be spooled in OUTPUT_SPOOL_DIR"""
+    if OUTPUT_SPOOL_DIR is None:
+        return True
+    output_limits = [case.get_limits().output_limit for case in cases if not case.submission.keep_output]
+    if not output_limits:
+        return True
+    if None in output_limits:
+        return False
+    try:
+        stat = os.statvfs(OUTPUT_SPOOL_DIR)
+    except OSError:
+        return False
+    return stat.f_bavail * stat.f_frsize >= max(output_limits) * min(jobs, len(output_limits))
+
+def run_test(case, runner, cache=None, fail_fast=False, spool=True):
+    """
+    Run the program on one test's input and compare its output with the expected output.
+    If there's a cache entry for the test, its output is used instead of running the program.
+    If fail_fast is True, the program is stopped at its first line of output that differs
+    from the expected output, where the post-processing operations allow that.  Profiled
+    runs are slower than usual, and the point is a new profile, so they don't use the cache.
+    Unless the case's submission keeps every test's output, the output is spooled (see
+    above), in OUTPUT_SPOOL_DIR if spool is True (see can_spool()) or else next to the
+    actual file, and only written to the actual file if the test fails.
+    """
+    if case.submission.keep_output:
+        return run_test_output(case, runner, cache, fail_fast, case.actual_fname)
+
+    fd, output_fname = tempfile.mkstemp(prefix="tester-output-", suffix=".txt", dir=OUTPUT_SPOOL_DIR if spool else os.path.dirname(case.actual_fname) or ".")
+    os.close(fd)
+    try:
+        result = run_test_output(case, runner, cache, fail_fast, output_fname)
+        if result.passed():
+            result.actual_fname = None
+            # The actual file of an earlier run would be misleading
+            if os.path.exists(case.actual_fname):
+                os.remove(case.actual_fname)
+        else:
+            shutil.move(output_fname, case.actual_fname)
+        return result
+    finally:
+        if os.path.exists(output_fname):
+            os.remove(output_fname)
+
+def run_test_output(case, runner, cache, fail_fast, output_fname):
+    """Do the work of run_test(), with the program's output going to output_fname"""
+    if not cache or case.submission.profile:
+        return compare_output(case, run_program(case, runner, fail_fast, output_fname), output_fname=output_fname)
+
+    key = cache.get_key(case)
+    entry = cache.claim(key)
+    if entry:
+        Path(output_fname).write_bytes(entry.pop("output"))
+        return compare_output(case, entry, cached=True, output_fname=output_fname)
+
+    result = None
+    try:
+        run = run_program(case, runner, fail_fast, output_fname)
+        result = compare_output(case, run, output_fname=output_fname)
+    finally:
+        #
+        # The output of a program stopped at a difference depends on when it was stopped, and
+        # running out of time or CPU time can be the fault of a busy machine rather than the
+        # program, so those results aren't kept
+        #
+        if result and run["stopped"] != "mismatch" and result.limit not in ("timeout", "cpu"):
+            entry = dict(run, verdict=result.verdict(), output=Path(output_fname).read_bytes())
+        cache.release(key, entry)
+
+    return result
+
+def run_program(case, runner, fail_fast=False, output_fname=None):
+    """
+    Run the program on the test's input, writing its output to output_fname (default: the
+    actual file).  Returns a
+    dict with the exit status ("rc"), wall-clock seconds ("elapsed"), and "stopped" and
+    "usage" from the runner (see the Runners comment).  If the case's submission is being
+    profiled, it also has the program's "profile", or None if the program didn't get
+    as far as writing it (see write_profile()).
+    """
+    watch = get_watch(case) if fail_fast else None
+    profile_fname = None
+    if case.submission.profile:
+        profile_fname = case.profile_fname
+        if os.path.exists(profile_fname):
+            os.remove(profile_fname)
+    start = time.monotonic()
+    rc, stopped, usage = runner.run(case.program_path, case.stdin_fname, output_fname or case.actual_fname, case.get_limits(),
+        watch, profile_fname)
+    run = {"rc": rc, "elapsed": time.monotonic() - start, "stopped": stopped, "usage": usage}
+    if profile_fname:
+        run["profile"] = read_profile(profile_fname)
+    return run
+
+#
+# Post-processed expected output is the same for every submission and every run until the
+# test files change, so ExpectedCache keeps it: in memory, for the rest of the run, and in
+# the .normalized directory of the test directory, for later runs.  A file there holds a line
+# of JSON (the test files' version, the expected file's size and modification time, the
+# operations, and the number of lines and their SHA-256 digest) followed by the lines.  It's
+# ignored, and rewritten, if any of those don't match.  Lines that don't end in a newline
+# would run together in the file, so if any but the last don't, the lines aren't written.
+#
+
+EXPECTED_CACHE_MEMORY = 64 * 2**20         # characters of expected lines kept in memory
+
+class ExpectedCache:
+    def __init__(self, max_chars=EXPECTED_CACHE_MEMORY):
+        self._max_chars = max_chars
+        self._lock = threading.Lock()
+        self._entries = {}         # In least recently used order
+        self._chars = 0
+
+    def get(self, expected_fname, program_ops):
+        """
+        Return the operations for expected_fname, program_ops followed by the operations
+        in its tag line, and its lines after post-processing with them, as a list that
+        mustn't be changed
+        """
+        stat = os.stat(expected_fname)
+        key = (expected_fname, tuple(program_ops))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] == (stat.st_size, stat.st_mtime_ns):
+                self._entries[key] = entry
+                return entry[1], entry[2]
+            if entry:
+                self._chars -= entry[3]
+
+        fname = Path(expected_fname).parent / ".normalized" / "{}.{}".format(Path(expected_fname).name, get_ops_digest(program_ops))
+        header = {"version": read_test_dir_version(Path(expected_fname).parent), "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns}
+        ops, lines = self._read(fname, header) or self._normalize(expected_fname, program_ops, fname, header)
+
+        chars = sum(map(len, lines))
+        with self._lock:
+            if chars <= self._max_chars and key not in self._entries:
+                self._entries[key] = ((stat.st_size, stat.st_mtime_ns), ops, lines, chars)
+                self._chars += chars
+                while self._chars > self._max_chars:
+                    oldest = next(iter(self._entries))
+                    self._chars -= self._entries.pop(oldest)[3]
+        return ops, lines
+
+    def _read(self, fname, header):
+        try:
+            with open(fname, "r", newline="\n") as f:
+                stored = json.loads(f.readline())
+                lines = f.readlines()
+        except (OSError, ValueError):
+            return None
+        if any(stored.get(name) != value for name, value in header.items()) or len(lines) != stored.get("lines") \
+                or hashlib.sha256("".join(lines).encode()).hexdigest() != stored.get("sha256"):
+            return None
+        return stored["ops"], lines
+
+    def _normalize(self, expected_fname, program_ops, fname, header):
+        with open(expected_fname, "r") as expected_file:
+            tags = []
+            expected = iter(expected_file)
+            first = next(expected, None)
+
+            #Check expected output for tag line, create tags if it exists.
+            #Tags like timeout=30 are limits (see TestCase.get_limits()), not post-processing operations.
+            if first is not None and first.startswith(TAG_INDICATOR):
+                tags = first.lstrip(TAG_INDICATOR + " ").rstrip().split()
+                tags = [tag for tag in tags if "=" not in tag]
+            elif first is not None:
+                expected = itertools.chain([first], expected)
+
+            #Post process based on the program's operations and then the tags
+            ops = program_ops + tags
+            lines = as_list(make_pipeline(ops)(expected))
+
+        text = "".join(lines)
+        if header["version"] is not None and text.count("\n") == len(lines) - (bool(text) and not text.endswith("\n")) \
+                and all(line.endswith("\n") for line in lines[:-1]):
+            header = dict(header, ops=ops, lines=len(lines), sha256=hashlib.sha256(text.encode()).hexdigest())
+            try:
+                fname.parent.mkdir(exist_ok=True)
+                temp_fname = fname.with_name("{}.{}.{}.tmp".format(fname.name, os.getpid(), threading.get_ident()))
+                with open(temp_fname, "w", newline="\n") as f:
+                    f.write(json.dumps(header) + "\n")
+                    f.write(text)
+                os.replace(temp_fname, fname)
+            except OSError:
+                pass
+        return ops, lines
+
+def get_ops_digest(program_ops):
+    """Return a digest of program_ops and of the code of all the operations, for naming ExpectedCache files"""
+    h = hashlib.sha256("{} {}".format(VERSION, ",".join(program_ops)).encode())
+    for name, (kind, func) in sorted(POST_PROCESS_OPS.items()):
+        code = getattr(func, "__code__", None)
+        h.update("{} {}".format(name, kind).encode() + (code.co_code if code else b""))
+    return h.hexdigest()[:16]
+
+def read_test_dir_version(test_dir):
+    try:
+        return (Path(test_dir) / "version.txt").read_text().strip()
+    except OSError:
+        return None
+
+expected_cache = ExpectedCache()
+
+def compare_output(case, run, cached=False, output_fname=None):
+    """
+    Compare the program's output, in output_fname (default: the actual file), with the
+    expected output and return a TestResult
+    """
+    output_fname = output_fname or case.actual_fname
+    ops, expected_lines = expected_cache.get(case.expected_fname, case.program_spec.get_post_process())
+    pipeline = make_pipeline(ops)
+
+    with open(output_fname, "r") as actual_file:
+        actual_lines = as_list(pipeline(actual_file))
+    #TODO: Add trailing newline check here
+
+    note = ""
+    if run["stopped"] == "mismatch":
+        #
+        # The program was stopped at its first differing line (see OutputWatcher).  Only
+        # FAIL_FAST_WINDOW lines after that are kept, in the actual file too.
+        #
+        first_diff = next((i for i, (e, a) in enumerate(zip(expected_lines, actual_lines)) if e != a),
+            min(len(expected_lines), len(actual_lines)))
+        keep = first_diff + FAIL_FAST_WINDOW
+        if len(actual_lines) > keep:
+            actual_lines = actual_lines[:keep]
+            with open(output_fname, "w") as actual_file:
+                actual_file.writelines(actual_lines)
+        expected_lines = expected_lines[:keep]
+        note = "\n(Stopped the program at the first difference, on line {}; the lines after line {} aren't compared.)\n".format(
+            first_diff + 1, keep)
+
+    if expected_lines == actual_lines:
+        diff_str = ""
+    else:
+        diff_str = make_diff(expected_lines, actual_lines, case.expected_fname, case.actual_fname, case.submission.diff_type) + note
+
+    limit, limit_msg = get_limit_exceeded(run["rc"], run["stopped"], case.get_limits(), output_fname)
+
+    return TestResult(case, run, get_file_size(output_fname), expected_lines, actual_lines, diff_str, limit, limit_msg, cached)
+
+def run_tests(cases, jobs=1, runner=None, cache=None, fail_fast=False, durations=None, stop_on_first_diff=None,
+        kept=None, should_stop=None):
+    """
+    Run the given TestCases with runner, up to jobs at a time, using cache if given, and report each result to its
+    case's Submission.  Results are reported in the order of cases no matter what
+    order the tests finish in, and each Submission's done() is called after its
+    last case.  With durations, a DurationHistory, the tests expected to take longest
+    are started first, and the history is updated with how long they took.  If
+    fail_fast or stop_on_first_diff is True, each program is stopped at its first line
+    of output that differs from the expected output.  If stop_on_first_diff is True,
+    the remaining tests of a program in a submission are skipped after its first failure.
+    stop_on_first_diff defaults to STOP_ON_FIRST_DIFF.  kept is a dict of TestResults by
+    get_case_key() for tests that needn't be run again; they're reported as they are.  If
+    should_stop() returns True before a test is reported, the rest are abandoned (without
+    calling done()) and False is returned.  Otherwise True is returned.  The performance
+    cases of the programs whose tests were run are run just before each Submission's done(),
+    if its performance attribute is True (see run_performance_case()).
+    """
+    def stop_key(case):
+        return (id(case.submission), case.program_fname)
+
+    runner = runner or SubprocessRunner()
+    if stop_on_first_diff is None:
+        stop_on_first_diff = STOP_ON_FIRST_DIFF
+    fail_fast = fail_fast or stop_on_first_diff
+    spool = can_spool(cases, jobs)
+    pool = None
+    if jobs > 1:
+        import concurrent.futures
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        if pool:
+            futures = [None] * len(cases)
+            order = durations.get_order(cases) if durations else range(len(cases))
+            for i in order:
+                if not (kept and get_case_key(cases[i]) in kept):
+                    futures[i] = pool.submit(run_test, cases[i], runner, cache, fail_fast, spool)
+        else:
+            futures = [None] * len(cases)
+
+        stopped = set()
+        performance = {}
+        for i, (case, future) in enumerate(zip(cases, futures)):
+            if should_stop and should_stop():
+                return False
+            if stop_key(case) in stopped:
+                if future:
+                    future.cancel()
+            else:
+                if kept and get_case_key(case) in kept:
+                    case.submission.print("\n{}: Test {} is unchanged...".format(case.program_basename, case.test_num), end="")
+                    result = kept[get_case_key(case)]
+                else:
+                    case.submission.print("\n{}: Running test {}...".format(case.program_basename, case.test_num), end="")
+                    case.submission.out.flush()
+                    if future:
+                        result = future.result()
+                    else:
+                        result = run_test(case, runner, cache, fail_fast, spool)
+                    if durations and not result.cached and result.stopped != "mismatch" and not case.submission.profile:
+                        durations.record(case, result.elapsed)
+                    if case.submission.performance and case.program_spec.get_performance():
+                        performance[case.program_fname] = (case.program_spec, case.program_path)
+                case.submission.report(result)
+
+                if not result.passed() and stop_on_first_diff:
+                    stopped.add(stop_key(case))
+                    for other_case, other_future in zip(cases, futures):
+                        if other_future and stop_key(other_case) == stop_key(case):
+                            other_future.cancel()
+
+            if i + 1 == len(cases) or cases[i + 1].submission is not case.submission:
+                if performance:
+                    # Other tests would slow the performance cases down
+                    if pool:
+                        concurrent.futures.wait([future for future in futures if future])
+                    run_performance_cases(case.submission, performance.values(), runner)
+                    performance = {}
+                case.submission.done()
+    finally:
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if durations:
+            durations.save()
+        save_catalogs()
+
+    return True
+
+#
+# Performance cases (see PerformanceCase).  After a submission's tests have run, and any other
+# tests running at the same time have finished, its programs' performance cases run one at a
+# time.  Each run is timed by the CPU time it takes, which other work on the machine affects
+# less than the wall-clock time, less the time it takes to start a program that does nothing.
+# Budgets are in units of the time the calibration program takes, so that they mean the same
+# on a fast machine and a slow one.
+#
+
+CALIBRATION_PROGRAM = """
+counts = {}
+for i in range(200000):
+    word = str(i * 7919 % 100003)
+    counts[word] = counts.get(word, 0) + 1
+print(len(sorted(counts)))
+"""
+CALIBRATION_RUNS = 3                # the least time of this many runs is used
+
+PERFORMANCE_MIN_TIME = 0.02         # times shorter than this (in seconds) are too noisy to fit
+
+calibrations = {}
+calibrations_lock = threading.Lock()
+
+def time_run(runner, program_path, stdin_fname, output_fname, limits):
+    """Run a program with runner and return (its CPU seconds, or wall-clock seconds if that's not known, exit status, stopped)"""
+    start = time.monotonic()
+    rc, stopped, usage = runner.run(program_path, stdin_fname, output_fname, limits)
+    seconds = usage["user_time"] + usage["sys_time"] if usage else time.monotonic() - start
+    return seconds, rc, stopped
+
+def calibrate(runner):
+    """
+    Return (startup, unit) for runner: the seconds it takes to run a program that does
+    nothing, and the further seconds that CALIBRATION_PROGRAM takes.  Each is worked out once.
+    """
+    key = type(runner).__name__
+    with calibrations_lock:
+        if key not in calibrations:
+            times = []
+            with tempfile.TemporaryDirectory(prefix="tester-calibrate-") as temp_dir:
+                program_path = os.path.join(temp_dir, "calibrate.py")
+                for text in ["", CALIBRATION_PROGRAM]:
+                    Path(program_path).write_text(text)
+                    times.append(min(time_run(runner, program_path, os.devnull, os.path.join(temp_dir, "output.txt"),
+                        Limits(DEFAULT_LIMITS))[0] for _ in range(CALIBRATION_RUNS)))
+            calibrations[key] = (times[0], max(times[1] - times[0], 0.001))
+        return calibrations[key]
+
+def fit_exponent(sizes, times):
+    """
+    Return the exponent k for which time = c * size**k best fits the sizes and times (a
+    least squares fit of their logarithms), or None if fewer than two of the times are
+    long enough to go by
+    """
+    points = [(math.log(size), math.log(seconds)) for size, seconds in zip(sizes, times) if seconds >= PERFORMANCE_MIN_TIME]
+    if len(set(x for x, _ in points)) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / sum((x - mean_x) ** 2 for x, _ in points)
+
+def run_performance_case(program_spec, program_path, performance_case, runner):
+    """
+    Run a program's PerformanceCase and return its record: the program, the case's name,
+    the verdict (PASS, SLOW, or FAILED if the program didn't finish a run normally), the
+    sizes it was run at and the seconds it took at each, the growth exponent fitted to
+    them and the most that's allowed, the budget in seconds, and a message explaining a
+    verdict other than PASS.  A run that goes over the budget ends the series.
+    """
+    startup, unit = calibrate(runner)
+    budget = performance_case.budget * unit
+    limits = Limits(DEFAULT_LIMITS, program_spec.get_limits(), {"timeout": 2 * budget + startup + 1})
+    verdict = None
+    message = None
+    times = []
+    with tempfile.TemporaryDirectory(prefix="tester-performance-") as data_dir:
+        output_fname = os.path.join(data_dir, "output.txt")
+        for size in performance_case.sizes:
+            stdin_fname = os.path.join(data_dir, "input-{}.txt".format(size))
+            Path(stdin_fname).write_text(performance_case.generator(size, data_dir))
+            seconds, rc, stopped = time_run(runner, program_path, stdin_fname, output_fname, limits)
+            limit, limit_msg = get_limit_exceeded(rc, stopped, limits, output_fname)
+            if limit not in (None, "timeout", "cpu") or (rc != 0 and not limit):
+                verdict = "FAILED"
+                message = (limit_msg or "Your program exited with status {}.".format(rc)) + " (On the input of size {}.)".format(size)
+                break
+            times.append(max(seconds - startup, 0))
+            if limit or times[-1] > budget:
+                verdict = "SLOW"
+                message = "Your program took more than {:.2f} seconds on the input of size {}; it should take at most {:.2f}.".format(
+                    times[-1], size, budget)
+                break
+
+    exponent = fit_exponent(performance_case.sizes, times)
+    max_exponent = performance_case.max_exponent
+    if verdict is None and exponent is not None and max_exponent is not None and exponent > max_exponent:
+        verdict = "SLOW"
+        message = "Your program's time grows like size**{:.2f}; it should grow no faster than size**{:g}.".format(exponent, max_exponent)
+
+    return {"program": program_spec.get_name(), "case": performance_case.name, "verdict": verdict or "PASS",
+        "sizes": performance_case.sizes[:len(times)], "times": [round_time(seconds) for seconds in times],
+        "exponent": None if exponent is None else round(exponent, 2), "max_exponent": max_exponent,
+        "budget": round_time(budget), "message": message}
+
+def run_performance_cases(submission, programs, runner):
+    """Run the PerformanceCases of programs, (Program, path) pairs, and report them to submission"""
+    for program_spec, program_path in programs:
+        for performance_case in program_spec.get_performance():
+            submission.print("\n{}: Running performance case {}...".format(program_spec.get_name().split(".")[0],
+                performance_case.name), end="")
+            submission.out.flush()
+            submission.report_performance(run_performance_case(program_spec, program_path, performance_case, runner))
+
+#
+# Diffs.  difflib's SequenceMatcher, which unified_diff() and context_diff() use, can take
+# time proportional to the square of the output's length when differences are scattered,
+# as with a long sorted output that's wrong here and there.  PatienceMatcher is a drop-in
+# replacement that's close to linear, and unified_diff() and context_diff() below produce
+# the same format as difflib's functions of the same name, using PatienceMatcher.
+#
+
+#
+# Regions with no lines unique to both sides are handed to difflib if they're no bigger
+# than this (number of lines in the region of a times number in the region of b).
+#
+DIFFLIB_REGION_LIMIT = 250000
+
+class PatienceMatcher:
+    """
+    A stand-in for a SequenceMatcher whose matching blocks come from a "patience diff":
+    common leading and trailing lines are matched first, then the lines that occur exactly
+    once on each side are matched (in order, as many as possible) and the regions between
+    them are matched the same way.  get_opcodes() and get_grouped_opcodes() are
+    SequenceMatcher's own, which only need get_matching_blocks(); borrowing them rather
+    than subclassing SequenceMatcher means difflib isn't imported until there's a diff.
+    """
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+        self.matching_blocks = self.opcodes = None
+
+    def get_opcodes(self):
+        import difflib
+        return difflib.SequenceMatcher.get_opcodes(self)
+
+    def get_grouped_opcodes(self, n=3):
+        import difflib
+        return difflib.SequenceMatcher.get_grouped_opcodes(self, n)
+
+    def get_matching_blocks(self):
+        import difflib
+        if self.matching_blocks is not None:
+            return self.matching_blocks
+
+        a, b = self.a, self.b
+        blocks = []
+        todo = [("region", 0, len(a), 0, len(b))]
+        while todo:
+            item = todo.pop()
+            if item[0] == "block":
+                blocks.append(item[1:])
+                continue
+
+            _, alo, ahi, blo, bhi = item
+            head = 0
+            while alo + head < ahi and blo + head < bhi and a[alo + head] == b[blo + head]:
+                head += 1
+            tail = 0
+            while alo + head < ahi - tail and blo + head < bhi - tail and a[ahi - tail - 1] == b[bhi - tail - 1]:
+                tail += 1
+
+            #
+            # Items are pushed in reverse order so that blocks come off in order
+            #
+            if tail:
+                todo.append(("block", ahi - tail, bhi - tail, tail))
+            todo += reversed(self._match_middle(alo + head, ahi - tail, blo + head, bhi - tail))
+            if head:
+                todo.append(("block", alo, blo, head))
+
+        merged = []
+        for i, j, n in blocks:
+            if merged and merged[-1][0] + merged[-1][2] == i and merged[-1][1] + merged[-1][2] == j:
+                merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + n)
+            else:
+                merged.append((i, j, n))
+        merged.append((len(a), len(b), 0))
+
+        self.matching_blocks = [difflib.Match(*block) for block in merged]
+        return self.matching_blocks
+
+    def _match_middle(self, alo, ahi, blo, bhi):
+        """Return work items for a[alo:ahi] and b[blo:bhi], which have no common head or tail"""
+        if alo == ahi or blo == bhi:
+            return []
+
+        a, b = self.a, self.b
+        a_index = {}
+        for i in range(alo, ahi):
+            a_index[a[i]] = None if a[i] in a_index else i
+        b_index = {}
+        for j in range(blo, bhi):
+            if a_index.get(b[j]) is not None:
+                b_index[b[j]] = None if b[j] in b_index else j
+
+        anchors = self._longest_increasing([(a_index[line], j) for line, j in b_index.items() if j is not None])
+        if not anchors:
+            if (ahi - alo) * (bhi - blo) > DIFFLIB_REGION_LIMIT:
+                return []
+            import difflib
+            matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+            return [("block", alo + i, blo + j, n) for i, j, n in matcher.get_matching_blocks() if n]
+
+        items = []
+        i, j = alo, blo
+        for anchor_i, anchor_j in anchors:
+            items.append(("region", i, anchor_i, j, anchor_j))
+            items.append(("block", anchor_i, anchor_j, 1))
+            i, j = anchor_i + 1, anchor_j + 1
+        items.append(("region", i, ahi, j, bhi))
+        return items
+
+    @staticmethod
+    def _longest_increasing(pairs):
+        """Of (i, j) pairs, return a longest list that's increasing in both i and j"""
+        pairs.sort()
+        tops = []          # tops[k] is the index in pairs of the smallest j ending an increasing run of length k+1
+        tops_j = []
+        back = [None] * len(pairs)
+        for n, (i, j) in enumerate(pairs):
+            k = bisect.bisect_left(tops_j, j)
+            if k > 0:
+                back[n] = tops[k - 1]
+            if k == len(tops):
+                tops.append(n)
+                tops_j.append(j)
+            else:
+                tops[k] = n
+                tops_j[k] = j
+
+        result = []
+        n = tops[-1] if tops else None
+        while n is not None:
+            result.append(pairs[n])
+            n = back[n]
+        result.reverse()
+        return result
+
+def _format_range_unified(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return "{}".format(beginning)
+    if not length:
+        beginning -= 1
+    return "{},{}".format(beginning, length)
+
+def _format_range_context(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if not length:
+        beginning -= 1
+    if length <= 1:
+        return "{}".format(beginning)
+    return "{},{}".format(beginning, beginning + length - 1)
+
+def unified_diff(a, b, fromfile="", tofile="", n=3):
+    """Like difflib.unified_diff(), but using PatienceMatcher"""
+    started = False
+    for group in PatienceMatcher(a, b).get_grouped_opcodes(n):
+        if not started:
+            started = True
+            yield "--- {}\n".format(fromfile)
+            yield "+++ {}\n".format(tofile)
+
+        first, last = group[0], group[-1]
+        yield "@@ -{} +{} @@\n".format(_format_range_unified(first[1], last[2]), _format_range_unified(first[3], last[4]))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                for line in a[i1:i2]:
+                    yield " " + line
+                continue
+            if tag in ("replace", "delete"):
+                for line in a[i1:i2]:
+                    yield "-" + line
+            if tag in ("replace", "insert"):
+                for line in b[j1:j2]:
+                    yield "+" + line
+
+def context_diff(a, b, fromfile="", tofile="", n=3):
+    """Like difflib.context_diff(), but using PatienceMatcher"""
+    prefix = {"insert": "+ ", "delete": "- ", "replace": "! ", "equal": "  "}
+    started = False
+    for group in PatienceMatcher(a, b).get_grouped_opcodes(n):
+        if not started:
+            started = True
+            yield "*** {}\n".format(fromfile)
+            yield "--- {}\n".format(tofile)
+
+        first, last = group[0], group[-1]
+        yield "***************\n"
+        yield "*** {} ****\n".format(_format_range_context(first[1], last[2]))
+        if any(tag in ("replace", "delete") for tag, _, _, _, _ in group):
+            for tag, i1, i2, _, _ in group:
+                if tag != "insert":
+                    for line in a[i1:i2]:
+                        yield prefix[tag] + line
+
+        yield "--- {} ----\n".format(_format_range_context(first[3], last[4]))
+        if any(tag in ("replace", "insert") for tag, _, _, _, _ in group):
+            for tag, _, _, j1, j2 in group:
+                if tag != "delete":
+                    for line in b[j1:j2]:
+                        yield prefix[tag] + line
+
+DIFF_TYPES = {"unified": unified_diff, "context": context_diff}
+
+def make_diff(expected_lines, actual_lines, fromfile, tofile, diff_type=None):
+    """
+    Return the text of a diff of expected_lines and actual_lines, which are known to differ.
+    diff_type is a name in DIFF_TYPES or a function like difflib.unified_diff; None means DIFF_TYPE.
+    """
+    diff_function = get_diff_function(diff_type or DIFF_TYPE)
+    return "".join(diff_function(expected_lines, actual_lines, fromfile=fromfile, tofile=tofile))
+
+def get_diff_function(diff_type):
+    diff_function = DIFF_TYPES.get(diff_type, diff_type)
+    if not callable(diff_function):
+        raise TesterError("Oops! DIFF_TYPE should be one of {}, not '{}'.".format(", ".join(map(repr, DIFF_TYPES)), diff_type))
+    return diff_function
+
+#
+# Post-processing operations, applied to both the expected and actual output before they're
+# compared.  A Program's post_process="op1,op2" and the tags in an expected file's tag line
+# name operations in POST_PROCESS_OPS, which are applied in order as one pipeline over the
+# lines of output.  There are two kinds of operations:
+#
+#     "map" operations are functions from one line to another, like str.upper.  A run of them
+#     is fused into a single function, so the lines are only passed over once.
+#
+#     "stream" operations are functions that take an iterable of lines and return (or yield)
+#     the lines that result, like uniq.
+#
+# More operations can be added with post_process_op(), e.g., next to get_configs():
+#
+#     @post_process_op("strip_trailing_spaces", "map")
+#     def strip_trailing_spaces(line):
+#         return line.rstrip(" \n") + "\n"
+#
+# sort sorts in memory until the lines hold more than POST_PROCESS_MEMORY characters, and
+# then sorts runs of that size, writes them to temporary files, and merges them.
+#
+
+POST_PROCESS_OPS = {}
+POST_PROCESS_MEMORY = 64 * 2**20
+
+def post_process_op(name, kind="stream"):
+    """Return a decorator that adds a function to POST_PROCESS_OPS as operation name; kind is "map" or "stream"."""
+    if kind not in ["map", "stream"]:
+        raise ValueError("post_process_op(): kind must be 'map' or 'stream', not '{}'".format(kind))
+    def register(func):
+        POST_PROCESS_OPS[name] = (kind, func)
+        return func
+    return register
+
+def make_pipeline(operations):
+    """Return a function that applies operations to an iterable of lines and returns an iterable of the result"""
+    stages = []
+    maps = []
+    for op in operations + [None]:
+        if op is not None and op not in POST_PROCESS_OPS:
+            raise TesterError("\nOops! Tester configuration error: no such operation as '{}'\nTell Dr. O'Bagy about this!".format(op))
+        kind, func = POST_PROCESS_OPS.get(op, (None, None))
+        if kind == "map":
+            maps.append(func)
+            continue
+        if len(maps) == 1:
+            stages.append(functools.partial(map, maps[0]))
+        elif maps:
+            stages.append(functools.partial(map, compose(maps)))
+        maps = []
+        if func:
+            stages.append(func)
+
+    def pipeline(lines):
+        for stage in stages:
+            lines = stage(lines)
+        return lines
+
+    return pipeline
+
+def compose(funcs):
+    def composed(line):
+        for func in funcs:
+            line = func(line)
+        return line
+    return composed
+
+def post_process(lines, operations):
+    """Return a list of the result of applying operations to lines"""
+    return as_list(make_pipeline(operations)(lines))
+
+def as_list(lines):
+    return lines if isinstance(lines, list) else list(lines)
+
+post_process_op("upper", "map")(str.upper)
+post_process_op("lower", "map")(str.lower)
+
+@post_process_op("sort")
+def external_sort(lines, memory=None):
+    """
+    Return lines in sorted order, as a list or an iterator.  Runs of lines that hold more than memory
+    (default: POST_PROCESS_MEMORY) characters are sorted and written to temporary files, which
+    are merged as the iterator is consumed.
+    """
+    memory = memory or POST_PROCESS_MEMORY
+    runs = []
+    chunk = []
+    size = 0
+    lines = iter(lines)
+    while True:
+        # Lines are taken in batches to keep the per-line work in C
+        batch = list(itertools.islice(lines, 4096))
+        if not batch:
+            break
+        chunk += batch
+        size += sum(map(len, batch))
+        if size > memory:
+            chunk.sort()
+            runs.append(write_sort_run(chunk))
+            chunk = []
+            size = 0
+
+    chunk.sort()
+    if not runs:
+        return chunk
+    return heapq.merge(*[read_sort_run(run) for run in runs], chunk)
+
+def write_sort_run(lines):
+    """
+    Write lines to a temporary file and return it.  Each line is preceded by its length, since
+    a line without a final newline can be anywhere in a sorted run.
+    """
+    run = tempfile.TemporaryFile("w+", newline="")
+    for line in lines:
+        run.write("{}\n{}".format(len(line), line))
+    run.seek(0)
+    return run
+
+def read_sort_run(run):
+    with run:
+        while True:
+            length = run.readline()
+            if not length:
+                return
+            yield run.read(int(length))
+
+@post_process_op("uniq")
+def uniq(lines):
+    return map(operator.itemgetter(0), itertools.groupby(lines))
+
+@post_process_op("fake_news_sort")
+def fake_news_sort(lines):
+    """
+    Sort each run of lines that end with the same count, keeping the runs in order.  A first
+    line like "File: N: 5" is first split into "File: N: " and "5".
+    """
+    def get_count(line):
+        try:
+            return int(line.split()[-1])
+        except:
+            return "x"
+
+    prefix = "File: N: "
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        return
+    if first.startswith(prefix):
+        head = [first[:len(prefix)] + "\n", first[len(prefix):]]
+    else:
+        head = [first]
+
+    result = []
+    for _, batch in itertools.groupby(itertools.chain(head, lines), get_count):
+        result += sorted(batch)
+    yield from result
+
+@post_process_op("friends_sort")
+def friends_sort(lines):
+    """Sort all but the first line"""
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        return []
+    rest = external_sort(lines)
+    if isinstance(rest, list):
+        rest.insert(0, first)
+        return rest
+    return itertools.chain([first], rest)
+
+def print_header():
+    print("CSC 120 Tester, version {}".format(VERSION))
+    print("Python version:")
+    print(sys.version)
+    print("os.name: {}, platform: {}, bits: {}".format(os.name, platform.platform(), int(math.log(sys.maxsize,2))+1))
+    print()
+
+def show_input(fname, out=None):
+    out = out or sys.stdout
+    print("Input: (in {})".format(fname), file=out)
+    try:
+        f = open(fname)
+        for line in f:
+            print("   ", line.rstrip(), file=out)
+        print(file=out)
+        f.close()
+    except Exception as e:
+        print(e, file=out)
+
+def get_assignment(argv):
+    aN_pattern = r'(a\d+)-.*'
+
+    if len(argv) != 0:
+        program = Path(argv[0]).name
+    else:
+        program = ""
+
+    match = re.match(aN_pattern, program)
+    if len(argv) == 0 or not match:
+        print("Note: Determining assignment based on first program in TEST list...", end="")
+        assignment = get_assignment_based_on_tests()
+        print("looks like '{}'".format(assignment))
+    else:
+        assignment = match.groups(0)[0]
+
+    return assignment
+
+def get_assignment_based_on_tests():
+    for aname, programs in get_configs().items():
+        for testprog in TEST:
+            for program in programs:
+                if testprog == program.get_name():
+                    return aname
+
+    raise TesterError("\nSorry! I can't figure out which assignment you're trying to test.\n"
+        "Either the tester must have a name like aN-tester.py or the variable TEST\n"
+        "in the tester source code (near the top) must specify a known program name.")
+
+def get_disclaimer():
+    return ["NOTE:",
+            "This tester gives you an automated way to confirm that your programs are producing the expected output for the examples shown in the assignment specifications, including error cases.",
+            "Passing the test cases does not guarantee any particular grade: additional and/or different test cases will be included when grading."
+            ]
+
+f=get_assignment_based_on_tests
+        
+def add_run_options(parser):
+    """Add the options that control how tests are run, shared by all the ways of running tests"""
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+        help="run up to N tests at the same time (0 means one per CPU)")
+    parser.add_argument("--warm", action="store_true",
+        help="run tests in children forked from pre-started Pythons instead of starting a new Python for each")
+    parser.add_argument("--no-cache", action="store_true",
+        help="run every test, even if its program, input, and expected output haven't changed since it was last run")
+    parser.add_argument("--cache-dir", default=".tester-cache", metavar="DIR",
+        help="keep the results of earlier runs in DIR (default: %(default)s)")
+    parser.add_argument("--cache-size", type=int, default=200, metavar="MB",
+        help="limit the cache to MB megabytes (default: %(default)s)")
+    add_limit_options(parser)
+    parser.add_argument("-x", "--fail-fast", action="store_true",
+        help="stop each test's program at its first line of output that differs from the expected output")
+    parser.add_argument("--offline", action="store_true",
+        help="don't check for new test files; use the test directory as it is")
+    parser.add_argument("--check-ttl", type=float, default=FRESHNESS_TTL, metavar="SECONDS",
+        help="check for new test files only if it's been SECONDS seconds since the last check (default: %(default)s)")
+    parser.add_argument("--background-check", action="store_true",
+        help="check for new test files while the tests run on the current ones")
+    parser.add_argument("--single-diff-file", action="store_true",
+        help="write all the tests' details in diff.html itself rather than a page per failed test")
+    parser.add_argument("--shard", type=parse_shard, metavar="K/N",
+        help="run only the Kth of N equal shares of the tests, writing results in shard-K-of-N; see 'merge'; implies --offline")
+    parser.add_argument("--shard-weights", metavar="FILE",
+        help="with --shard, balance the shares by the test times in FILE, the results.json of an earlier run")
+    parser.add_argument("--junit", action="store_true",
+        help="write results in JUnit XML format to junit.xml, next to diff.html and results.json")
+    parser.add_argument("--no-performance", action="store_true",
+        help="don't run the programs' performance cases")
+    parser.add_argument("--keep-output", action="store_true",
+        help="write every test's output to its actual file, not just the output of the tests that fail")
+    parser.add_argument("--profile", action="store_true",
+        help="run each test under the profiler and add where its time and memory went to diff.html and results.json")
+
+def add_limit_options(parser):
+    parser.add_argument("--timeout", type=float, metavar="SECONDS",
+        help="stop each test after SECONDS seconds (default: {})".format(DEFAULT_LIMITS["timeout"]))
+    parser.add_argument("--cpu-limit", type=float, metavar="SECONDS",
+        help="stop each test after SECONDS seconds of CPU time")
+    parser.add_argument("--memory-limit", type=parse_size, metavar="SIZE",
+        help="limit each test's memory to SIZE, like 500M")
+    parser.add_argument("--output-limit", type=parse_size, metavar="SIZE",
+        help="stop each test when it has written SIZE of output (default: {})".format(DEFAULT_LIMITS["output_limit"]))
+
+def check_run_options(args):
+    if args.jobs <= 0:
+        args.jobs = os.cpu_count() or 1
+
+    args.limits = {name: getattr(args, name) for name in LIMIT_NAMES}
+    # Shards on machines that share the test directory would replace it out from under each other
+    if args.shard:
+        args.offline = True
+
+    return args
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="CSC 120 Tester",
+        epilog="Use '%(prog)s batch --help' for grading a directory of submissions.")
+    add_run_options(parser)
+    parser.add_argument("--watch", action="store_true",
+        help="after running the tests, run them again as the programs and test files change, until ^C")
+
+    return check_run_options(parser.parse_args(argv))
+
+def main():
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == "batch":
+            batch_main(sys.argv[2:])
+        elif len(sys.argv) > 1 and sys.argv[1] == "warm-server":
+            warm_server()
+        elif len(sys.argv) == 4 and sys.argv[1] == "profile-child":
+            profile_child(sys.argv[2], sys.argv[3])
+        elif len(sys.argv) == 3 and sys.argv[1] == "manifest":
+            make_manifest(sys.argv[2])
+        elif len(sys.argv) == 3 and sys.argv[1] == "bundle":
+            make_bundle(sys.argv[2])
+        elif len(sys.argv) > 1 and sys.argv[1] == "record":
+            record_main(sys.argv[2:])
+        elif len(sys.argv) > 1 and sys.argv[1] == "merge":
+            merge_main(sys.argv[2:])
+        elif len(sys.argv) > 1 and sys.argv[1] == "serve":
+            serve_main(sys.argv[2:])
+        else:
+            test_main(sys.argv)
+    except TesterError as e:
+        print(e)
+        sys.exit(1)
+
+def test_main(argv):
+    import urllib.error
+
+    args = parse_args(argv[1:])
+    print_header()
+    assignment = get_assignment(argv)
+
+    report_dir = ""
+    if args.shard:
+        report_dir = get_shard_dir_name(args.shard)
+        os.makedirs(report_dir, exist_ok=True)
+    diff_file = make_diff_file(assignment, os.path.join(report_dir, "diff.html"), args.single_diff_file)
+    submission = Submission("", assignment, "", "test-" + assignment, diff_file, report_dir=report_dir, junit=args.junit)
+    submission.profile = args.profile
+    submission.keep_output = args.keep_output
+    submission.performance = not args.no_performance
+    
     try:
         configs = get_configs()
         if assignment not in configs:
-            print("Oops! Can't figure out assignment number for tester named '{}'".format(sys.argv[0]))
-            sys.exit(1)
+            raise TesterError("Oops! Can't figure out assignment number for tester named '{}'".format(argv[0]))
             
-        ensure_test_dir_current(assignment)
+        check = ensure_test_dir_current(assignment, args.offline, args.check_ttl, args.background_check)
+        cases = []
         for test_name in TEST:
             found_test = False
             for program in configs[assignment]:
                 if program.get_name() == test_name:
-                    run_tests(program, assignment, diff_file)
+                    if not Path(program.get_name()).is_file():
+                        raise TesterError("Oops! I can't find the file '{}'.  Did you use the right name for your solution?".format(program.get_name()))
+                    cases += get_test_cases(program, assignment, submission, args.limits)
                     found_test = True
             if not found_test:
-                print("Oops! Looks like TEST is incorrect: '{}' is not a program in this assignment."
+                raise TesterError("Oops! Looks like TEST is incorrect: '{}' is not a program in this assignment."
                     .format(test_name))
-                sys.exit(1)
-                
+
+        if args.shard:
+            if args.watch:
+                raise TesterError("Oops! --watch doesn't work with --shard.")
+            cases = select_shard(cases, args.shard, read_shard_weights(args.shard_weights))
+            print("Running shard {} of {}: {} tests, results in '{}'".format(*args.shard, len(cases), report_dir), end="")
+
+        runner = make_runner(args)
+        cache = make_cache(args)
+        try:
+            if args.watch:
+                submission.results = {}
+            run_tests(cases, args.jobs, runner, cache, args.fail_fast, make_durations(args))
+            # done() was only called by run_tests() if there were tests to run, and a shard with none still needs its results
+            submission.done()
+            if cache and cache.hits:
+                print("\n\n({} of {} results came from earlier runs; use --no-cache to run every test)".format(cache.hits, len(cases)), end="")
+            if check:
+                check.finish()
+            if args.watch:
+                diff_file.finish()
+                submission, diff_file = watch_tests(args, assignment, [case.program_spec for case in cases], submission, runner, cache)
+        finally:
+            runner.close()
+            if cache:
+                cache.close()
+
+    except TesterError as e:
+        print(e)
+        sys.exit(1)
+
     except urllib.error.HTTPError as e:
         print("Oops! HTTPError, url='{}'".format(e.geturl()))
         print(e)
@@ -554,12 +3541,1014 @@ def main():
     except KeyboardInterrupt:
         print("Interrupted!")
         diff_file.note_interrupted()
+        submission.done()
 
     finally:
         print("\n\n" + " ".join(get_disclaimer()))
         diff_file.finish()
 
-main()
+#
+# Watch mode: with --watch, once the tests have run, the tester waits for changes to the
+# programs being tested, the other .py files next to them (which they might import), and the
+# files in the test directory.  Then it runs just the tests that the changes affect, reuses
+# the other tests' results, and rewrites the console summary and diff.html.  If more files
+# change while tests are running, the run is abandoned and started again with those changes
+# too, so saving a file a few times in a row doesn't leave a queue of runs to sit through.
+# On Linux, changes are noticed with inotify; elsewhere, by checking the files' modification
+# times every WATCH_INTERVAL seconds.
+#
+
+WATCH_INTERVAL = 0.5
+WATCH_SETTLE = 0.2             # Editors save a file in several steps, so wait this long for more changes
+
+IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x8, 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED = 0x400, 0x800, 0x4000, 0x8000
+
+class FileMonitor:
+    """
+    Notices changes to the files in dirs (not their subdirectories) for which include(path)
+    returns True.  Changes are paths like "test-a1/word-grid-input-01.txt"; a directory's own
+    path means it was replaced or removed.
+    """
+    def __init__(self, dirs, include):
+        self._dirs = [os.path.normpath(d) for d in dirs]
+        self._include = include
+        self._pending = set()
+        self._fd = None
+        if sys.platform.startswith("linux"):
+            try:
+                self._start_inotify()
+            except (OSError, AttributeError):
+                self._fd = None
+        if self._fd is None:
+            self._mtimes = self._scan()
+
+    def _start_inotify(self):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1() failed")
+        self._fd = fd
+        self._watches = {}
+        self._add_watches()
+
+    def _add_watches(self):
+        """Watch the dirs that aren't being watched, returning the ones that now are"""
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+        added = []
+        for directory in self._dirs:
+            if directory not in self._watches.values() and os.path.isdir(directory):
+                wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+                if wd >= 0:
+                    self._watches[wd] = directory
+                    added.append(directory)
+        return added
+
+    def _read_events(self, timeout):
+        """Add the paths in inotify's events to the pending changes, waiting up to timeout seconds for some"""
+        import select
+        import struct
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return False
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return False
+
+        found = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+            offset += 16 + length
+            directory = self._watches.get(wd)
+            if mask & IN_Q_OVERFLOW:
+                self._pending.update(self._dirs)
+                found = True
+            elif directory is None:
+                continue
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # Like a test directory being replaced by a new one
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._watches[wd]
+                self._pending.add(directory)
+                found = True
+            elif name and self._include(os.path.normpath(os.path.join(directory, name))):
+                self._pending.add(os.path.normpath(os.path.join(directory, name)))
+                found = True
+
+        if self._add_watches():
+            found = True
+        return found
+
+    def _scan(self):
+        mtimes = {}
+        for directory in self._dirs:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.normpath(os.path.join(directory, name))
+                if self._include(path):
+                    try:
+                        stat = os.stat(path)
+                        mtimes[path] = (stat.st_mtime_ns, stat.st_size)
+                    except OSError:
+                        pass
+        return mtimes
+
+    def _poll(self, timeout):
+        """Add the files whose modification times have changed to the pending changes, checking for up to timeout seconds"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            mtimes = self._scan()
+            changed = set(path for path in set(mtimes) | set(self._mtimes) if mtimes.get(path) != self._mtimes.get(path))
+            self._mtimes = mtimes
+            if changed:
+                self._pending |= changed
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(WATCH_INTERVAL if deadline is None else max(0, min(WATCH_INTERVAL, deadline - time.monotonic())))
+
+    def _collect(self, timeout):
+        return self._read_events(timeout) if self._fd is not None else self._poll(timeout)
+
+    def has_changes(self):
+        """Return True if there are changes that wait() hasn't returned yet"""
+        self._collect(0)
+        return bool(self._pending)
+
+    def wait(self):
+        """Wait for changes, and then until there have been none for WATCH_SETTLE seconds, and return them"""
+        while not self._pending:
+            self._collect(None)
+        while self._collect(WATCH_SETTLE):
+            pass
+        changed, self._pending = self._pending, set()
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+def get_affected_tests(changed, cases, assignment):
+    """Return the get_case_key()s of the cases that changes to the paths in changed affect"""
+    test_dir = "test-" + assignment
+    program_fnames = set(case.program_fname for case in cases)
+    for path in changed:
+        if path == test_dir or (os.path.dirname(path) != test_dir and path not in program_fnames):
+            # A new test directory, or a module that the programs might import
+            return set(get_case_key(case) for case in cases)
+
+    affected = set()
+    for case in cases:
+        if changed & {case.program_fname, case.stdin_fname, case.expected_fname}:
+            affected.add(get_case_key(case))
+        elif changed & set(os.path.normpath(ref) for ref in get_test_file_refs(case.stdin_fname, assignment)):
+            affected.add(get_case_key(case))
+    return affected
+
+def watch_tests(args, assignment, programs, submission, runner, cache):
+    """
+    Run programs' tests again as files change (see the comment above), starting from the results
+    of submission, until ^C.  Returns the last run's Submission and diff file.
+    """
+    test_dir = "test-" + assignment
+    def include(path):
+        name = os.path.basename(path)
+        if os.path.dirname(path) == test_dir:
+            return not ("-actual-" in name or "-profile-" in name or name == FRESHNESS_FNAME or name.startswith(".") or name.endswith(".tmp"))
+        return name.endswith(".py")
+
+    programs = list(dict.fromkeys(programs))
+    monitor = FileMonitor([".", test_dir], include)
+    results = submission.results
+    stale = set()
+    diff_file = submission.diff_file
+    print("\n\nWatching for changes to the programs and test files; type ^C to stop.", end="")
+    sys.stdout.flush()
+    try:
+        while True:
+            changed = monitor.wait()
+            diff_file.finish()
+            diff_file = make_diff_file(assignment, "diff.html", args.single_diff_file)
+            submission = Submission("", assignment, "", test_dir, diff_file, junit=args.junit)
+            submission.results = {}
+            submission.profile = args.profile
+            submission.keep_output = args.keep_output
+            submission.performance = not args.no_performance
+            cases = []
+            for program in programs:
+                cases += get_test_cases(program, assignment, submission, args.limits)
+            stale |= get_affected_tests(changed, cases, assignment)
+            kept = {key: result for key, result in results.items() if key not in stale}
+
+            # Start the console over, if it's a terminal
+            print("\033[H\033[2J" if sys.stdout.isatty() else "\n\n", end="")
+            print("Changed: {}; running {} of {} tests".format(", ".join(sorted(changed)),
+                sum(get_case_key(case) not in kept for case in cases), len(cases)), end="")
+            finished = run_tests(cases, args.jobs, runner, cache, args.fail_fast, kept=kept, should_stop=monitor.has_changes)
+            results.update(submission.results)
+            stale -= set(submission.results) - set(kept)
+            if finished:
+                diff_file.finish()
+                print("\n\nWatching for changes; type ^C to stop.", end="")
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+        if not submission._done:
+            diff_file.note_interrupted()
+            submission.done()
+    finally:
+        monitor.close()
+    return submission, diff_file
+
+#
+# Batch grading: test every submission in a directory against one copy of test-aN
+#
+
+class BatchSubmission(Submission):
+    """
+    A submission in a batch run.  Its console output goes to output.txt and its diff.html
+    is written in its own result directory, along with its actual output files.  The
+    files are opened when the first result is reported and closed by done(), so only a
+    few submissions have files open at any time.  Unless quiet is True, done() prints a
+    one-line summary on the console.
+    """
+    def __init__(self, name, program_dir, result_dir, assignment, junit=False, single_diff_file=False, quiet=False):
+        Submission.__init__(self, name, assignment, program_dir, result_dir, None, None, result_dir, junit)
+        self.single_diff_file = single_diff_file
+        self.quiet = quiet
+        self.missing = []
+        self._opened = False
+
+    def _open(self):
+        if not self._opened:
+            self._opened = True
+            self.out = open(os.path.join(self.actual_dir, "output.txt"), "w")
+            self.diff_file = make_diff_file(self.assignment, os.path.join(self.actual_dir, "diff.html"), self.single_diff_file)
+            for program_fname in self.missing:
+                msg = "Oops! I can't find the file '{}'.  Did you use the right name for your solution?".format(program_fname)
+                self.print(msg)
+                self.diff_file.add_message(program_fname, 0, msg)
+
+    def print(self, *args, **kwargs):
+        self._open()
+        Submission.print(self, *args, **kwargs)
+
+    def report(self, result):
+        self._open()
+        Submission.report(self, result)
+
+    def note_interrupted(self):
+        """Note an interruption in this submission's diff.html, if it's been started.  Returns True if so."""
+        if self._opened and not self._done:
+            self.diff_file.note_interrupted()
+            return True
+        return False
+
+    def done(self):
+        if self._done:
+            return
+        self._open()
+        Submission.done(self)
+        self.print("\n\n" + " ".join(get_disclaimer()))
+        self.diff_file.finish()
+        self.out.close()
+
+        if self.quiet:
+            return
+        summary = "{}: {} passed, {} failed".format(self.name, self.num_passed, self.num_failed)
+        if self.missing:
+            summary += ", missing " + ", ".join(self.missing)
+        print(summary)
+
+def get_submissions(submissions_dir, results_dir, assignment, junit=False, single_diff_file=False):
+    """Return a BatchSubmission for each directory in submissions_dir, in name order"""
+    submissions = []
+    for path in sorted(Path(submissions_dir).iterdir()):
+        if not path.is_dir():
+            continue
+        result_dir = Path(results_dir) / path.name
+        result_dir.mkdir(parents=True, exist_ok=True)
+        submissions.append(BatchSubmission(path.name, str(path), str(result_dir), assignment, junit, single_diff_file))
+
+    return submissions
+
+def get_programs(assignment, names=None):
+    """Return the Programs of assignment from get_configs(), or just the ones named in names"""
+    configs = get_configs()
+    if assignment not in configs:
+        raise TesterError("Oops! '{}' is not an assignment I know about.".format(assignment))
+
+    programs = configs[assignment]
+    if names:
+        programs = [program for program in programs if program.get_name() in names]
+        unknown = set(names) - set(program.get_name() for program in programs)
+        if unknown:
+            raise TesterError("Oops! Not a program in this assignment: {}".format(", ".join(sorted(unknown))))
+    return programs
+
+def batch_main(argv):
+    import argparse
+    import urllib.error
+
+    parser = argparse.ArgumentParser(prog="tester batch",
+        description="Test each submission (a directory holding one student's programs) in SUBMISSIONS against test-ASSIGNMENT")
+    parser.add_argument("assignment", help="assignment name from get_configs(), like a5")
+    parser.add_argument("submissions", metavar="SUBMISSIONS", help="directory with one subdirectory per submission")
+    parser.add_argument("-r", "--results", metavar="DIR",
+        help="write each submission's results to DIR/<submission> (default: results-ASSIGNMENT)")
+    parser.add_argument("-p", "--program", action="append", metavar="NAME",
+        help="test only program NAME (may be repeated; default: all programs in the assignment)")
+    add_run_options(parser)
+    args = check_run_options(parser.parse_args(argv))
+
+    print_header()
+    programs = get_programs(args.assignment, args.program)
+    if not Path(args.submissions).is_dir():
+        raise TesterError("Oops! '{}' is not a directory.".format(args.submissions))
+
+    try:
+        check = ensure_test_dir_current(args.assignment, args.offline, args.check_ttl, args.background_check)
+    except urllib.error.URLError as e:
+        raise TesterError("{}\nOops! Couldn't get the test files for {}.".format(e, args.assignment))
+
+    results_dir = args.results or "results-" + args.assignment
+    if args.shard:
+        results_dir = os.path.join(results_dir, get_shard_dir_name(args.shard))
+    submissions = get_submissions(args.submissions, results_dir, args.assignment, args.junit, args.single_diff_file)
+    cases = []
+    for submission in submissions:
+        submission.profile = args.profile
+        submission.keep_output = args.keep_output
+        submission.performance = not args.no_performance
+        for program in programs:
+            if Path(submission.program_dir, program.get_name()).is_file():
+                cases += get_test_cases(program, args.assignment, submission, args.limits)
+            else:
+                submission.missing.append(program.get_name())
+
+    if args.shard:
+        cases = select_shard(cases, args.shard, read_shard_weights(args.shard_weights))
+        sharded = []
+        for submission in submissions:
+            # Missing programs are noted by the first shard only
+            if args.shard[0] != 1:
+                submission.missing = []
+            if submission.missing or any(case.submission is submission for case in cases):
+                sharded.append(submission)
+            else:
+                # It may have results from an earlier run of this shard
+                shutil.rmtree(submission.actual_dir)
+        submissions = sharded
+
+    print("Testing {} submissions, {} tests, results in '{}'".format(len(submissions), len(cases), results_dir))
+    runner = make_runner(args)
+    cache = make_cache(args)
+    try:
+        run_tests(cases, args.jobs, runner, cache, args.fail_fast, make_durations(args))
+    except KeyboardInterrupt:
+        print("Interrupted!")
+        for submission in submissions:
+            if submission.note_interrupted():
+                submission.done()
+        sys.exit(1)
+    finally:
+        runner.close()
+        if cache:
+            cache.close()
+
+    # Submissions with no tests to run haven't been reported yet
+    for submission in submissions:
+        submission.done()
+
+    # All the submissions' results in one file, for loading into a gradebook
+    with open(os.path.join(results_dir, "results.json"), "w") as f:
+        json.dump({"tester_version": VERSION, "python": sys.version, "assignment": args.assignment,
+            "submissions": [{"submission": submission.name, "passed": submission.num_passed,
+                "failed": submission.num_failed, "missing": submission.missing, "tests": submission.records,
+                "performance": submission.performance_records}
+                for submission in submissions]}, f, indent=1)
+
+    if cache and cache.hits:
+        print("({} of {} results came from the cache)".format(cache.hits, len(cases)))
+    if check:
+        check.finish()
+        print()
+
+#
+# Sharding: "--shard K/N" runs the Kth of N shares of the tests, so that a big run can be
+# spread over N machines that share a filesystem.  Every machine works out the same shares
+# from the list of tests (and the weights, if given), so nothing else needs to be shared.
+# Each shard's results go in a directory shard-K-of-N (under the results directory, for
+# batch runs), and "tester.py merge DIR" combines the shards in DIR into one set of results.
+#
+
+def parse_shard(spec):
+    """Parse a --shard argument like 2/5 into (2, 5)"""
+    import argparse
+    m = re.fullmatch(r"([0-9]+)/([0-9]+)", spec)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError("expected K/N with 1 <= K <= N, like 2/5, not '{}'".format(spec))
+    return int(m.group(1)), int(m.group(2))
+
+def get_shard_dir_name(shard):
+    return "shard-{}-of-{}".format(*shard)
+
+def get_shard_key(submission_name, program_fname, test_num):
+    return "{}/{}/{}".format(submission_name, program_fname, test_num)
+
+def read_shard_weights(fname):
+    """Return a dict of test times from the results.json fname (see get_shard_key()), or None if fname is None"""
+    if fname is None:
+        return None
+    try:
+        with open(fname) as f:
+            results = json.load(f)
+    except (OSError, ValueError) as e:
+        raise TesterError("Oops! Couldn't read the shard weights in '{}': {}".format(fname, e))
+
+    weights = {}
+    for submission in results.get("submissions", [results]):
+        for record in submission["tests"]:
+            weights[get_shard_key(submission["submission"], record["program"], record["test"])] = record["wall_time"]
+    return weights
+
+def select_shard(cases, shard, weights=None):
+    """
+    Return the cases in shard (K, N).  The cases are dealt out in order of decreasing weight,
+    each to the share with the least total weight so far, so the shares take about the same
+    time.  Cases without a weight get the average weight, and with no weights at all, each
+    case counts the same.
+    """
+    k, n = shard
+    weights = weights or {}
+    def get_key(case):
+        return get_shard_key(case.submission.name, case.program_fname, case.test_num)
+    default = sum(weights.values()) / len(weights) if weights else 1
+    def get_weight(case):
+        return weights.get(get_key(case), default)
+
+    loads = [0] * n
+    selected = set()
+    for case in sorted(cases, key=lambda case: (-get_weight(case), get_key(case))):
+        i = loads.index(min(loads))
+        loads[i] += get_weight(case)
+        if i == k - 1:
+            selected.add(id(case))
+
+    return [case for case in cases if id(case) in selected]
+
+def merge_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="tester merge",
+        description="Combine the results of the shard-K-of-N directories in DIR into one set of results in DIR")
+    parser.add_argument("dir", metavar="DIR", help="the directory holding the shards' directories (default: .)", nargs="?", default=".")
+    parser.add_argument("--junit", action="store_true", help="also write junit.xml")
+    args = parser.parse_args(argv)
+
+    shard_dirs = {}
+    for path in Path(args.dir).glob("shard-*-of-*"):
+        m = re.fullmatch(r"shard-([0-9]+)-of-([0-9]+)", path.name)
+        if m and path.is_dir():
+            shard_dirs[(int(m.group(1)), int(m.group(2)))] = path
+    counts = set(n for k, n in shard_dirs)
+    if len(counts) != 1:
+        raise TesterError("Oops! Expected the shard-K-of-N directories of one sharded run in '{}'.".format(args.dir))
+    n = counts.pop()
+
+    shards = []
+    for k in range(1, n + 1):
+        results_fname = shard_dirs.get((k, n), Path(args.dir, get_shard_dir_name((k, n)))) / "results.json"
+        if not results_fname.is_file():
+            raise TesterError("Oops! There's no '{}'.  Has shard {} of {} finished?".format(results_fname, k, n))
+        with results_fname.open() as f:
+            shards.append((shard_dirs[(k, n)], json.load(f)))
+
+    assignment = shards[0][1]["assignment"]
+    if "submissions" not in shards[0][1]:
+        submission = merge_submission("", assignment, args.dir, [(shard_dir, results) for shard_dir, results in shards], args.junit)
+        submission.out.write("\n")
+        return
+
+    names = sorted(set(result["submission"] for _, results in shards for result in results["submissions"]))
+    submissions = []
+    for name in names:
+        parts = [(shard_dir / name, result) for shard_dir, results in shards
+            for result in results["submissions"] if result["submission"] == name]
+        result_dir = os.path.join(args.dir, name)
+        os.makedirs(result_dir, exist_ok=True)
+        submission = merge_submission(name, assignment, result_dir, parts, args.junit, out=io.StringIO())
+        summary = "{}: {} passed, {} failed".format(name, submission.num_passed, submission.num_failed)
+        if submission.missing:
+            summary += ", missing " + ", ".join(submission.missing)
+        print(summary)
+        submissions.append(submission)
+
+    with open(os.path.join(args.dir, "results.json"), "w") as f:
+        json.dump({"tester_version": VERSION, "python": sys.version, "assignment": assignment,
+            "submissions": [{"submission": submission.name, "passed": submission.num_passed,
+                "failed": submission.num_failed, "missing": submission.missing, "tests": submission.records,
+                "performance": submission.performance_records}
+                for submission in submissions]}, f, indent=1)
+
+def merge_submission(name, assignment, report_dir, parts, junit, out=None):
+    """
+    Combine the results of a submission from several shards, given as (report directory,
+    results) pairs, into results.json and diff.html in report_dir.  Returns the Submission.
+    """
+    diff_file = DiffReport(assignment, os.path.join(report_dir, "diff.html"))
+    submission = Submission(name, assignment, "", "", diff_file, out, report_dir, junit)
+    submission.missing = []
+    records = []
+    performance_records = {}
+    for part_dir, results in parts:
+        submission.missing += results.get("missing", [])
+        records += [(record, part_dir) for record in results["tests"]]
+        # Each shard that ran one of a program's tests ran its performance cases too
+        for record in results.get("performance", []):
+            performance_records.setdefault((record["program"], record["case"]), record)
+
+    for program_fname in submission.missing:
+        diff_file.add_message(program_fname, 0, "Oops! I can't find the file '{}'.".format(program_fname))
+    for record, part_dir in sorted(records, key=lambda item: (item[0]["program"], item[0]["test"])):
+        part_fname = Path(part_dir, "diff-tests", "{}-{}.html".format(record["program"], record["test"]))
+        has_part = record["verdict"] != "PASSED" or record.get("profile")
+        diff_file.add_record(record, part_fname.as_posix() if has_part and part_fname.is_file() else None)
+        submission.records.append(record)
+        if record["verdict"] == "PASSED":
+            submission.num_passed += 1
+        else:
+            submission.num_failed += 1
+    for record in performance_records.values():
+        submission.performance_records.append(record)
+        diff_file.add_performance(record)
+
+    submission.done()
+    diff_file.finish()
+    return submission
+
+#
+# Using the tester from Python: a grading service can import this file and call run_suite()
+# for each submission, rather than running a tester process per submission and reading what
+# it prints.  Importing the file doesn't run anything, problems raise TesterError rather than
+# exiting, and a runner and cache can be kept from one call to the next.
+#
+
+def get_run_options(options=None):
+    """
+    Return the settings for a run, as parse_args() would return them for a command line with
+    no options, changed by the dict options.  Its keys are the long option names with "_" for
+    "-", like {"jobs": 4, "timeout": 10, "offline": True}, with values like the ones argparse
+    produces, plus "diff_type" and "stop_on_first_diff", which default to DIFF_TYPE and
+    STOP_ON_FIRST_DIFF.
+    """
+    args = parse_args([])
+    args.diff_type = DIFF_TYPE
+    args.stop_on_first_diff = STOP_ON_FIRST_DIFF
+    for name, value in (options or {}).items():
+        if name == "limits" or not hasattr(args, name):
+            raise TesterError("Oops! '{}' isn't a tester option.".format(name))
+        setattr(args, name, value)
+    get_diff_function(args.diff_type)
+
+    return check_run_options(args)
+
+def run_suite(assignment, programs=None, submission_dir=".", options=None, result_dir=None, runner=None, cache=None, on_record=None):
+    """
+    Test the programs in submission_dir against test-ASSIGNMENT, checking for new test files
+    first, and return the BatchSubmission that holds the results: its records (see
+    make_result_record()), num_passed, num_failed, and missing, the programs that aren't in
+    submission_dir.  programs are names like "phylo.py" (default: all of the assignment's).
+    options are as for get_run_options().  As in a batch run, the actual output files,
+    output.txt, diff.html, and results.json are written in result_dir (default:
+    results-ASSIGNMENT/<name of submission_dir>).  If runner or cache is given, it's used
+    rather than one made from options, and isn't closed, so that it can serve many calls.
+    on_record, if given, is called with each test's record as it's reported.
+    """
+    import urllib.error
+
+    args = get_run_options(options)
+    programs = get_programs(assignment, programs)
+    if not Path(submission_dir).is_dir():
+        raise TesterError("Oops! '{}' is not a directory.".format(submission_dir))
+
+    try:
+        check = ensure_test_dir_current(assignment, args.offline, args.check_ttl, args.background_check)
+    except urllib.error.URLError as e:
+        raise TesterError("{}\nOops! Couldn't get the test files for {}.".format(e, assignment)) from e
+
+    name = Path(submission_dir).resolve().name
+    result_dir = get_result_dir(assignment, submission_dir, result_dir)
+    os.makedirs(result_dir, exist_ok=True)
+    submission = BatchSubmission(name, str(submission_dir), result_dir, assignment, args.junit, args.single_diff_file, quiet=True)
+    submission.diff_type = args.diff_type
+    submission.profile = args.profile
+    submission.keep_output = args.keep_output
+    submission.performance = not args.no_performance
+    submission.on_record = on_record
+    cases = []
+    for program in programs:
+        if Path(submission_dir, program.get_name()).is_file():
+            cases += get_test_cases(program, assignment, submission, args.limits)
+        else:
+            submission.missing.append(program.get_name())
+
+    own_runner = runner is None
+    own_cache = cache is None
+    if own_runner:
+        runner = make_runner(args)
+    if own_cache:
+        cache = make_cache(args)
+    try:
+        run_tests(cases, args.jobs, runner, cache, args.fail_fast, make_durations(args), args.stop_on_first_diff)
+    finally:
+        if own_runner:
+            runner.close()
+        if own_cache and cache:
+            cache.close()
+
+    # done() was only called by run_tests() if there were tests to run
+    submission.done()
+    if check:
+        # There's no one to tell about new test files, but the next call will use them
+        check.finish(io.StringIO())
+    return submission
+
+def get_result_dir(assignment, submission_dir, result_dir=None):
+    """Return the directory run_suite() writes submission_dir's results in: result_dir, if given"""
+    return result_dir or os.path.join("results-" + assignment, Path(submission_dir).resolve().name)
+
+#
+# Grading service: "tester.py serve" keeps the test directories of all the assignments in
+# get_configs() up to date and a pool of warm servers running, and grades submissions sent
+# to it over HTTP, on a Unix socket (or with --port, a localhost port), so that a burst of
+# submissions doesn't pay for starting a tester and checking test files each time.  A job is
+# a POST to /grade of a JSON object like
+#
+#     {"assignment": "a5", "submission_dir": "/subs/jdoe", "programs": ["phylo.py"],
+#      "priority": "interactive", "options": {"timeout": 10}, "result_dir": "/results/jdoe"}
+#
+# where only assignment and submission_dir are required, and programs, options and result_dir
+# are as for run_suite().  Anyone who can send the service a job can have it run the code in
+# a submission directory, so the socket is only usable by the service's user until its
+# permissions are changed, and a localhost port, which every user of the machine can reach,
+# is only for machines with a single user.  Jobs can't reach further than the service lets
+# them: submission_dir must be under --submissions-root and result_dir (default
+# RESULTS-ROOT/results-aN/<name of submission_dir>) under --results-root, options can only
+# be the ones in SERVE_JOB_OPTIONS, and jobs and the limits in options are cut down to the
+# service's own (or the default limits) if they're higher.  The reply is a line of JSON per test, its record (see
+# make_result_record()), as the test finishes, and then a line with "done" and the totals, or
+# with "error" and what went wrong.  Jobs are graded --workers at a time, each running -j tests
+# at a time, interactive jobs (a student checking their work) before bulk ones (a regrade).
+# When --queue-size jobs are waiting, more are turned away with status 503, and the client
+# should try again later.  GET /status tells how many jobs are waiting and running.
+#
+
+SERVE_PRIORITIES = {"interactive": 0, "bulk": 1}
+SERVE_CACHE_TRIM_INTERVAL = 300      # The service's cache is trimmed to its size limit this often (in seconds)
+SERVE_JOB_OPTIONS = ["fail_fast", "stop_on_first_diff", "diff_type", "junit", "single_diff_file", "no_performance",
+    "jobs"] + LIMIT_NAMES
+
+class GradingQueue:
+    """
+    The jobs waiting to be graded, taken by priority and then in order of arrival.  put()
+    refuses a job, returning False, when max_size jobs are already waiting.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._condition = threading.Condition()
+        self._heap = []
+        self._count = itertools.count()
+        self.running = 0
+
+    def put(self, priority, job):
+        with self._condition:
+            if len(self._heap) >= self._max_size:
+                return False
+            heapq.heappush(self._heap, (priority, next(self._count), job))
+            self._condition.notify()
+            return True
+
+    def get(self):
+        """Wait for the next job and return it; call done() when it's finished"""
+        with self._condition:
+            while not self._heap:
+                self._condition.wait()
+            self.running += 1
+            return heapq.heappop(self._heap)[2]
+
+    def done(self):
+        with self._condition:
+            self.running -= 1
+
+    def get_status(self):
+        with self._condition:
+            waiting = {name: 0 for name in SERVE_PRIORITIES}
+            for priority, _, job in self._heap:
+                waiting[job.priority] += 1
+            return {"waiting": waiting, "running": self.running, "max_waiting": self._max_size}
+
+class GradingJob:
+    """
+    A request to grade a submission, and the queue of events for its reply.  args are the
+    service's settings, which limit what the request can ask for (see serve_main()).
+    """
+    def __init__(self, request, base_options, args):
+        if not isinstance(request, dict) or not isinstance(request.get("assignment"), str) \
+                or not isinstance(request.get("submission_dir"), str):
+            raise ValueError("expected a JSON object with \"assignment\" and \"submission_dir\"")
+        self.priority = request.get("priority", "interactive")
+        if self.priority not in SERVE_PRIORITIES:
+            raise ValueError("priority should be one of {}".format(", ".join(SERVE_PRIORITIES)))
+        self.programs = request.get("programs")
+        if self.programs is not None and not (isinstance(self.programs, list) and all(isinstance(name, str) for name in self.programs)):
+            raise ValueError("programs should be a list of program names")
+
+        self.assignment = request["assignment"]
+        self.submission_dir = check_under(request["submission_dir"], args.submissions_root, "submission_dir")
+        result_dir = request.get("result_dir") or os.path.normpath(os.path.join(args.results_root,
+            get_result_dir(self.assignment, self.submission_dir)))
+        if not isinstance(result_dir, str):
+            raise ValueError("result_dir should be a directory name")
+        self.result_dir = check_under(result_dir, args.results_root, "result_dir")
+
+        options = request.get("options", {})
+        if not isinstance(options, dict):
+            raise ValueError("options should be a JSON object")
+        unknown = sorted(set(options) - set(SERVE_JOB_OPTIONS))
+        if unknown:
+            raise ValueError("a job can't set {}; try {}".format(", ".join(unknown), ", ".join(SERVE_JOB_OPTIONS)))
+        self.options = dict(base_options, **options)
+        for name in ["jobs"] + LIMIT_NAMES:
+            if name in options:
+                self.options[name] = get_job_limit(name, options[name], base_options)
+        # The service keeps the test directories up to date itself
+        self.options["offline"] = True
+        self.events = queue.Queue()
+
+def check_under(path, root, what):
+    """Return path, what a job calls it, if it's in the directory root or below, and raise ValueError if not"""
+    resolved = Path(path).resolve()
+    root = Path(root).resolve()
+    if resolved != root and root not in resolved.parents:
+        raise ValueError("{} should be in '{}'".format(what, root))
+    return path
+
+def get_job_limit(name, value, base_options):
+    """
+    Return a job's setting of jobs or of the limit name, value, cut down to the service's
+    own setting, or if the service has none, to DEFAULT_LIMITS'
+    """
+    if name in ["memory_limit", "output_limit"]:
+        value = parse_size(value)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        raise ValueError("{} should be a positive number".format(name))
+    if name == "jobs":
+        return min(int(value), base_options["jobs"])
+    limit = base_options[name]
+    if limit is None:
+        limit = parse_size(DEFAULT_LIMITS[name])
+    return value if limit is None else min(value, limit)
+
+class ReadWriteLock:
+    """
+    A lock that any number of threads can hold shared, or one thread exclusive.  Once a
+    thread is waiting to hold it exclusive, no more threads get it shared until that thread
+    has had its turn, so that a steady stream of shared holders can't keep it waiting forever.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting = 0
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._condition:
+            while self._exclusive or self._waiting:
+                self._condition.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._shared -= 1
+                if not self._shared:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._waiting += 1
+            while self._exclusive or self._shared:
+                self._condition.wait()
+            self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+class NamedLocks:
+    """A lock for each name, like a directory's, that's only kept while it's held or waited for"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}        # name -> [lock, number of threads holding or waiting for it]
+
+    @contextlib.contextmanager
+    def hold(self, name):
+        with self._lock:
+            entry = self._locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[name]
+
+def grade_jobs(grading_queue, runner, cache, fixture_locks, result_dir_locks, args):
+    """
+    Grade jobs from grading_queue, forever; run by each of the service's worker threads.
+    fixture_locks has a ReadWriteLock per assignment, which jobs hold shared while they use
+    its test directory, and which is held exclusive to replace the directory with new test
+    files, so that it isn't replaced out from under a job.  Jobs that write their results
+    in the same directory, like a student's resubmissions, take turns, by result_dir_locks,
+    a NamedLocks.
+    """
+    while True:
+        job = grading_queue.get()
+        try:
+            get_programs(job.assignment, job.programs)
+            fixture_lock = fixture_locks[job.assignment]
+            if not is_test_dir_fresh(Path("test-" + job.assignment), args.offline, args.check_ttl):
+                with fixture_lock.exclusive():
+                    ensure_test_dir_current(job.assignment, args.offline, args.check_ttl)
+            result_dir = os.path.abspath(get_result_dir(job.assignment, job.submission_dir, job.result_dir))
+            with result_dir_locks.hold(result_dir), fixture_lock.shared():
+                submission = run_suite(job.assignment, job.programs, job.submission_dir, job.options, job.result_dir,
+                    runner, cache, job.events.put)
+            job.events.put({"done": True, "submission": submission.name, "passed": submission.num_passed,
+                "failed": submission.num_failed, "missing": submission.missing, "result_dir": submission.report_dir})
+        except TesterError as e:
+            job.events.put({"error": str(e).strip()})
+        except Exception as e:
+            job.events.put({"error": "{}: {}".format(type(e).__name__, e)})
+            import traceback
+            traceback.print_exc()
+        finally:
+            grading_queue.done()
+
+def trim_cache(cache):
+    """Keep cache within its size limit, forever; the service never closes it, which is when a run trims its cache"""
+    while True:
+        time.sleep(SERVE_CACHE_TRIM_INTERVAL)
+        cache.trim()
+
+def make_grading_server(args, grading_queue, base_options):
+    """Return an HTTP server that takes jobs for grading_queue, on args.socket or localhost:args.port"""
+    import http.server
+    import socketserver
+
+    class GradingHandler(http.server.BaseHTTPRequestHandler):
+        def _reply(self, status, value, headers=None):
+            body = (json.dumps(value) + "\n").encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, header in (headers or {}).items():
+                self.send_header(name, header)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != "/status":
+                self._reply(404, {"error": "try GET /status or POST /grade"})
+                return
+            self._reply(200, grading_queue.get_status())
+
+        def do_POST(self):
+            if self.path != "/grade":
+                self._reply(404, {"error": "try GET /status or POST /grade"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                job = GradingJob(request, base_options, args)
+            except (ValueError, TypeError) as e:
+                self._reply(400, {"error": "bad request: {}".format(e)})
+                return
+            if not grading_queue.put(SERVE_PRIORITIES[job.priority], job):
+                self._reply(503, {"error": "too many jobs waiting; try again later"}, {"Retry-After": "10"})
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            while True:
+                event = job.events.get()
+                try:
+                    self.wfile.write((json.dumps(event) + "\n").encode())
+                    self.wfile.flush()
+                except OSError:
+                    pass     # The client's gone, but the job still gets graded
+                if "done" in event or "error" in event:
+                    break
+
+        def address_string(self):
+            # A Unix socket's clients have no address
+            return self.client_address[0] if self.client_address else "local"
+
+    if args.port:
+        return http.server.ThreadingHTTPServer(("127.0.0.1", args.port), GradingHandler)
+
+    class GradingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    # Only the service's user can connect until the socket's permissions are changed
+    umask = os.umask(0o177)
+    try:
+        return GradingServer(args.socket, GradingHandler)
+    finally:
+        os.umask(umask)
+
+def serve_main(argv):
+    import argparse
+    import urllib.error
+
+    parser = argparse.ArgumentParser(prog="tester serve",
+        description="Grade submissions sent over HTTP; see the comments before serve_main() for the protocol")
+    parser.add_argument("--socket", default="tester-serve.sock", metavar="PATH",
+        help="listen on the Unix socket PATH, which only the service's user can use until its permissions are changed "
+            "(default: %(default)s)")
+    parser.add_argument("--port", type=int, metavar="PORT",
+        help="listen on localhost:PORT instead, which every user of this machine can reach")
+    parser.add_argument("--submissions-root", default=".", metavar="DIR",
+        help="only grade submissions in DIR or below (default: the current directory)")
+    parser.add_argument("--results-root", default=".", metavar="DIR",
+        help="only write results in DIR or below (default: the current directory)")
+    parser.add_argument("--workers", type=int, default=2, metavar="N", help="grade N jobs at a time (default: %(default)s)")
+    parser.add_argument("--queue-size", type=int, default=100, metavar="N",
+        help="turn jobs away when N are waiting (default: %(default)s)")
+    add_run_options(parser)
+    args = check_run_options(parser.parse_args(argv))
+    # Each job's options start from the service's
+    base_options = {name: value for name, value in vars(args).items()
+        if name not in ["port", "socket", "submissions_root", "results_root", "workers", "queue_size", "limits"]}
+
+    print_header()
+    fixture_locks = {assignment: ReadWriteLock() for assignment in get_configs()}
+    for assignment in get_configs():
+        if not re.fullmatch(r"a[0-9]+", assignment):
+            continue
+        try:
+            ensure_test_dir_current(assignment, args.offline, args.check_ttl)
+        except (urllib.error.URLError, TesterError) as e:
+            print("Note: no test files for {} ({})".format(assignment, str(e).strip()))
+
+    runner = WarmRunner() if hasattr(os, "fork") else SubprocessRunner()
+    if isinstance(runner, WarmRunner):
+        runner.start(args.workers * args.jobs)
+    cache = make_cache(args)
+    if cache:
+        threading.Thread(target=trim_cache, args=(cache,), daemon=True).start()
+    grading_queue = GradingQueue(args.queue_size)
+    result_dir_locks = NamedLocks()
+    for _ in range(args.workers):
+        threading.Thread(target=grade_jobs, args=(grading_queue, runner, cache, fixture_locks, result_dir_locks, args),
+            daemon=True).start()
+
+    server = make_grading_server(args, grading_queue, base_options)
+    print("Grading {} jobs at a time, {} tests each, on {}".format(args.workers, args.jobs,
+        "http://127.0.0.1:{}/".format(args.port) if args.port else args.socket))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Interrupted!")
+    finally:
+        server.server_close()
+        if not args.port and os.path.exists(args.socket):
+            os.remove(args.socket)
+        runner.close()
+        if cache:
+            cache.close()
+
+if __name__ == "__main__":
+    main()
 
 """
 Fix: